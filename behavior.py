@@ -0,0 +1,182 @@
+# Behavior features of spikes, for phy
+#
+# Port of visualize-behavior/+phy/makeNPYfiles.m as a stage of the export.
+# phy shows every spike_<name>.npy of its folder as a per-spike attribute, so
+# for each behavior variable we write its value at the time of every spike,
+# and behavioral content can be looked at while curating. The session's
+# timestamps mda is memory-mapped once per session (per process), and all the
+# spikes of a tetrode are aligned to the behavior table with one searchsorted.
+
+import glob
+import json
+import os
+
+import numpy as np
+
+import manifest
+import mdaio
+
+# Columns of the behavior table that are not spike features
+EXCLUDED = ('day', 'time')
+
+# (variable, variable, fill value) pairs written as one (spikes x 2) file
+VARS2D = (('x', 'y', 0.),
+          ('currentAngle', 'currentPathLength', -10.),
+          ('currentAngle', 'currentEucDist', -10.))
+
+# Fill value of the one dimensional variables
+NANVAL = -10.
+
+# Marker left in the phy folder : digest of what the features were made from
+MARKER = '.behavior_features'
+
+def find_timestamps(session_path:str):
+    '''
+    The session's timestamps mda (first *time*mda* of the session folder),
+    followed through a .prv to the file it points to
+    '''
+    candidates = sorted(glob.glob(os.path.join(session_path, '*time*mda*')))
+    if not candidates:
+        raise FileNotFoundError(f"no timestamps mda in {session_path}")
+    timefile = candidates[0]
+    if timefile.endswith('.prv'):
+        with open(timefile, 'r') as F:
+            timefile = json.load(F)['original_path']
+    return timefile
+
+def read_table(filename:str):
+    '''
+    Behavior table as a DataFrame, by extension : csv, parquet, feather,
+    pickle or hdf (one 'time' column in seconds, one column per variable)
+    '''
+    import pandas as pd
+    readers = {'.csv': pd.read_csv, '.parquet': pd.read_parquet,
+               '.feather': pd.read_feather, '.pkl': pd.read_pickle,
+               '.pickle': pd.read_pickle, '.h5': pd.read_hdf,
+               '.hdf': pd.read_hdf}
+    extension = os.path.splitext(filename)[1].lower()
+    if extension not in readers:
+        raise ValueError(f"unsupported behavior table format {filename}")
+    return readers[extension](filename)
+
+class BehaviorSession:
+    '''
+    Behavior table and spike clock of one session
+
+    Parameters
+    ----------
+    session_path : str
+        the .mountain folder holding the timestamps mda
+    table : str
+        behavior table file (relative paths are taken from session_path)
+    clock_rate : float
+        ticks per second of the timestamps
+    day : int or None
+        keep only the rows of this day, for tables spanning several days
+    max_gap_s : float or None
+        spikes further than this from every behavior sample get no value
+        (None : 1.5 times the median sampling interval of the table)
+    '''
+
+    def __init__(self, session_path:str, table:str, clock_rate=30000.,
+                 day=None, max_gap_s=None):
+        self.timestamps_file = find_timestamps(session_path)
+        header = mdaio.read_header(self.timestamps_file)
+        self.timestamps = np.memmap(self.timestamps_file, dtype=header.dtype,
+                                    mode='r', offset=header.header_size,
+                                    shape=(int(np.prod(header.dims)),))
+        self.clock_rate = clock_rate
+
+        self.table_file = os.path.join(session_path, table)
+        beh = read_table(self.table_file)
+        if day is not None and 'day' in beh.columns:
+            beh = beh[beh['day'] == day]
+        beh = beh.sort_values('time')
+        self.time = beh['time'].to_numpy(dtype='float64')
+        self.vars1d = [name for name in beh.columns if name not in EXCLUDED
+                       and (beh[name].dtype.kind in 'biuf')]
+        self.vars2d = [pair for pair in VARS2D
+                       if pair[0] in self.vars1d and pair[1] in self.vars1d]
+        self.values = beh[self.vars1d].to_numpy(dtype='float64')
+        if max_gap_s is None:
+            max_gap_s = 1.5 * np.median(np.diff(self.time)) if len(self.time) > 1 else 0.
+        self.max_gap_s = max_gap_s
+
+        self.digest = manifest.digest(manifest.fast_hash(self.timestamps_file),
+                                      manifest.full_hash(self.table_file),
+                                      clock_rate, day, max_gap_s)
+
+    def rows(self, spike_samples):
+        '''
+        Row of the behavior table nearest to each spike (samples of the
+        recording, i.e. indices into the timestamps); -1 where the spike is
+        out of the table or further than max_gap_s from its nearest row
+        '''
+        spike_samples = np.asarray(spike_samples, dtype='int64').ravel()
+        rows = np.full(len(spike_samples), -1, dtype='int64')
+        inside = (spike_samples >= 0) & (spike_samples < len(self.timestamps))
+        if len(self.time) == 0 or not inside.any():
+            return rows
+        seconds = self.timestamps[spike_samples[inside]] / self.clock_rate
+        after = np.clip(np.searchsorted(self.time, seconds), 1, len(self.time) - 1)
+        before = after - 1
+        nearest = np.where(np.abs(self.time[after] - seconds) <
+                           np.abs(seconds - self.time[before]), after, before)
+        if len(self.time) == 1:
+            nearest[:] = 0
+        valid = ((seconds >= self.time[0]) & (seconds <= self.time[-1]) &
+                 (np.abs(self.time[nearest] - seconds) <= self.max_gap_s))
+        rows[inside] = np.where(valid, nearest, -1)
+        return rows
+
+    def features(self, spike_samples):
+        '''
+        {file name: array} of the spike_*.npy feature files for these spikes
+        '''
+        rows = self.rows(spike_samples)
+        values = self.values[np.maximum(rows, 0)]
+        values[rows < 0] = np.nan
+        column = {name: index for index, name in enumerate(self.vars1d)}
+        files = {f'spike_{name}.npy': np.nan_to_num(values[:, column[name]],
+                                                    nan=NANVAL)
+                 for name in self.vars1d}
+        for first, second, nanval in self.vars2d:
+            files[f'spike_{first}{second}.npy'] = np.nan_to_num(
+                values[:, [column[first], column[second]]], nan=nanval)
+        return files
+
+    def fresh(self, phyplace:str):
+        '''
+        Are the features of phyplace made from this table and clock?
+        '''
+        try:
+            with open(os.path.join(phyplace, MARKER), 'r') as F:
+                return F.read().strip() == self.digest
+        except OSError:
+            return False
+
+    def write(self, phyplace:str):
+        '''
+        Write every spike_*.npy feature file of phyplace, each through a
+        rename, then the marker
+        '''
+        spike_times = np.load(os.path.join(phyplace, 'spike_times.npy'),
+                              mmap_mode='r')
+        for name, values in self.features(spike_times).items():
+            filename = os.path.join(phyplace, name)
+            np.save(filename + '.tmp.npy', values)
+            os.replace(filename + '.tmp.npy', filename)
+        with open(os.path.join(phyplace, MARKER), 'w') as F:
+            F.write(self.digest)
+
+# Sessions already loaded by this process
+_sessions = {}
+
+def session(session_path:str, table:str, **params):
+    '''
+    BehaviorSession of session_path, loaded once per process
+    '''
+    key = (os.path.abspath(session_path), table, tuple(sorted(params.items())))
+    if key not in _sessions:
+        _sessions[key] = BehaviorSession(session_path, table, **params)
+    return _sessions[key]
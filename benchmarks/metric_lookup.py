@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+# Cluster table refresh latency of MSCurationTagsPlugin
+#
+# Builds a synthetic metrics_tagged.json and times what phy does when it
+# redraws the cluster view : every metric column evaluated for every cluster.
+# "before" replays the old pandas lookup (cluster_id in df.index, then
+# df.loc[cluster_id]), "after" the array backed lambdas and the batch API.
+#
+# Usage: python benchmarks/metric_lookup.py [--clusters 500] [--repeat 5]
+# (needs phy importable, like the plugin itself)
+
+import json
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'plugins'))
+from MSclusterPlugins import MSCurationTagsPlugin
+
+def synthetic_metrics(filename:str, n_clusters:int, seed=0):
+    '''
+    Write a metrics_tagged.json with n_clusters mountainsort clusters
+    '''
+    rng = np.random.default_rng(seed)
+    labels = np.sort(rng.choice(np.arange(1, 4 * n_clusters), n_clusters,
+                                replace=False))
+    clusters = []
+    for label in labels:
+        num_events = int(rng.integers(50, 50000))
+        clusters.append(dict(
+            label=int(label),
+            metrics=dict(num_events=num_events,
+                         firing_rate=num_events / 3600.,
+                         t1_sec=float(rng.uniform(0, 10)),
+                         t2_sec=float(rng.uniform(3590, 3600)),
+                         dur_sec=3600.,
+                         peak_amp=float(rng.uniform(50, 400)),
+                         peak_noise=float(rng.uniform(5, 20)),
+                         peak_snr=float(rng.uniform(2, 30)),
+                         isolation=float(rng.uniform(0.5, 1)),
+                         noise_overlap=float(rng.uniform(0, 0.5)),
+                         overlap_cluster=int(rng.choice(labels)),
+                         bursting_parent=int(rng.choice(labels)
+                                             if rng.random() < 0.2 else 0)),
+            tags=['accepted'] if rng.random() < 0.7 else ['rejected', 'noise']))
+    with open(filename, 'w') as F:
+        json.dump(dict(clusters=clusters), F)
+
+def pandas_lambda(df, metric:str):
+    '''
+    The lookup the plugin used before the metric arrays
+    '''
+    obj = df[metric]
+    def func(cluster_id):
+        if cluster_id in obj.index:
+            return obj.loc[cluster_id]
+        return np.nan
+    return func
+
+def timed(refresh, repeat:int):
+    '''
+    Best of repeat wall times of refresh(), in ms
+    '''
+    best = np.inf
+    for _ in range(repeat):
+        start = time.perf_counter()
+        refresh()
+        best = min(best, time.perf_counter() - start)
+    return best * 1e3
+
+def run(n_clusters=500, repeat=5):
+    with tempfile.TemporaryDirectory() as folder:
+        json_filename = os.path.join(folder, 'metrics_tagged.json')
+        synthetic_metrics(json_filename, n_clusters)
+        plugin = MSCurationTagsPlugin()
+        plugin.get_metric_table(json_filename)
+
+    metrics = plugin.list_metric_names()
+    cluster_ids = list(range(n_clusters))
+    before = [pandas_lambda(plugin.df, metric) for metric in metrics]
+    after = [plugin.get_cluster_lambda(metric) for metric in metrics]
+
+    results = dict(
+        clusters=n_clusters, metrics=len(metrics),
+        before_ms=timed(lambda: [[f(c) for c in cluster_ids] for f in before],
+                        repeat),
+        after_ms=timed(lambda: [[f(c) for c in cluster_ids] for f in after],
+                       repeat),
+        batch_ms=timed(lambda: [plugin.get_cluster_metrics(metric, cluster_ids)
+                                for metric in metrics], repeat))
+    return results
+
+
+if __name__ == "__main__":
+
+    import argparse
+    parse = argparse.ArgumentParser(description='cluster table refresh '
+                                                'latency, before and after '
+                                                'the metric arrays')
+    parse.add_argument("--clusters", default=500, type=int)
+    parse.add_argument("--repeat", default=5, type=int)
+    Opt = parse.parse_args()
+
+    results = run(Opt.clusters, Opt.repeat)
+    print(f"{results['clusters']} clusters x {results['metrics']} metrics")
+    for name in ('before', 'after', 'batch'):
+        print(f"{name:>7} : {results[name + '_ms']:8.2f} ms per refresh")
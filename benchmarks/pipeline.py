@@ -0,0 +1,320 @@
+#!/usr/bin/env python
+# Synthetic benchmark of the mountainsort -> phy -> mountainsort pipeline
+#
+# Generates a tetrode folder (filt.mda, firings_raw.mda, params.json, geom.csv,
+# metrics_tagged.json) of configurable duration, channel count and spike rate,
+# runs every stage of the pipeline on it and writes the wall time, throughput,
+# peak RSS and bytes read of each stage to a json that can be compared across
+# runs. With --raw the stages read raw.mda (with a slow drift added) through
+# the lazy bandpass filter instead of filt.mda. Runs offline on CPU only.
+#
+# Usage: python benchmarks/pipeline.py --duration 60 --channels 4 --rate 10 \
+#                                      --out results.json [--compare old.json]
+#                                      [--raw]
+
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import mdaio
+from instrument import PeakRSS, io_counters
+
+# Samples before/after the peak of the injected spike templates
+TEMPLATE_BEFORE = 20
+TEMPLATE_AFTER  = 40
+
+# -------------------
+# Synthetic tetrodes
+# -------------------
+def templates(num_units:int, num_channels:int, rng):
+    '''
+    (num_units, num_channels, TEMPLATE_BEFORE + TEMPLATE_AFTER) spike shapes :
+    a negative peak followed by a slower rebound, scaled per channel
+    '''
+    t = np.arange(-TEMPLATE_BEFORE, TEMPLATE_AFTER, dtype='float32')
+    shape = -np.exp(-(t / 4.)**2) + 0.3 * np.exp(-((t - 12) / 8.)**2)
+    amplitude = rng.uniform(40, 200, size=(num_units, 1, 1))
+    gain = rng.uniform(0.1, 1., size=(num_units, num_channels, 1))
+    return (amplitude * gain * shape).astype('float32')
+
+def synthetic_tetrode(folder:str, duration=60., num_channels=4, rate=10.,
+                      num_units=8, samplerate=30000, noise=10., seed=0,
+                      chunk_size=2**18, raw=False):
+    '''
+    Write a tetrode folder of duration seconds with num_units units firing at
+    rate Hz each (Poisson) on top of gaussian noise. filt.mda is streamed in
+    chunks of chunk_size samples, so long recordings never sit in memory.
+    With raw, also write the same traces plus a 1 Hz drift as an int16
+    raw.mda, and a raw.mda.prv pointing to it.
+
+    Returns
+    -------
+    dict with num_samples, num_spikes and the size of filt.mda (and raw.mda)
+    in bytes
+    '''
+    os.makedirs(folder, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    num_samples = int(duration * samplerate)
+    shapes = templates(num_units, num_channels, rng)
+    width = TEMPLATE_BEFORE + TEMPLATE_AFTER
+
+    # Spike trains, kept clear of the edges of the recording
+    times, labels = [], []
+    for unit in range(num_units):
+        count = rng.poisson(rate * duration)
+        times.append(rng.integers(TEMPLATE_BEFORE, num_samples - TEMPLATE_AFTER,
+                                  size=count))
+        labels.append(np.full(count, unit + 1))
+    times, labels = np.concatenate(times), np.concatenate(labels)
+    order = np.argsort(times, kind='stable')
+    times, labels = times[order], labels[order]
+    primary = np.argmax(np.abs(shapes).max(axis=2), axis=1) + 1
+
+    filename = os.path.join(folder, 'filt.mda')
+    raw_filename = os.path.join(folder, 'raw.mda')
+    R = open(raw_filename, 'wb') if raw else None
+    if raw:
+        R.write(mdaio.header_bytes('int16', (num_channels, num_samples)))
+    with open(filename, 'wb') as F:
+        F.write(mdaio.header_bytes('float32', (num_channels, num_samples)))
+        carry = np.zeros((width, num_channels), dtype='float32')
+        for start in range(0, num_samples, chunk_size):
+            stop = min(start + chunk_size, num_samples)
+            # (samples x channels) in C order is the column-major mda layout;
+            # the last width rows catch templates running past the chunk
+            block = np.zeros((stop - start + width, num_channels), dtype='float32')
+            block[:stop - start] = rng.normal(scale=noise, size=(stop - start,
+                                                                 num_channels))
+            block[:width] += carry
+            first, last = np.searchsorted(times, [start + TEMPLATE_BEFORE,
+                                                  stop + TEMPLATE_BEFORE])
+            onsets = times[first:last] - TEMPLATE_BEFORE - start
+            for unit in np.unique(labels[first:last]):
+                mine = onsets[labels[first:last] == unit]
+                index = (mine[:, None] + np.arange(width)).ravel()
+                np.add.at(block, index, np.tile(shapes[unit - 1].T, (len(mine), 1)))
+            carry = block[stop - start:].copy()
+            block[:stop - start].tofile(F)
+            if raw:
+                drift = 50 * np.sin(2 * np.pi * np.arange(start, stop) / samplerate)
+                np.round(block[:stop - start] + drift[:, None]).astype('int16').tofile(R)
+    if raw:
+        R.close()
+        with open(os.path.join(folder, 'raw.mda.prv'), 'w') as F:
+            json.dump(dict(original_path=raw_filename), F)
+
+    firings = np.vstack([primary[labels - 1], times + 1, labels]).astype('float64')
+    with open(os.path.join(folder, 'firings_raw.mda'), 'wb') as F:
+        F.write(mdaio.header_bytes('float64', firings.shape))
+        firings.T.tofile(F)
+
+    with open(os.path.join(folder, 'params.json'), 'w') as F:
+        json.dump(dict(samplerate=samplerate), F)
+    with open(os.path.join(folder, 'geom.csv'), 'w') as F:
+        F.write(''.join(f'0,{20 * channel}\n' for channel in range(num_channels)))
+
+    clusters = []
+    for unit in range(1, num_units + 1):
+        count = int(np.sum(labels == unit))
+        peak_amp = float(np.abs(shapes[unit - 1]).max())
+        clusters.append(dict(label=unit, tags=['accepted'] if unit % 3 else ['mua'],
+                             metrics=dict(num_events=count,
+                                          firing_rate=count / duration,
+                                          t1_sec=0., t2_sec=duration,
+                                          dur_sec=duration,
+                                          peak_amp=peak_amp, peak_noise=noise,
+                                          peak_snr=peak_amp / noise,
+                                          isolation=float(rng.uniform(0.8, 1)),
+                                          noise_overlap=float(rng.uniform(0, 0.2)),
+                                          overlap_cluster=int(unit % num_units) + 1,
+                                          bursting_parent=0)))
+    with open(os.path.join(folder, 'metrics_tagged.json'), 'w') as F:
+        json.dump(dict(clusters=clusters), F)
+
+    sizes = dict(num_samples=num_samples, num_spikes=len(times),
+                 filt_bytes=os.path.getsize(filename))
+    if raw:
+        sizes['raw_bytes'] = os.path.getsize(raw_filename)
+    return sizes
+
+# -----------
+# Measurement
+# -----------
+def measure(results:dict, name:str, func, amount=None, unit=None):
+    '''
+    Run func(), store its wall time, throughput (amount per second), peak
+    RSS and bytes read (by this process, so n_jobs=1 for the full count)
+    under results[name], and return what func returned
+    '''
+    read = io_counters()['read']
+    with PeakRSS(interval=0.01) as rss:
+        start = time.perf_counter()
+        value = func()
+        wall = time.perf_counter() - start
+    results[name] = dict(wall_s=wall, peak_rss_mb=rss.peak / 2**20,
+                         read_mb=(io_counters()['read'] - read) / 2**20)
+    if amount is not None:
+        results[name].update(throughput=amount / max(wall, 1e-9),
+                             throughput_unit=f'{unit}/s')
+    print(f"{name:>22} : {wall:8.3f} s, peak RSS {rss.peak / 2**20:7.0f}M")
+    return value
+
+# ------
+# Stages
+# ------
+def run(folder:str, n_jobs=1, chunk_size=None, raw=False, **synthetic):
+    '''
+    Generate a synthetic tetrode in folder and run every pipeline stage on it,
+    from raw.mda filtered on the fly if raw (else filt.mda)
+
+    Returns
+    -------
+    {stage: {wall_s, peak_rss_mb, throughput, throughput_unit}}
+    '''
+    import spikeinterface.extractors.mdaextractors as mda_extract
+    import spikeinterface.toolkit as toolkit
+    import mountainsort_to_phy
+    import phy_to_mountainsort
+    import waveform_cache
+
+    config = mountainsort_to_phy.config
+    samplerate = synthetic.get('samplerate', 30000)
+    results = {}
+    size = measure(results, 'generate', lambda: synthetic_tetrode(folder, raw=raw,
+                                                                  **synthetic))
+    results['generate'].update(size)
+    filt_file = os.path.join(folder, 'raw.mda' if raw else 'filt.mda')
+    firings_file = os.path.join(folder, 'firings_raw.mda')
+    chunk_size = chunk_size or samplerate
+    job_kwargs = dict(n_jobs=n_jobs, chunk_size=chunk_size, progress_bar=False)
+
+    def open_mda():
+        mdaio.read_header(filt_file)
+        recording = mda_extract.read_mda_recording(folder, raw_fname=filt_file)
+        if raw:
+            return mountainsort_to_phy.lazy_filter(recording, firings_file, config)
+        recording.annotate(is_filtered=True)
+        return recording
+    recording = measure(results, 'mda_open', open_mda,
+                        os.path.getsize(filt_file) / 2**20, 'MB')
+
+    def load_sorting():
+        sorting = mda_extract.read_mda_sorting(firings_file,
+                                               sampling_frequency=samplerate)
+        for unit_id in sorting.unit_ids:
+            sorting.get_unit_spike_train(unit_id)
+        return sorting
+    sorting = measure(results, 'sorting_load', load_sorting,
+                      size['num_spikes'], 'spikes')
+
+    waveform = measure(results, 'waveform_extraction',
+                       lambda: waveform_cache.extract(recording, sorting,
+                                                      os.path.join(folder, 'waveform'),
+                                                      config['waveform'], **job_kwargs),
+                       size['num_samples'], 'samples')
+
+    def export():
+        toolkit.compute_principal_components(waveform, load_if_exists=False,
+                                             **config['pcs'])
+        mountainsort_to_phy.export_phy(waveform, os.path.join(folder, 'phy'),
+                                       raw_dat=filt_file if raw else None,
+                                       **config['phy'], **job_kwargs)
+    measure(results, 'phy_export', export, size['num_spikes'], 'spikes')
+
+    json_filename = os.path.join(folder, 'metrics_tagged.json')
+    try:
+        sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                        '..', 'plugins'))
+        from MSclusterPlugins import MSCurationTagsPlugin
+    except ImportError as E:
+        results['plugin_metric_load'] = dict(skipped=repr(E))
+    else:
+        measure(results, 'plugin_metric_load',
+                lambda: MSCurationTagsPlugin().get_metric_table(json_filename),
+                synthetic.get('num_units', 8), 'clusters')
+        measure(results, 'plugin_metric_load_cached',
+                lambda: MSCurationTagsPlugin().get_metric_table(json_filename),
+                synthetic.get('num_units', 8), 'clusters')
+
+    measure(results, 'phy_to_ms',
+            lambda: phy_to_mountainsort.phy_to_mountainsort(os.path.join(folder, 'phy')),
+            size['num_spikes'], 'spikes')
+    return results
+
+def environment():
+    import spikeinterface
+    return dict(python=platform.python_version(), numpy=np.__version__,
+                spikeinterface=spikeinterface.__version__,
+                machine=platform.machine(), cpus=os.cpu_count())
+
+def compare(results:dict, previous:dict):
+    '''
+    Print each stage's wall time and peak RSS against a previous results file
+    '''
+    print(f"{'stage':>26} {'wall':>9} {'before':>9} {'ratio':>6} "
+          f"{'rss':>7} {'before':>7} {'read':>7} {'before':>7}")
+    for name, stage in results['stages'].items():
+        old = previous.get('stages', {}).get(name, {})
+        if 'wall_s' not in stage or 'wall_s' not in old:
+            continue
+        print(f"{name:>26} {stage['wall_s']:8.3f}s {old['wall_s']:8.3f}s "
+              f"{stage['wall_s'] / max(old['wall_s'], 1e-9):6.2f} "
+              f"{stage['peak_rss_mb']:6.0f}M {old['peak_rss_mb']:6.0f}M "
+              f"{stage.get('read_mb', np.nan):6.0f}M {old.get('read_mb', np.nan):6.0f}M")
+
+
+if __name__ == "__main__":
+
+    import argparse
+    parse = argparse.ArgumentParser(description='benchmark the export pipeline '
+                                                'on a synthetic tetrode')
+    parse.add_argument("--duration", default=60., type=float,
+                       help="seconds of recording")
+    parse.add_argument("--channels", default=4, type=int)
+    parse.add_argument("--units", default=8, type=int)
+    parse.add_argument("--rate", default=10., type=float,
+                       help="firing rate of every unit, Hz")
+    parse.add_argument("--samplerate", default=30000, type=int)
+    parse.add_argument("--n-jobs", default=1, type=int,
+                       help="spikeinterface jobs for extraction and export")
+    parse.add_argument("--seed", default=0, type=int)
+    parse.add_argument("--raw", action="store_true",
+                       help="read raw.mda through the lazy bandpass filter "
+                            "instead of filt.mda")
+    parse.add_argument("--folder", default=None, type=str,
+                       help="where to build the tetrode (default: a temporary "
+                            "folder, removed afterwards)")
+    parse.add_argument("--out", default="benchmark_results.json", type=str)
+    parse.add_argument("--compare", default=None, type=str,
+                       help="previous results file to compare against")
+    Opt = parse.parse_args()
+
+    synthetic = dict(duration=Opt.duration, num_channels=Opt.channels,
+                     num_units=Opt.units, rate=Opt.rate,
+                     samplerate=Opt.samplerate, seed=Opt.seed)
+    folder = Opt.folder or tempfile.mkdtemp(prefix='nt1.mountain.')
+    try:
+        stages = run(os.path.join(folder, 'nt1.mountain') if Opt.folder else folder,
+                     n_jobs=Opt.n_jobs, raw=Opt.raw, **synthetic)
+    finally:
+        if Opt.folder is None:
+            shutil.rmtree(folder, ignore_errors=True)
+
+    results = dict(time=time.strftime('%Y-%m-%dT%H:%M:%S'),
+                   environment=environment(),
+                   params=dict(synthetic, n_jobs=Opt.n_jobs, raw=Opt.raw),
+                   stages=stages)
+    with open(Opt.out, 'w') as F:
+        json.dump(results, F, indent=2)
+    print(f"Results written to {Opt.out}")
+
+    if Opt.compare:
+        with open(Opt.compare, 'r') as F:
+            compare(results, json.load(F))
@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+# Check : lazy bandpass filtering against a filter of the whole recording
+#
+# Writes a firings file whose spike windows start, end or straddle the edges
+# of the filter blocks, reads every window through LazyFilterRecording (as
+# the waveform extraction does) and compares it with the same window of the
+# whole recording filtered at once. A window reaching into a block that was
+# not filtered comes back as zeros and fails the check. Runs offline on CPU
+# only.
+#
+# Usage: python checks/lazy_filter_edges.py [--block-size 8192]
+
+import os
+import shutil
+import sys
+import tempfile
+
+import numpy as np
+import scipy.signal
+from spikeinterface.core import NumpyRecording
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import mdaio
+from lazyfilter import LazyFilterRecording
+
+def check(folder:str, block_size=8192, samplerate=30000, ms_before=3.,
+          ms_after=4., tolerance=0.01):
+    before = int(ms_before * samplerate / 1000.)
+    after = int(ms_after * samplerate / 1000.)
+    rng = np.random.default_rng(0)
+    # One spike on every other block edge, so that no other spike gets the
+    # two blocks around it filtered : windows [frame - before, frame + after)
+    # ending just before or just past an edge, starting on or just before
+    # one, or centered on one
+    offsets = (-after, -after + 1, before, before - 1, 0)
+    num_blocks = 2 * len(offsets) + 2
+    edges = block_size * np.arange(2, num_blocks, 2)
+    frames = edges + np.resize(offsets, len(edges))
+    traces = rng.normal(scale=20., size=(num_blocks * block_size, 4))
+    traces += 200 * np.sin(2 * np.pi * np.arange(len(traces)) / samplerate)[:, None]
+    traces = traces.astype('float32')
+    firings = np.vstack([np.ones(len(frames)), frames,
+                         np.ones(len(frames))]).astype('float64')
+    firings_file = os.path.join(folder, 'firings_raw.mda')
+    with open(firings_file, 'wb') as F:
+        F.write(mdaio.header_bytes('float64', firings.shape))
+        firings.T.tofile(F)
+
+    recording = NumpyRecording([traces], samplerate)
+    lazy = LazyFilterRecording(recording, firings_file, ms_before=ms_before,
+                               ms_after=ms_after, block_size=block_size)
+    sos = scipy.signal.iirfilter(5, [2 * 300. / samplerate, 2 * 6000. / samplerate],
+                                 btype='bandpass', ftype='butter', output='sos')
+    full = scipy.signal.sosfiltfilt(sos, traces, axis=0)
+
+    worst = 0.
+    for frame in frames:
+        window = lazy.get_traces(start_frame=frame - before, end_frame=frame + after)
+        expected = full[frame - before:frame + after]
+        error = np.abs(window - expected).max() / np.abs(expected).max()
+        assert error < tolerance, (f"spike at {frame}: relative error {error:.3f}, "
+                                   f"{int(np.sum(np.all(window == 0, axis=1)))} "
+                                   f"zero samples")
+        worst = max(worst, error)
+    print(f"ok : {len(frames)} spikes at block edges, worst relative error "
+          f"{worst:.4f}")
+
+
+if __name__ == "__main__":
+
+    import argparse
+    parse = argparse.ArgumentParser(prog="lazy filter edge check")
+    parse.add_argument("--block-size", default=8192, type=int)
+    Opt = parse.parse_args()
+
+    folder = tempfile.mkdtemp(prefix='lazy_filter_edges.')
+    try:
+        check(folder, block_size=Opt.block_size)
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+# Check : lease claiming races and the staging write-back
+#
+# Lease : several processes at once claim a folder holding a stale lease of
+# another node, over a number of rounds. Exactly one must get it each round,
+# and still hold it once every other process has tried (a loser that broke
+# the fresh lease instead of the stale one would take it away).
+#
+# Staging : stages a tetrode folder between two local folders and checks the
+# write-back. A phy folder filled in place keeps a curation file written in
+# the session meanwhile, a rebuilt phy folder replaces the session's whole,
+# and a write-back that fails (lost lease) is reported, keeps its staged copy
+# and does not hold up the staging of the next tetrode. Runs offline on CPU
+# only.
+#
+# Usage: python checks/lease_staging.py [--processes 8] [--rounds 20]
+
+import json
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import lease
+import staging
+
+# --------------
+# Lease breaking
+# --------------
+def stale_lease(folder:str):
+    '''
+    Lease of a node that stopped touching it long ago
+    '''
+    path = os.path.join(folder, lease.LEASE)
+    with open(path, 'w') as F:
+        json.dump(dict(token='elsewhere:1:stale', host='elsewhere', pid=1,
+                       acquired=0.), F)
+    os.utime(path, (time.time() - 3600,) * 2)
+
+def claimer(folder:str, start, tried, results):
+    start.wait()
+    claimed = lease.Lease(folder, timeout=60., heartbeat=30.)
+    got = claimed.acquire()
+    tried.wait()
+    results.put((got, got and claimed.claim.held()))
+    # Losers are done before the winner lets go
+    tried.wait()
+    if got:
+        claimed.release()
+
+def check_lease(folder:str, processes=8, rounds=20):
+    context = multiprocessing.get_context('spawn')
+    for round in range(rounds):
+        stale_lease(folder)
+        start, tried = context.Barrier(processes), context.Barrier(processes)
+        results = context.Queue()
+        workers = [context.Process(target=claimer,
+                                   args=(folder, start, tried, results))
+                   for _ in range(processes)]
+        for worker in workers:
+            worker.start()
+        outcome = [results.get(timeout=60) for _ in workers]
+        for worker in workers:
+            worker.join()
+        winners = [held for got, held in outcome if got]
+        assert len(winners) == 1, f"round {round}: {len(winners)} claims"
+        assert winners[0], f"round {round}: the winner lost its lease"
+        assert not os.path.exists(os.path.join(folder, lease.LEASE)), \
+            f"round {round}: lease left after release"
+        assert not [name for name in os.listdir(folder) if '.broken-' in name], \
+            f"round {round}: broken lease left"
+    print(f"ok : {rounds} rounds of {processes} processes breaking a stale "
+          f"lease, one claim each")
+
+# ----------
+# Write-back
+# ----------
+def write(path:str, text:str):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as F:
+        F.write(text)
+
+def read(path:str):
+    with open(path, 'r') as F:
+        return F.read()
+
+def tetrode(session:str, name:str):
+    folder = os.path.join(session, name)
+    write(os.path.join(folder, 'filt.mda'), 'x' * 1000)
+    write(os.path.join(folder, 'firings_raw.mda'), 'firings')
+    write(os.path.join(folder, 'phy', 'spike_clusters.npy'), 'clusters')
+    write(os.path.join(folder, 'phy', 'params.py'),
+          f"dat_path = r'{os.path.join(folder, 'filt.mda')}'\n")
+    return folder
+
+def check_staging(folder:str):
+    session = os.path.join(folder, 'session.mountain')
+    scratch = os.path.join(folder, 'scratch')
+
+    # Filled in place : the session's curation survives the write-back
+    nt1 = tetrode(session, 'nt1.mountain')
+    stager = staging.Stager(scratch)
+    local = stager.acquire(nt1)
+    assert local != nt1, "nt1 not staged"
+    assert read(os.path.join(local, 'phy', 'params.py')).find(local) > 0, \
+        "params.py not translated to the scratch copy"
+    write(os.path.join(local, 'phy', 'pc_features.npy'), 'features')
+    write(os.path.join(nt1, 'phy', 'cluster_group.tsv'), 'curated')
+    stager.release(nt1).result()
+    assert read(os.path.join(nt1, 'phy', 'pc_features.npy')) == 'features'
+    assert read(os.path.join(nt1, 'phy', 'cluster_group.tsv')) == 'curated', \
+        "curation lost by a fill write-back"
+    assert nt1 in read(os.path.join(nt1, 'phy', 'params.py')), \
+        "params.py not translated back"
+
+    # Rebuilt (next to the old one and swapped in, as export_phy does) :
+    # the new phy folder replaces the session's
+    local = stager.acquire(nt1)
+    rebuilt = lease.scratch_folder(os.path.join(local, 'phy'), 'tmp')
+    write(os.path.join(rebuilt, 'spike_clusters.npy'), 'rebuilt')
+    lease.replace_folder(rebuilt, os.path.join(local, 'phy'))
+    stager.release(nt1).result()
+    assert sorted(os.listdir(os.path.join(nt1, 'phy'))) == ['spike_clusters.npy'], \
+        "rebuilt phy folder not swapped in whole"
+    assert read(os.path.join(nt1, 'phy', 'spike_clusters.npy')) == 'rebuilt'
+    assert not [name for name in os.listdir(nt1) if '.old-' in name
+                or name.endswith('.writeback')], "swap leftovers"
+    assert not stager.close()
+
+    # Failed : reported, staged copy kept, and no wait on it for room
+    nt2 = tetrode(session, 'nt2.mountain')
+    nt3 = tetrode(session, 'nt3.mountain')
+    stager = staging.Stager(scratch, max_bytes=1500)
+    local = stager.acquire(nt2)
+    write(os.path.join(local, 'phy', 'pc_features.npy'), 'features')
+    lost = lease.Claim(os.path.join(nt2, lease.LEASE), 'elsewhere:1:lost')
+    future = stager.release(nt2, claim=lost)
+    assert isinstance(future.exception(), lease.LeaseLost), future.exception()
+    assert not os.path.exists(os.path.join(nt2, 'phy', 'pc_features.npy')), \
+        "written back without the lease"
+    prefetched = []
+    thread = threading.Thread(target=lambda: prefetched.append(stager.prefetch(nt3)),
+                              daemon=True)
+    thread.start()
+    thread.join(timeout=10)
+    assert not thread.is_alive(), "prefetch spins on a failed write-back"
+    assert prefetched == [None], "failed copy evicted to make room"
+    errors = stager.close()
+    assert [remote for remote, _ in errors] == [nt2], errors
+    assert os.path.exists(os.path.join(local, 'phy', 'pc_features.npy')), \
+        "failed copy removed"
+    print("ok : fill write-back keeps the curation, rebuilt folder swapped, "
+          "failed write-back kept and skipped")
+
+
+if __name__ == "__main__":
+
+    import argparse
+    parse = argparse.ArgumentParser(prog="lease and staging check")
+    parse.add_argument("--processes", default=8, type=int)
+    parse.add_argument("--rounds", default=20, type=int)
+    Opt = parse.parse_args()
+
+    folder = tempfile.mkdtemp(prefix='lease_staging.')
+    try:
+        os.makedirs(os.path.join(folder, 'claimed'))
+        check_lease(os.path.join(folder, 'claimed'), Opt.processes, Opt.rounds)
+        check_staging(folder)
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
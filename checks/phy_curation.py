@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+# Check : phy -> mountainsort conversion of a merged and split phy folder
+#
+# Exports a synthetic tetrode to phy, then curates it the way phy saves a
+# curation : clusters 2 and 3 merged into a new cluster, cluster 0 split in
+# two new ones, and spike_clusters.npy, cluster_group.tsv and
+# cluster_si_unit_ids.tsv rewritten with the current clusters only (split
+# children keep their parent's si_unit_id). Converts it back and checks the
+# labels of firings.mda against the curation, and that only the untouched
+# clusters carry their mountainsort metrics. Runs offline on CPU only.
+#
+# Usage: python checks/phy_curation.py [--folder F]
+
+import json
+import os
+import shutil
+import sys
+import tempfile
+
+import numpy as np
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'benchmarks'))
+import mdaio
+import mountainsort_to_phy
+import phy_to_mountainsort
+from pipeline import synthetic_tetrode
+
+def write_tsv(filename:str, column:str, values:dict):
+    with open(filename, 'w') as F:
+        F.write(f'cluster_id\t{column}\n')
+        F.writelines(f'{cluster_id}\t{value}\n'
+                     for cluster_id, value in sorted(values.items()))
+
+def curate(phy_folder:str):
+    '''
+    Merge clusters 2 and 3, split cluster 0 by spike parity and save as phy
+    does. Returns the curated spike_clusters.
+    '''
+    spike_clusters = np.load(os.path.join(phy_folder, 'spike_clusters.npy')).ravel()
+    si_unit_ids = phy_to_mountainsort.read_tsv(
+        os.path.join(phy_folder, 'cluster_si_unit_ids.tsv'), 'si_unit_id', int)
+    new_id = int(spike_clusters.max()) + 1
+
+    merged, first, second = new_id, new_id + 1, new_id + 2
+    spike_clusters[np.isin(spike_clusters, [2, 3])] = merged
+    parent = np.flatnonzero(spike_clusters == 0)
+    spike_clusters[parent[::2]] = first
+    spike_clusters[parent[1::2]] = second
+    np.save(os.path.join(phy_folder, 'spike_clusters.npy'), spike_clusters)
+
+    current = np.unique(spike_clusters)
+    labels = {int(c): si_unit_ids.get(int(c)) for c in current}
+    labels[first] = labels[second] = si_unit_ids[0]
+    labels[merged] = si_unit_ids[2]
+    write_tsv(os.path.join(phy_folder, 'cluster_si_unit_ids.tsv'), 'si_unit_id',
+              labels)
+    write_tsv(os.path.join(phy_folder, 'cluster_group.tsv'), 'group',
+              {int(c): 'noise' if c == 1 else 'good' for c in current})
+    return spike_clusters
+
+def check(folder:str):
+    session = os.path.join(folder, 'session.mountain')
+    tetrode = os.path.join(session, 'nt1.mountain')
+    synthetic_tetrode(tetrode, duration=20., num_units=6)
+    config = dict(mountainsort_to_phy.config, claim=False, report_dir=folder)
+    error = mountainsort_to_phy.export_session(session, config,
+                                               mountainsort_to_phy.new_error_dict(),
+                                               n_workers=1)
+    assert not any(error.values()), error
+
+    phy_folder = os.path.join(tetrode, 'phy')
+    num_templates = len(np.load(os.path.join(phy_folder, 'templates.npy'),
+                                mmap_mode='r'))
+    spike_clusters = curate(phy_folder)
+    labels = phy_to_mountainsort.phy_to_mountainsort(phy_folder)
+
+    # Every kept spike carries the label of its curated cluster; phy spikes
+    # and firings columns pair up on (time, original label)
+    firings = phy_to_mountainsort.read_firings(os.path.join(tetrode, 'firings_raw.mda'))
+    spike_times = np.load(os.path.join(phy_folder, 'spike_times.npy')).ravel()
+    templates = np.load(os.path.join(phy_folder, 'spike_templates.npy')).ravel()
+    units = phy_to_mountainsort.unit_ids(firings)
+    phy_key = {(int(t), int(units[k])): int(c) for t, k, c
+               in zip(spike_times, templates, spike_clusters)}
+    expected = np.array([labels.get(phy_key[(int(t), int(l))], 0)
+                         for t, l in zip(firings[1], firings[2])])
+    curated = phy_to_mountainsort.read_firings(os.path.join(tetrode, 'firings.mda'))
+    assert np.array_equal(curated[2], expected[expected > 0]), "firings.mda labels"
+    assert 1 not in labels, "noise cluster kept"
+
+    # Only the clusters phy left untouched keep their mountainsort metrics
+    with open(os.path.join(tetrode, 'metrics_curated.json'), 'r') as F:
+        clusters = json.load(F)['clusters']
+    for cluster in clusters:
+        cluster_id = cluster['metrics']['phy_cluster_id']
+        untouched = cluster_id < num_templates
+        assert ('num_events' in cluster['metrics']) == untouched, cluster
+        if untouched:
+            assert cluster['metrics']['num_events'] == int(
+                np.sum(spike_clusters == cluster_id)), cluster
+    print(f"ok : {len(labels)} curated clusters, "
+          f"{int(np.sum(expected > 0))} spikes kept")
+
+
+if __name__ == "__main__":
+
+    import argparse
+    parse = argparse.ArgumentParser(prog="phy curation check")
+    parse.add_argument("--folder", default=None, type=str,
+                       help="where to build the session (default: a temporary "
+                            "folder, removed afterwards)")
+    Opt = parse.parse_args()
+
+    folder = Opt.folder or tempfile.mkdtemp(prefix='phy_curation.')
+    try:
+        check(folder)
+    finally:
+        if Opt.folder is None:
+            shutil.rmtree(folder, ignore_errors=True)
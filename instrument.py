@@ -0,0 +1,216 @@
+# Per-stage instrumentation of the export
+#
+# Every stage of a tetrode export runs inside StageRecorder.stage(), which
+# measures its wall time, peak resident memory and bytes read/written, and
+# keeps the full traceback if it fails. Records are appended, one json per
+# line, to the session's report file as soon as each stage ends, so a crashed
+# or killed overnight run still leaves its report behind.
+
+import json
+import os
+import socket
+import threading
+import time
+import traceback
+import uuid
+from contextlib import contextmanager
+
+# Session report : <report dir>/export_report_<session>.jsonl
+REPORT_PREFIX = 'export_report_'
+
+class PeakRSS:
+    '''
+    Samples the resident memory of this process and its children every
+    interval seconds while in use, and keeps the peak (bytes)
+    '''
+
+    def __init__(self, interval=0.05):
+        self.interval = interval
+        self.peak = 0
+        self._done = threading.Event()
+
+    def sample(self):
+        try:
+            import psutil
+            process = psutil.Process()
+            rss = process.memory_info().rss
+            for child in process.children(recursive=True):
+                try:
+                    rss += child.memory_info().rss
+                except psutil.Error:
+                    pass
+        except ImportError:
+            with open('/proc/self/statm', 'r') as F:
+                rss = int(F.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+        self.peak = max(self.peak, rss)
+
+    def run(self):
+        while not self._done.wait(self.interval):
+            self.sample()
+
+    def __enter__(self):
+        self.sample()
+        self._thread = threading.Thread(target=self.run, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self._done.set()
+        self._thread.join()
+        self.sample()
+
+def io_counters():
+    '''
+    Bytes read and written so far : by read/write calls of this process
+    (read, written), and from disk by this process and its finished children
+    (disk_read, disk_written, which also sees memory-mapped reads)
+    '''
+    import resource
+    counters = dict(read=0, written=0, disk_read=0, disk_written=0)
+    try:
+        with open('/proc/self/io', 'r') as F:
+            io = dict(line.split(':') for line in F.read().splitlines())
+        counters.update(read=int(io['rchar']), written=int(io['wchar']),
+                        disk_read=int(io['read_bytes']),
+                        disk_written=int(io['write_bytes']))
+    except (OSError, KeyError, ValueError):
+        pass
+    # Children only report blocks of 512 bytes
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    counters['disk_read']    += children.ru_inblock * 512
+    counters['disk_written'] += children.ru_oublock * 512
+    return counters
+
+def error_context(E:BaseException):
+    return dict(type=type(E).__name__, message=str(E),
+                traceback=''.join(traceback.format_exception(type(E), E,
+                                                             E.__traceback__)))
+
+def report_file(folder:str, session:str):
+    return os.path.join(folder, f'{REPORT_PREFIX}{session}.jsonl')
+
+def new_session():
+    '''
+    Session id : start time, then host, pid and a random suffix to keep
+    concurrent runs and runs started in the same second apart
+    '''
+    return (time.strftime('%Y%m%d-%H%M%S') +
+            f'_{socket.gethostname()}_{os.getpid()}_{uuid.uuid4().hex[:8]}')
+
+class StageRecorder:
+    '''
+    Records the stages of one tetrode export
+
+    Parameters
+    ----------
+    report_file : str or None
+        jsonl the records are appended to (None : only kept in .records)
+    tetrode : str
+        the ntXX.mountain folder
+    session : str
+        id shared by every record of the session
+    '''
+
+    def __init__(self, report_file=None, tetrode=None, session=None):
+        self.report_file = report_file
+        self.tetrode = tetrode
+        self.session = session
+        self.records = []
+
+    @contextmanager
+    def stage(self, name:str, **info):
+        '''
+        Measure the body of the with block as stage name. Yields the record,
+        so the body can add its own fields (unit counts, ...). Exceptions are
+        recorded with their traceback and re-raised.
+        '''
+        record = dict(session=self.session, tetrode=self.tetrode, stage=name,
+                      start=time.strftime('%Y-%m-%dT%H:%M:%S'), **info)
+        io_start = io_counters()
+        start = time.perf_counter()
+        try:
+            with PeakRSS() as rss:
+                yield record
+            record['status'] = 'ok'
+        except BaseException as E:
+            record.update(status='error', error=error_context(E))
+            raise
+        finally:
+            io_stop = io_counters()
+            record.update(wall_s=time.perf_counter() - start,
+                          peak_rss_mb=rss.peak / 2**20,
+                          **{f'bytes_{key}': io_stop[key] - io_start[key]
+                             for key in io_start})
+            self.write(record)
+
+    def write(self, record:dict):
+        self.records.append(record)
+        if self.report_file is None:
+            return
+        # One write per line in append mode : workers of the pool share the file
+        line = json.dumps(record, default=str) + '\n'
+        with open(self.report_file, 'a') as F:
+            F.write(line)
+
+def read_report(filename:str):
+    records = []
+    with open(filename, 'r') as F:
+        for line in F:
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                # A line cut short by a killed run
+                pass
+    return records
+
+def summary(records:list):
+    '''
+    Text table of a session report : one row per tetrode (wall time, the
+    stage that took longest, peak memory, bytes read/written by the
+    process, then those from or to disk, which are 0 on a warm page cache,
+    status), then the time spent in each stage over all tetrodes
+    '''
+    tetrodes = {}
+    for record in records:
+        if record.get('stage') in (None, 'session'):
+            continue
+        tetrodes.setdefault(record['tetrode'], []).append(record)
+
+    lines = [f"{'tetrode':<24} {'wall':>9} {'slowest stage':>24} {'peak rss':>9} "
+             f"{'read':>9} {'written':>9} {'disk rd':>9} {'disk wr':>9}  status"]
+    stage_wall = {}
+    for tetrode, stages in sorted(tetrodes.items(),
+                                  key=lambda x: -sum(r['wall_s'] for r in x[1]
+                                                     if r['stage'] == 'tetrode')):
+        parts = [r for r in stages if r['stage'] != 'tetrode']
+        total = [r for r in stages if r['stage'] == 'tetrode']
+        for r in parts:
+            stage_wall[r['stage']] = stage_wall.get(r['stage'], 0) + r['wall_s']
+        wall = sum(r['wall_s'] for r in total) or sum(r['wall_s'] for r in parts)
+        slowest = max(parts, key=lambda r: r['wall_s'], default=None)
+        failed = [r for r in stages if r.get('status') == 'error'
+                  or any(r.get('errors', {}).values())]
+        lines.append(f"{os.path.basename(str(tetrode)):<24} {wall:8.1f}s "
+                     f"{(slowest['stage'] + ' %.1fs' % slowest['wall_s']) if slowest else '':>24} "
+                     f"{max(r['peak_rss_mb'] for r in stages):8.0f}M "
+                     f"{sum(r['bytes_read'] for r in parts) / 2**20:8.0f}M "
+                     f"{sum(r['bytes_written'] for r in parts) / 2**20:8.0f}M "
+                     f"{sum(r['bytes_disk_read'] for r in parts) / 2**20:8.0f}M "
+                     f"{sum(r['bytes_disk_written'] for r in parts) / 2**20:8.0f}M  "
+                     f"{'error' if failed else 'ok'}")
+
+    total = sum(stage_wall.values()) or 1
+    lines.append('')
+    lines.append(f"{'stage':<24} {'wall':>9} {'share':>6}")
+    for stage, wall in sorted(stage_wall.items(), key=lambda x: -x[1]):
+        lines.append(f"{stage:<24} {wall:8.1f}s {100 * wall / total:5.1f}%")
+    return '\n'.join(lines)
+
+
+if __name__ == "__main__":
+
+    import argparse
+    parse = argparse.ArgumentParser(description='summarize an export report')
+    parse.add_argument("report", type=str, help="export_report_*.jsonl file")
+    Opt = parse.parse_args()
+    print(summary(read_report(Opt.report)))
@@ -0,0 +1,164 @@
+# Lazy bandpass filtering of raw recordings
+#
+# Exporting from raw.mda used to need a full size filt.mda next to it. A
+# LazyFilterRecording filters the raw recording on demand instead, in fixed
+# blocks of block_size samples, each filtered with margin_ms of raw data on
+# both sides so that block edges agree with a filter of the whole recording.
+# Given the firings file, only the blocks holding a spike window are read and
+# filtered; the rest of the recording reads as zeros. Filtered blocks are kept
+# in a least recently used cache bounded in bytes, since consecutive chunks of
+# waveform extraction, PC projection and amplitudes share their edge blocks.
+
+from collections import OrderedDict
+
+import numpy as np
+import scipy.signal
+from spikeinterface.toolkit.preprocessing.basepreprocessor import (
+    BasePreprocessor, BasePreprocessorSegment)
+from spikeinterface.toolkit.preprocessing.tools import get_chunk_with_margin
+
+import mdaio
+
+def spike_frames(firings_file:str):
+    '''
+    Spike times of a mountainsort firings file as frames of the recording,
+    taken as they are like MdaSortingExtractor does (so the windows below
+    are those the waveform extraction reads)
+    '''
+    header = mdaio.read_header(firings_file)
+    firings = np.memmap(firings_file, dtype=header.dtype, mode='r',
+                        offset=header.header_size, shape=header.dims, order='F')
+    return np.rint(firings[1]).astype('int64')
+
+def needed_blocks(frames, num_samples:int, before:int, after:int,
+                  block_size:int):
+    '''
+    Mask of the blocks that hold part of the window [frame - before,
+    frame + after) of some spike
+    '''
+    num_blocks = -(-num_samples // block_size)
+    first = np.clip((frames - before) // block_size, 0, num_blocks - 1)
+    last  = np.clip((frames + after - 1) // block_size, 0, num_blocks - 1)
+    # +1 on the first block of each window, -1 past its last
+    counts = np.zeros(num_blocks + 1, dtype='int64')
+    np.add.at(counts, first, 1)
+    np.add.at(counts, last + 1, -1)
+    return np.cumsum(counts[:-1]) > 0
+
+class LazyFilterRecording(BasePreprocessor):
+    '''
+    Bandpass filter of a recording, computed block by block when read
+
+    Parameters
+    ----------
+    recording : BaseRecording
+        the raw recording
+    firings_file : str or None
+        mountainsort firings; only the blocks around its spikes are filtered
+        (None : every block is)
+    ms_before, ms_after : float
+        spike window the blocks must cover, as in the waveform extraction
+    freq_min, freq_max : float
+        band of the butterworth filter (Hz)
+    filter_order : int
+    margin_ms : float
+        raw data filtered on each side of a block and dropped
+    block_size : int
+        samples per block
+    cache_bytes : int
+        size cap of the filtered blocks kept in memory (per process)
+    '''
+    name = 'lazyfilter'
+
+    def __init__(self, recording, firings_file=None, ms_before=3., ms_after=4.,
+                 freq_min=300., freq_max=6000., filter_order=5, margin_ms=10.,
+                 block_size=8192, cache_bytes=200 * 2**20):
+        samplerate = recording.get_sampling_frequency()
+        sos = scipy.signal.iirfilter(filter_order,
+                                     [2 * freq_min / samplerate,
+                                      2 * freq_max / samplerate],
+                                     btype='bandpass', ftype='butter',
+                                     output='sos')
+        BasePreprocessor.__init__(self, recording, dtype='float32')
+        self.annotate(is_filtered=True)
+        if "offset_to_uV" in self.get_property_keys():
+            self.set_channel_offsets(0)
+
+        frames = spike_frames(firings_file) if firings_file else None
+        margin = int(margin_ms * samplerate / 1000.)
+        for parent_segment in recording._recording_segments:
+            needed = None
+            if frames is not None:
+                needed = needed_blocks(frames, parent_segment.get_num_samples(),
+                                       int(ms_before * samplerate / 1000.),
+                                       int(ms_after * samplerate / 1000.),
+                                       block_size)
+            self.add_recording_segment(
+                LazyFilterRecordingSegment(parent_segment, sos, margin,
+                                           block_size, needed, cache_bytes,
+                                           recording.get_num_channels()))
+
+        self._kwargs = dict(recording=recording.to_dict(),
+                            firings_file=firings_file, ms_before=ms_before,
+                            ms_after=ms_after, freq_min=freq_min,
+                            freq_max=freq_max, filter_order=filter_order,
+                            margin_ms=margin_ms, block_size=block_size,
+                            cache_bytes=cache_bytes)
+
+class LazyFilterRecordingSegment(BasePreprocessorSegment):
+
+    def __init__(self, parent_recording_segment, sos, margin:int,
+                 block_size:int, needed, cache_bytes:int, num_channels:int):
+        BasePreprocessorSegment.__init__(self, parent_recording_segment)
+        self.num_channels = num_channels
+        self.sos = sos
+        self.margin = margin
+        self.block_size = block_size
+        self.needed = needed
+        self.cache_bytes = cache_bytes
+        self.cache = OrderedDict()
+        self.cached = 0
+        # Raw samples read, for the benchmarks
+        self.samples_read = 0
+
+    def block(self, index:int):
+        '''
+        Filtered block index (all channels), from the cache if there
+        '''
+        if index in self.cache:
+            self.cache.move_to_end(index)
+            return self.cache[index]
+        start = index * self.block_size
+        end = min(start + self.block_size, self.get_num_samples())
+        traces, left, _ = get_chunk_with_margin(self.parent_recording_segment,
+                                                start, end, None, self.margin)
+        self.samples_read += traces.shape[0]
+        filtered = scipy.signal.sosfiltfilt(self.sos, traces.astype('float32'),
+                                            axis=0)
+        filtered = filtered[left:left + end - start].astype('float32')
+
+        self.cache[index] = filtered
+        self.cached += filtered.nbytes
+        while self.cached > self.cache_bytes and len(self.cache) > 1:
+            _, evicted = self.cache.popitem(last=False)
+            self.cached -= evicted.nbytes
+        return filtered
+
+    def get_traces(self, start_frame, end_frame, channel_indices):
+        start = 0 if start_frame is None else start_frame
+        end = self.get_num_samples() if end_frame is None else end_frame
+        if channel_indices is None:
+            channel_indices = slice(None)
+        num_channels = np.arange(self.num_channels)[channel_indices].size
+
+        traces = np.zeros((max(end - start, 0), num_channels), dtype='float32')
+        for index in range(start // self.block_size,
+                           -(-end // self.block_size)):
+            if self.needed is not None and not self.needed[index]:
+                continue
+            block = self.block(index)
+            offset = index * self.block_size
+            lo, hi = max(start, offset), min(end, offset + block.shape[0])
+            traces[lo - start:hi - start] = block[lo - offset:hi - offset,
+                                                  channel_indices]
+        return traces
@@ -0,0 +1,243 @@
+# Work claiming over a shared filesystem
+#
+# Several nodes may export the same session. Before working on a tetrode a
+# node claims it with a lease file created atomically (O_CREAT | O_EXCL) in
+# the tetrode folder, and touches it every heartbeat seconds while it works.
+# A lease whose heartbeat is older than timeout (or whose process is gone,
+# for leases of this host) is stale and can be broken by the next node.
+# Outputs are built next to their final place and renamed in, so readers
+# never see a half-written folder. Those scratch folders carry the lease
+# token (or host, pid and a uuid), so nodes never share or sweep each
+# other's live ones.
+
+import glob
+import json
+import os
+import shutil
+import socket
+import threading
+import time
+import uuid
+from collections import namedtuple
+
+LEASE = '.export_lease'
+
+class LeaseLost(RuntimeError):
+    """The lease was broken by another node (missed heartbeats)."""
+
+def read_lease(path:str):
+    '''
+    Contents of a lease file, or None if missing or not fully written yet
+    '''
+    try:
+        with open(path, 'r') as F:
+            return json.load(F)
+    except (OSError, ValueError):
+        return None
+
+class Claim(namedtuple('Claim', ['path', 'token'])):
+    '''
+    Picklable handle on a held lease, for the worker processes to check
+    before they put outputs in place
+    '''
+
+    def held(self):
+        info = read_lease(self.path)
+        return info is not None and info.get('token') == self.token
+
+    def check(self):
+        if not self.held():
+            raise LeaseLost(f"lost the lease on {os.path.dirname(self.path)}")
+
+def _alive(pid:int):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+class Lease:
+    '''
+    Exclusive, time limited claim on a folder
+
+    Parameters
+    ----------
+    folder : str
+        the folder to claim (the lease file lives inside it)
+    timeout : float
+        seconds without heartbeat after which the lease is stale
+    heartbeat : float
+        seconds between two touches of the lease file
+    '''
+
+    def __init__(self, folder:str, timeout=600., heartbeat=30.):
+        self.path = os.path.join(folder, LEASE)
+        self.timeout = timeout
+        # A few heartbeats per timeout, so one late touch does not lose it
+        self.heartbeat = min(heartbeat, timeout / 4)
+        self.host = socket.gethostname()
+        self.token = f"{self.host}:{os.getpid()}:{uuid.uuid4().hex}"
+        self.claim = Claim(self.path, self.token)
+        self.lost = False
+        self._stop = threading.Event()
+        self._thread = None
+
+    def stale(self, info, mtime:float):
+        if time.time() - mtime > self.timeout:
+            return True
+        # Same host : no need to wait for the timeout of a dead process
+        return (info is not None and info.get('host') == self.host
+                and not _alive(info.get('pid', -1)))
+
+    def _break_stale(self):
+        '''
+        Remove the current lease if stale. Returns whether a claim is worth
+        retrying.
+        '''
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return True
+        info = read_lease(self.path)
+        if not self.stale(info, stat.st_mtime):
+            return False
+        # Rename first : of several nodes breaking the same lease only one
+        # gets it. Then make sure it is the stale lease we looked at (same
+        # file, same contents; leases are never rewritten), not a fresh one
+        # claimed in between, and put that back if it is. This also holds
+        # for a stale lease cut short mid-write (info None) : a lease that
+        # now reads a token is a fresh one.
+        broken = f"{self.path}.broken-{uuid.uuid4().hex}"
+        try:
+            os.rename(self.path, broken)
+        except FileNotFoundError:
+            return True
+        taken = read_lease(broken)
+        if os.stat(broken).st_ino != stat.st_ino or taken != info:
+            try:
+                os.link(broken, self.path)
+            except FileExistsError:
+                pass
+            os.remove(broken)
+            return False
+        os.remove(broken)
+        print(f"Broke stale lease {self.path} of {(info or {}).get('token')}")
+        return True
+
+    def acquire(self):
+        '''
+        Claim the folder. Returns False if another live node holds it.
+        '''
+        for _ in range(3):
+            try:
+                fd = os.open(self.path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+            except FileExistsError:
+                if not self._break_stale():
+                    return False
+                continue
+            with os.fdopen(fd, 'w') as F:
+                json.dump(dict(token=self.token, host=self.host,
+                               pid=os.getpid(), acquired=time.time()), F)
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._beat, name='lease',
+                                            daemon=True)
+            self._thread.start()
+            return True
+        return False
+
+    def _beat(self):
+        while not self._stop.wait(self.heartbeat):
+            if not self.claim.held():
+                self.lost = True
+                print(f"Lost lease {self.path}")
+                return
+            try:
+                os.utime(self.path)
+            except OSError:
+                pass
+
+    def release(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self.claim.held():
+            try:
+                os.remove(self.path)
+            except FileNotFoundError:
+                pass
+
+    def __enter__(self):
+        if not self.acquire():
+            raise LeaseLost(f"{os.path.dirname(self.path)} is claimed")
+        return self
+
+    def __exit__(self, *args):
+        self.release()
+
+def scratch_folder(target:str, kind:str, token=None):
+    '''
+    Name of a scratch folder next to target (kind 'tmp' or 'old'), unique
+    across nodes : it carries the lease token, or this host, pid and a fresh
+    uuid (the same fields)
+    '''
+    if token is None:
+        token = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex}"
+    return f"{target}.{kind}-{token.replace(':', '-')}"
+
+def _touched(folder:str):
+    '''
+    Last modification of folder or of the files directly in it
+    '''
+    try:
+        latest = os.stat(folder).st_mtime
+        with os.scandir(folder) as entries:
+            for entry in entries:
+                try:
+                    latest = max(latest, entry.stat(follow_symlinks=False).st_mtime)
+                except FileNotFoundError:
+                    pass
+    except FileNotFoundError:
+        return time.time()
+    return latest
+
+def sweep_scratch(target:str, timeout:float, token=None):
+    '''
+    Remove the scratch folders of target left by killed runs : those of
+    token (this lease), of dead processes of this host, and any untouched
+    for timeout seconds. The live ones of other nodes (say one still
+    writing after its lease was broken) are left to them.
+    '''
+    host = socket.gethostname()
+    own = token.replace(':', '-') if token is not None else None
+    for kind in ('tmp', 'old'):
+        prefix = f"{target}.{kind}-"
+        for folder in glob.glob(glob.escape(prefix) + '*'):
+            owner = folder[len(prefix):]
+            try:
+                owner_host, pid, _ = owner.rsplit('-', 2)
+                pid = int(pid)
+            except ValueError:
+                owner_host, pid = None, -1
+            dead = owner_host == host and not _alive(pid)
+            if (owner == own or dead
+                    or time.time() - _touched(folder) > timeout):
+                shutil.rmtree(folder, ignore_errors=True)
+
+def replace_folder(source:str, target:str, token=None):
+    '''
+    Put the folder source in place of target with renames only : readers
+    see the old target, then (briefly) none, then the complete new one.
+    The old target is set aside under a scratch name of token (see
+    scratch_folder).
+    '''
+    old = scratch_folder(target, 'old', token)
+    if os.path.isdir(old):
+        shutil.rmtree(old)
+    if os.path.isdir(target):
+        os.rename(target, old)
+    os.rename(source, target)
+    if os.path.isdir(old):
+        shutil.rmtree(old)
@@ -0,0 +1,152 @@
+# Incremental export manifest
+#
+# Every tetrode folder keeps a small json recording what each export stage
+# (waveforms, PCs, phy files) was built from. A stage is rebuilt only when the
+# digest of its inputs differs from the one stored in the manifest.
+
+import hashlib
+import json
+import os
+
+MANIFEST = '.export_manifest.json'
+
+# Order matters : a stage's digest folds in the digest of the stage before it,
+# so a changed input rebuilds that stage and everything downstream of it
+STAGES = ('waveforms', 'pcs', 'phy')
+
+# Fast hash : number and size of the blocks sampled out of large files
+HASH_BLOCKS     = 16
+HASH_BLOCK_SIZE = 2**16
+
+# Read size of full hashes
+HASH_READ_SIZE = 2**22
+
+def full_hash(path:str):
+    '''
+    Hash the size and the whole content of a file
+    '''
+    size = os.path.getsize(path)
+    digest = hashlib.blake2b(str(size).encode(), digest_size=16)
+    with open(path, 'rb') as F:
+        for block in iter(lambda: F.read(HASH_READ_SIZE), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def fast_hash(path:str):
+    '''
+    Hash the size of a file plus evenly spaced blocks of its content. Small
+    files are hashed whole; for a multi-GB mda we read at most
+    HASH_BLOCKS * HASH_BLOCK_SIZE bytes (the header is always included).
+    Only meant for recordings : a change between the blocks goes unseen, so
+    anything that can be edited in place (firings, params) gets full_hash.
+    '''
+    size = os.path.getsize(path)
+    digest = hashlib.blake2b(str(size).encode(), digest_size=16)
+    with open(path, 'rb') as F:
+        if size <= HASH_BLOCKS * HASH_BLOCK_SIZE:
+            digest.update(F.read())
+        else:
+            step = (size - HASH_BLOCK_SIZE) // (HASH_BLOCKS - 1)
+            for block in range(HASH_BLOCKS):
+                F.seek(block * step)
+                digest.update(F.read(HASH_BLOCK_SIZE))
+    return digest.hexdigest()
+
+def file_entry(path:str, previous=None, sampled=False):
+    '''
+    Return {size, mtime_ns, sampled, hash} for path, hashed with fast_hash
+    when sampled, else with full_hash. When size, mtime and hash kind match
+    the previous entry its hash is reused without reading the file.
+    '''
+    if not os.path.exists(path):
+        return None
+    stat = os.stat(path)
+    entry = dict(size=stat.st_size, mtime_ns=stat.st_mtime_ns, sampled=sampled)
+    if (previous is not None and previous.get('size') == entry['size']
+            and previous.get('mtime_ns') == entry['mtime_ns']
+            and previous.get('sampled', True) == sampled):
+        entry['hash'] = previous['hash']
+    else:
+        entry['hash'] = fast_hash(path) if sampled else full_hash(path)
+    return entry
+
+def digest(*items):
+    return hashlib.blake2b(json.dumps(items, sort_keys=True).encode(),
+                           digest_size=16).hexdigest()
+
+class Manifest:
+    '''
+    Per-folder record of export inputs and the stage digests they produced
+
+    Parameters
+    ----------
+    local_path : str
+        the ntXX.mountain folder
+    inputs : dict
+        name -> path of the files the export reads
+    params : dict
+        stage -> dict of parameters that stage depends on
+    sampled : tuple
+        names of the inputs too large to hash whole (see fast_hash)
+    '''
+
+    def __init__(self, local_path:str, inputs:dict, params:dict, sampled=()):
+        self.filename = os.path.join(local_path, MANIFEST)
+        self.stored = self.load(self.filename)
+
+        previous = self.stored.get('inputs', {})
+        self.inputs = {name: file_entry(path, previous.get(name),
+                                        sampled=name in sampled)
+                       for name, path in inputs.items()}
+        self.params = params
+        self.stages = dict(self.stored.get('stages', {}))
+
+        # Stage digests this run would produce
+        self.digests = {}
+        upstream = [self.inputs[name]['hash'] if self.inputs[name] else None
+                    for name in sorted(self.inputs)]
+        for stage in STAGES:
+            upstream = digest(upstream, params.get(stage, {}))
+            self.digests[stage] = upstream
+
+    @staticmethod
+    def load(filename:str):
+        if not os.path.exists(filename):
+            return {}
+        try:
+            with open(filename, 'r') as F:
+                return json.load(F)
+        except (ValueError, OSError):
+            return {}
+
+    def fresh(self, stage:str):
+        '''
+        Was stage already built from the current inputs?
+        '''
+        return self.stages.get(stage) == self.digests[stage]
+
+    def all_fresh(self):
+        return all(self.fresh(stage) for stage in STAGES)
+
+    def mark(self, stage:str):
+        '''
+        Record stage as built from the current inputs and save
+        '''
+        self.stages[stage] = self.digests[stage]
+        self.save()
+
+    def invalidate(self, stage:str):
+        '''
+        Forget stage and every stage downstream of it, and save
+        '''
+        for name in STAGES[STAGES.index(stage):]:
+            self.stages.pop(name, None)
+        self.save()
+
+    def save(self):
+        manifest = dict(inputs=self.inputs, params=self.params,
+                        stages=self.stages)
+        tmp = self.filename + '.tmp'
+        with open(tmp, 'w') as F:
+            json.dump(manifest, F, indent=2, sort_keys=True)
+        os.replace(tmp, self.filename)
@@ -0,0 +1,110 @@
+# Lightweight MDA file helpers
+#
+# Reads the MDA header (dtype, dims) straight from the first bytes of a file
+# so that we can validate filt.mda/raw.mda/firings.mda without constructing a
+# full spikeinterface reader.
+
+import json
+import os
+import struct
+from collections import namedtuple
+
+# MDA dtype codes -> numpy dtype strings
+DTYPE_CODES = {-2: 'uint8',
+               -3: 'float32',
+               -4: 'int16',
+               -5: 'int32',
+               -6: 'uint16',
+               -7: 'float64',
+               -8: 'uint32'}
+CODE_DTYPES = {value: key for key, value in DTYPE_CODES.items()}
+
+# Name of the per-folder sidecar that caches the headers we already parsed
+HEADER_CACHE = '.mda_headers.json'
+
+MdaHeader = namedtuple('MdaHeader', ['dtype', 'num_bytes_per_entry', 'dims',
+                                     'header_size'])
+
+def read_header(path:str):
+    '''
+    Parse the header of an mda file, touching only its first bytes
+
+    Returns
+    -------
+    MdaHeader(dtype, num_bytes_per_entry, dims, header_size)
+    '''
+    with open(path, 'rb') as F:
+        code, num_bytes_per_entry, num_dims = struct.unpack('<iii', F.read(12))
+        if code not in DTYPE_CODES:
+            raise ValueError(f"{path} has an invalid mda dtype code {code}")
+        # A negative dim count marks 64 bit dims
+        if num_dims < 0:
+            num_dims = -num_dims
+            fmt, size = 'q', 8
+        else:
+            fmt, size = 'i', 4
+        if not 1 <= num_dims <= 50:
+            raise ValueError(f"{path} has an invalid mda dim count {num_dims}")
+        dims = struct.unpack('<' + fmt * num_dims, F.read(size * num_dims))
+    return MdaHeader(DTYPE_CODES[code], num_bytes_per_entry, tuple(dims),
+                     12 + size * num_dims)
+
+def header_bytes(dtype:str, dims):
+    '''
+    Build the raw bytes of an mda header for an array of dtype and dims
+    '''
+    code = CODE_DTYPES[str(dtype)]
+    num_bytes_per_entry = struct.calcsize({'uint8': 'B', 'float32': 'f',
+                                           'int16': 'h', 'int32': 'i',
+                                           'uint16': 'H', 'float64': 'd',
+                                           'uint32': 'I'}[str(dtype)])
+    dims = tuple(int(dim) for dim in dims)
+    if max(dims) >= 2**31:
+        return (struct.pack('<iii', code, num_bytes_per_entry, -len(dims)) +
+                struct.pack('<' + 'q' * len(dims), *dims))
+    return (struct.pack('<iii', code, num_bytes_per_entry, len(dims)) +
+            struct.pack('<' + 'i' * len(dims), *dims))
+
+def _stat_key(path:str):
+    stat = os.stat(path)
+    return [stat.st_size, stat.st_mtime_ns]
+
+def cached_header(path:str, cache_dir=None):
+    '''
+    Return the header of path, reusing the value cached in the sidecar of
+    cache_dir (default: the file's folder) when the file's size and mtime
+    have not changed
+    '''
+    path = os.path.abspath(path)
+    cache_dir = cache_dir or os.path.dirname(path)
+    cache_file = os.path.join(cache_dir, HEADER_CACHE)
+    name = os.path.relpath(path, cache_dir)
+    key = _stat_key(path)
+
+    cache = {}
+    if os.path.exists(cache_file):
+        try:
+            with open(cache_file, 'r') as F:
+                cache = json.load(F)
+        except (ValueError, OSError):
+            cache = {}
+    if name in cache and cache[name]['stat'] == key:
+        entry = cache[name]
+        return MdaHeader(entry['dtype'], entry['num_bytes_per_entry'],
+                         tuple(entry['dims']), entry['header_size'])
+
+    header = read_header(path)
+    cache[name] = dict(header._asdict(), stat=key)
+    try:
+        with open(cache_file, 'w') as F:
+            json.dump(cache, F)
+    except OSError:
+        # Read-only folders just don't get a cache
+        pass
+    return header
+
+def num_channels(path:str, cache_dir=None):
+    '''
+    Channel count (N1) of a timeseries mda
+    '''
+    return cached_header(path, cache_dir).dims[0]
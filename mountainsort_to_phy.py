@@ -1,44 +1,474 @@
 # ----------------------------------------------
 # Spikeinterface : Mountainsort curation via Phy
 # ----------------------------------------------
-import json, os, tqdm
+import json, os, sys, time, tqdm
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
 import spikeinterface.core.waveform_extractor as wave_extract
 import spikeinterface.exporters.to_phy as phy
 import spikeinterface.extractors.mdaextractors as mda_extract
+import spikeinterface.toolkit as toolkit
+import behavior, instrument, lazyfilter, lease, manifest, mdaio, staging, waveform_cache
 
 # -------------
 # Configuration
 # -------------
 config = {}
 config['filtered']        = True # Use filt.mda instead of raw.mda?
+# Bandpass raw.mda on the fly when not using filt.mda : only the blocks
+# around spikes are read and filtered, and phy reads raw.mda directly (see
+# lazyfilter.py). None hands the raw data over unfiltered.
+config['raw_filter'] = dict(freq_min=300., freq_max=6000., filter_order=5,
+                            margin_ms=10., block_size=8192,
+                            cache_size='200M') # Filtered blocks kept per job
 config['toleratemissing'] = True # Throw an error for missing tetrodes? Or just skip...
-config['skipproc']        = True # Skip already processed folders?
+config['debug']           = False # Let a tetrode's exception stop a serial run (for pdb)?
+config['skipproc']        = True # Skip folders whose export is up to date with its inputs?
+
+# Export stage parameters : changing any of these rebuilds that stage (and the
+# stages after it) on the next run, see manifest.py
+config['waveform'] = dict(max_spikes_per_unit=None, ms_before=3., ms_after=4.,
+                          return_scaled=False)
+config['pcs']      = dict(n_components=5, mode='by_channel_local')
+config['phy']      = dict(compute_pc_features=True, compute_amplitudes=True,
+                          max_channels_per_template=16, peak_sign='neg')
+
+# Tiered export : first export a stratified-in-time subsample of each unit so
+# curation can start, then fill in the full waveforms and per-spike PC
+# features (in the pool right after, or on demand with --tier fill)
+config['tiered']               = False
+config['tier_spikes_per_unit'] = 1000
+config['tier_strata']          = 20
+
+# Parallelism : tetrodes are spread over a process pool, and each worker gets
+# a slice of the cores/memory for its own waveform extraction jobs
+config['n_workers']       = None # Tetrodes processed at once (None = derive from cores)
+config['min_jobs']        = 2    # Fewest waveform jobs a single tetrode should get
+config['memory_fraction'] = 0.5  # Fraction of available RAM the pool may use
+
+# Chunking : the waveform extraction of each tetrode is planned from its
+# memory budget, channel count and spike count (see plan_extraction)
+config['max_rss']         = None  # Hard ceiling on a tetrode's extraction memory, e.g. '4G'
+config['job_overhead']    = '200M' # Resident memory of one extraction job before any chunk
+config['chunk_overhead']  = 3     # Copies of a chunk alive at once (traces, casts, snippets)
+config['min_chunk_size']  = 10000 # Samples; fewer jobs are used rather than smaller chunks
+config['max_chunk_size']  = None  # Samples; None = bounded by memory only
+config['chunks_per_job']  = 4     # Keep chunks small enough that every job gets this many
+
+# Run report : every stage of every tetrode is timed and appended to
+# export_report_<session>.jsonl, summarized at the end of the session
+config['report_dir'] = None # Folder of the report (None = parent_path)
+
+# Scratch staging : copy each tetrode's inputs to a local folder in the
+# background while the previous tetrode is processed, and copy the outputs
+# back asynchronously (for sessions on a slow network mount, see staging.py)
+config['scratch_dir'] = None  # Local scratch folder (None = work in place)
+config['scratch_max'] = '50G' # Size cap of the staged copies (None = no cap)
+config['stage_ahead'] = 1     # Tetrodes staged ahead of the one processing (serial runs)
+
+# Work claiming : several nodes can export the same parent_path. Each claims
+# a tetrode with a lease file before working on it, and skips tetrodes
+# claimed by a live node (see lease.py)
+config['claim']           = True # Claim tetrodes before processing them?
+config['lease_timeout']   = 600  # Seconds without heartbeat before a lease is broken
+config['lease_heartbeat'] = 30   # Seconds between two heartbeats
+
+# Behavior features : write the behavior at every spike into each phy folder
+# as spike_<variable>.npy, which phy shows as spike attributes (replaces
+# visualize-behavior/+phy/makeNPYfiles.m, see behavior.py)
+config['behavior_table'] = None # Behavior table, relative to parent_path (None = no features)
+config['behavior']       = dict(clock_rate=30000., # Ticks per second of the timestamps mda
+                                day=None,          # Rows of this day only
+                                max_gap_s=None)    # Furthest a spike may be from a row
 
 # Directory to look for tetrodes to send into Phy
 config['parent_path'] = '/mnt/deathstar/RY22_direct/MountainSort/.mountain/'
 #config['parent_path'] = '/Volumes/GenuDrive/RY16_direct/MountainSort/RY16_36.mountain/'
 #config['remote_path'] = 'citadel:/volume1/data/Projects/RY16_experiment/RY16_direct/MountainSort/RY16_36.mountain/'
 
-# TODO
-#from localremote import Rsync
-#rsync = Rsync(path_local=config['parent_path'],
-#              path_remote=config['remote_path'],
-#              dry_run=True)
+# Sessions on a remote mount are staged through a local scratch folder with
+# --scratch (see staging.py)
+
+def new_error_dict():
+    '''
+    Empty container for the data we store about failed tetrodes
+    '''
+    error = {}
+    error['missing'] = []
+    error['incompletemda'] = []
+    error['phyerror'] = []
+    error['workererror'] = []
+    error['stagingerror'] = []
+    error['claimed'] = []
+    error['behaviorerror'] = []
+    return error
+
+def merge_error_dict(error:dict, other:dict):
+    '''
+    Fold the errors of one tetrode into the session-wide error dict
+    '''
+    for key, value in other.items():
+        error.setdefault(key, []).extend(value)
+    return error
 
 # Store some data from the error
-error = {}
-error['missing'] = []
-error['incompletemda'] = []
-error['phyerror'] = []
+error = new_error_dict()
+
+# ------------------
+# Resource budgeting
+# ------------------
+def available_resources():
+    '''
+    Returns the (cores, bytes of free memory) this process may use
+    '''
+    if hasattr(os, 'sched_getaffinity'):
+        n_cores = len(os.sched_getaffinity(0))
+    else:
+        n_cores = os.cpu_count() or 1
+    try:
+        import psutil
+        memory = psutil.virtual_memory().available
+    except ImportError:
+        memory = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_AVPHYS_PAGES')
+    return n_cores, memory
+
+def worker_budget(n_tetrodes:int, n_workers=None, n_cores=None, memory=None,
+                  min_jobs=None, memory_fraction=None):
+    '''
+    Split the machine between tetrode-level workers and the waveform
+    extraction jobs inside each worker, such that n_workers * n_jobs never
+    exceeds the core count and the workers' chunk memory together stays
+    under memory_fraction of the available RAM.
+
+    Returns
+    -------
+    dict with n_workers, n_jobs (per worker) and total_memory (per worker,
+    as a spikeinterface memory string)
+    '''
+    free_cores, free_memory = available_resources()
+    n_cores  = n_cores or free_cores
+    memory   = memory or free_memory
+    min_jobs = min_jobs or config['min_jobs']
+    memory_fraction = memory_fraction or config['memory_fraction']
+
+    if n_workers is None:
+        n_workers = max(1, min(n_cores // min_jobs, n_cores))
+    n_workers = max(1, min(n_workers, n_tetrodes))
+    n_jobs    = max(1, n_cores // n_workers)
+
+    worker_memory = int(memory * memory_fraction) // n_workers
+    total_memory  = max(1, worker_memory // 2**20)
+    return dict(n_workers=n_workers, n_jobs=n_jobs,
+                total_memory=f"{total_memory}M")
+
+def memory_bytes(memory):
+    '''
+    Convert a spikeinterface style memory string ('500M', '2G') to bytes
+    '''
+    if not isinstance(memory, str):
+        return int(memory)
+    units = dict(k=2**10, K=2**10, M=2**20, G=2**30, T=2**40)
+    if memory[-1] in units:
+        return int(float(memory[:-1]) * units[memory[-1]])
+    return int(memory)
+
+def plan_extraction(num_channels:int, num_samples:int, num_spikes:int,
+                    nsamples_waveform:int, n_jobs:int, memory, dtype_size=4,
+                    config:dict=config):
+    '''
+    Pick the chunk size and number of jobs for one tetrode's waveform
+    extraction, such that the estimated peak memory of all jobs stays under
+    min(memory, config['max_rss']).
+
+    A chunk costs its traces plus the snippets of the spikes falling inside
+    it, times config['chunk_overhead'] for the temporary copies. Each job
+    also carries config['job_overhead'] of resident memory. Jobs are dropped
+    before chunks shrink under config['min_chunk_size'], and chunks are kept
+    small enough for every job to get config['chunks_per_job'] of them.
+
+    Returns
+    -------
+    dict with n_jobs, chunk_size (samples) and peak_memory (bytes, estimate)
+    '''
+    ceiling = memory_bytes(memory)
+    if config['max_rss'] is not None:
+        ceiling = min(ceiling, memory_bytes(config['max_rss']))
+    job_overhead = memory_bytes(config['job_overhead'])
+
+    bytes_per_sample  = num_channels * dtype_size
+    spikes_per_sample = num_spikes / max(num_samples, 1)
+    sample_cost = (bytes_per_sample * config['chunk_overhead']
+                   * (1 + spikes_per_sample * nsamples_waveform))
+
+    max_chunk = num_samples
+    if config['max_chunk_size'] is not None:
+        max_chunk = min(max_chunk, config['max_chunk_size'])
+    min_chunk = min(config['min_chunk_size'], max_chunk)
+
+    n_jobs = max(1, n_jobs)
+    while n_jobs > 1:
+        chunk_memory = ceiling / n_jobs - job_overhead
+        if chunk_memory >= min_chunk * sample_cost:
+            break
+        n_jobs -= 1
+    chunk_memory = max(ceiling / n_jobs - job_overhead, 0)
+    max_chunk = min(max_chunk, max(-(-num_samples // (n_jobs *
+                                                     config['chunks_per_job'])),
+                                   min_chunk))
+    chunk_size = int(min(max(chunk_memory / sample_cost, min_chunk), max_chunk))
+    chunk_size = max(chunk_size, 1)
+
+    return dict(n_jobs=n_jobs, chunk_size=chunk_size,
+                peak_memory=int(n_jobs * (job_overhead + chunk_size * sample_cost)))
+
+def peak_rss():
+    '''
+    Peak resident memory (bytes) of this process and of its largest child
+    '''
+    import resource
+    scale = 1 if sys.platform == 'darwin' else 2**10
+    return (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale,
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * scale)
+
+# -----------------------
+# Single tetrode pipeline
+# -----------------------
+def reconcile_geom(local_path:str, num_channels:int):
+    '''
+    Make geom.csv hold exactly num_channels coordinates.
+
+    The geom.csv of a tetrode often carries more coordinates than there are
+    channels in the *.mda, which makes the mda reader assert. We keep the
+    first num_channels rows and rewrite the file once (only if it changed).
+
+    Returns
+    -------
+    False if the geom has fewer coordinates than channels, True otherwise
+    '''
+    geom_file = os.path.join(local_path, 'geom.csv')
+    with open(geom_file, 'r') as F:
+        lines = [line for line in F.readlines() if line.strip()]
+    if len(lines) < num_channels or num_channels == 0:
+        return False
+    if len(lines) > num_channels:
+        with open(geom_file, 'w') as F:
+            F.writelines(lines[:num_channels])
+    return True
 
-for folder in tqdm.tqdm(os.listdir(config['parent_path']),
-                        desc="Process mountainsort folders"):
+# Marker left in a phy folder whose per-spike PC features are still pending;
+# holds the phy stage digest of the inputs the subsample export was made from
+FEATURES_PENDING = '.features_pending'
 
-    #if 'nt16' not in folder:
-    #    continue
+def export_manifest(local_path:str, recording_file:str, config:dict):
+    '''
+    Manifest of a tetrode's export inputs (see manifest.py)
+    '''
+    return manifest.Manifest(local_path,
+                             inputs={'recording': recording_file,
+                                     'firings_raw.mda': os.path.join(local_path, 'firings_raw.mda'),
+                                     'params.json': os.path.join(local_path, 'params.json'),
+                                     'geom.csv': os.path.join(local_path, 'geom.csv')},
+                             params=stage_params(config),
+                             sampled=('recording',))
 
-    # Set the full path to the tetrdode folder
-    local_path = os.path.join(config['parent_path'], folder)
+def read_pending(phyplace:str):
+    '''
+    phy digest a subsample export is waiting on its PC features for, or None
+    '''
+    pending_file = os.path.join(phyplace, FEATURES_PENDING)
+    if not os.path.exists(pending_file):
+        return None
+    with open(pending_file, 'r') as F:
+        return F.read().strip()
+
+def up_to_date(local_path:str, config:dict=config, tier='full'):
+    '''
+    Would process_tetrode skip local_path as already exported? Reads only,
+    so it can be asked before staging the folder.
+    '''
+    if not config['skipproc']:
+        return False
+    phyplace = os.path.join(local_path, 'phy')
+    if not os.path.exists(os.path.join(phyplace, 'params.py')):
+        return False
+    try:
+        if config['filtered']:
+            recording_file = os.path.join(local_path, 'filt.mda')
+        else:
+            with open(os.path.join(local_path, 'raw.mda.prv'), 'r') as F:
+                recording_file = json.load(F)['original_path']
+        record = export_manifest(local_path, recording_file, config)
+    except (OSError, ValueError, KeyError):
+        return False
+    pending = read_pending(phyplace)
+    return ((record.all_fresh() and pending is None) or
+            (tier == 'subsample' and pending == record.digests['phy']))
+
+def stage_params(config:dict):
+    '''
+    The parameters each export stage depends on, as recorded in the manifest
+    '''
+    waveforms = dict(config['waveform'], filtered=config['filtered'])
+    if not config['filtered']:
+        waveforms['raw_filter'] = config['raw_filter']
+    return dict(waveforms=waveforms,
+                pcs=config['pcs'],
+                phy=config['phy'])
+
+def lazy_filter(recording, firings_file:str, config:dict=config):
+    '''
+    Bandpass filter of a raw recording, computed only around the spikes of
+    firings_file, when read (see lazyfilter.py)
+    '''
+    params = dict(config['raw_filter'])
+    cache_bytes = memory_bytes(params.pop('cache_size'))
+    return lazyfilter.LazyFilterRecording(recording, os.path.abspath(firings_file),
+                                          ms_before=config['waveform']['ms_before'],
+                                          ms_after=config['waveform']['ms_after'],
+                                          cache_bytes=cache_bytes, **params)
+
+def fill_features(waveform, phyplace:str, config:dict=config, claim=None,
+                  **job_kwargs):
+    '''
+    Write the per-spike PC features of a subsample export (pc_features.npy,
+    pc_feature_ind.npy) in place. Only these files are touched, so curation
+    done on the subsample export in the meantime is kept.
+    '''
+    pc = waveform.load_extension('principal_components')
+    num_channels = min(config['phy']['max_channels_per_template'],
+                       waveform.recording.get_num_channels())
+    peak_sign = config['phy']['peak_sign']
+
+    partial = os.path.join(phyplace, 'pc_features.partial.npy')
+    pc.run_for_all_spikes(partial, max_channels_per_template=num_channels,
+                          peak_sign=peak_sign, **job_kwargs)
+    best_channels = toolkit.get_template_channel_sparsity(waveform,
+                                                          method='best_channels',
+                                                          peak_sign=peak_sign,
+                                                          num_channels=num_channels,
+                                                          outputs='index')
+    pc_feature_ind = np.array([best_channels[unit_id] for unit_id in
+                               waveform.sorting.unit_ids], dtype='int64')
+    if claim is not None:
+        claim.check()
+    np.save(os.path.join(phyplace, 'pc_feature_ind.npy'), pc_feature_ind)
+    os.replace(partial, os.path.join(phyplace, 'pc_features.npy'))
+
+def export_phy(waveform, phyplace:str, claim=None, pending=None,
+               raw_dat=None, features=None, lease_timeout=None, **kwargs):
+    '''
+    export_to_phy into a temporary folder next to phyplace, then rename it
+    into place : readers never see a half-written phy folder, and an export
+    whose lease was lost meanwhile (claim) is dropped instead of replacing
+    the other node's. pending is written as the FEATURES_PENDING marker.
+    Temporary folders left by killed exports are removed if they are this
+    lease's, or untouched for lease_timeout seconds (default
+    config['lease_timeout']).
+
+    With raw_dat (an mda file), no recording.dat is written and phy reads
+    the traces from raw_dat, past its header, filtering them itself.
+    features (a behavior.BehaviorSession) adds the behavior features.
+    '''
+    if raw_dat is not None:
+        kwargs['copy_binary'] = False
+    # Leftovers of an export killed before or during its swap
+    token = claim.token if claim is not None else None
+    lease.sweep_scratch(phyplace, config['lease_timeout'] if lease_timeout is None
+                        else lease_timeout, token)
+    temporary = lease.scratch_folder(phyplace, 'tmp', token)
+    phyfiles = phy.export_to_phy(waveform, temporary, remove_if_exists=True,
+                                 **kwargs)
+    # params.py points dat_path at the folder it was written in
+    params_py = os.path.join(temporary, 'params.py')
+    with open(params_py, 'r') as F:
+        text = F.read().replace(temporary, phyplace)
+    if raw_dat is not None:
+        header = mdaio.read_header(raw_dat)
+        params = dict(dat_path=f"r'{raw_dat}'", dtype=f"'{header.dtype}'",
+                      offset=header.header_size, hp_filtered=False)
+        lines = []
+        for line in text.splitlines():
+            name = line.split('=')[0].strip()
+            lines.append(f"{name} = {params[name]}" if name in params else line)
+        text = '\n'.join(lines) + '\n'
+    with open(params_py, 'w') as F:
+        F.write(text)
+    if pending is not None:
+        with open(os.path.join(temporary, FEATURES_PENDING), 'w') as F:
+            F.write(pending)
+    if features is not None:
+        features.write(temporary)
+    if claim is not None:
+        claim.check()
+    lease.replace_folder(temporary, phyplace, token)
+    return phyfiles
+
+def update_behavior(phyplace:str, features, recorder, error:dict, claim=None):
+    '''
+    Bring the behavior features of an exported phy folder up to date, in
+    place (each file through a rename). Returns error.
+    '''
+    if features is None or features.fresh(phyplace):
+        return error
+    try:
+        with recorder.stage('behavior'):
+            if claim is not None:
+                claim.check()
+            features.write(phyplace)
+    except lease.LeaseLost:
+        error['claimed'].append(phyplace)
+    except Exception:
+        # The traceback is in the report
+        error['behaviorerror'].append(phyplace)
+    return error
+
+def process_tetrode(local_path:str, config:dict=config, n_jobs=10,
+                    total_memory='50M', tier='full', report_file=None,
+                    session=None, tetrode=None, claim=None):
+    '''
+    Exports one ntXX.mountain folder to phy
+
+    tier is one of
+        'full'      : waveforms of all spikes, PCs and the phy export
+        'subsample' : phy export from a stratified subsample of each unit,
+                      without PC features (see config['tier_spikes_per_unit'])
+        'fill'      : complete a subsample export with the full waveforms
+                      and per-spike PC features ('full' also does this when
+                      it finds a pending subsample export)
+
+    Every stage is timed and its failures recorded with their traceback,
+    in report_file when given (see instrument.py), under the name tetrode
+    (default local_path, e.g. the session folder of a staged copy).
+
+    claim (a lease.Claim on the tetrode) is checked before the phy outputs
+    are put in place; if another node broke the lease meanwhile, they are
+    dropped and the tetrode is reported under 'claimed'.
+
+    With config['behavior_table'], the behavior features of the session
+    (the folder holding tetrode) are written with the phy export, or added
+    to an existing export they are missing from or outdated in.
+
+    Returns
+    -------
+    dict of error lists (same keys as the session error dict) for this
+    tetrode; empty lists if everything went through
+    '''
+    recorder = instrument.StageRecorder(report_file,
+                                        tetrode=tetrode or local_path,
+                                        session=session)
+    with recorder.stage('tetrode', tier=tier) as record:
+        error = _process_tetrode(local_path, config, n_jobs, total_memory,
+                                 tier, recorder, claim,
+                                 os.path.dirname(os.path.abspath(tetrode or local_path)))
+        record['errors'] = {key: value for key, value in error.items()
+                            if value}
+    return error
+
+def _process_tetrode(local_path:str, config:dict, n_jobs:int,
+                     total_memory, tier:str, recorder, claim=None,
+                     session_path=None):
+
+    error = new_error_dict()
 
     # The files that we may be using ...
     phyplace    = local_path + os.path.sep + "phy"
@@ -46,125 +476,514 @@ for folder in tqdm.tqdm(os.listdir(config['parent_path']),
     filt_file   = local_path + os.path.sep + 'filt.mda'
     params_file = local_path + os.path.sep + 'params.json'
     firings_file = local_path + os.path.sep + 'firings_raw.mda'
+    geom_file   = local_path + os.path.sep + 'geom.csv'
     curated_firings_file = local_path + os.path.sep + 'firings_raw.mda'
 
-    # If skipproc and a phy foler already created, skip this folder
-    if config['skipproc'] and os.path.exists(os.path.join(phyplace, 'params.py')):
-        continue
     if not os.path.isdir(local_path):
-        continue
-
-    print("Processing " + local_path)
-
-    # Derive the properties of the prv
-    with open(params_file, 'r') as F:
-        params_dict = json.load(F)
+        return error
 
-    # Create the mda object
+    # Which timeseries the waveforms are read from
     if config['filtered']:
         if config['toleratemissing'] and not os.path.exists(filt_file):
             print(f"Warning {local_path} has no filt.mda")
             error['missing'].append(filt_file)
-            continue
+            return error
+        recording_file = filt_file
+    else:
+        with open(prv_file, 'r') as F:
+            json_dict = json.load(F)
+        recording_file = json_dict['original_path']
 
-        not_complete = True
-        geom_empty   = False
-        print("Extracting MDA")
-        while not_complete and not geom_empty:
+    # Make the geom.csv agree with the channel count in the mda header
+    # before opening the recording, instead of retrying the reader
+    num_channels = mdaio.num_channels(recording_file, local_path)
+    if not reconcile_geom(local_path, num_channels):
+        print(f"Warning {geom_file} has fewer coordinates than the "
+              f"{num_channels} channels of {recording_file}")
+        error['missing'].append(geom_file)
+        return error
 
-            try:
-                mda = mda_extract.read_mda_recording(local_path,
-                                                         raw_fname=filt_file)
-                not_complete = False
-
-            # When an assertion error occurs, it's usually due to the geom.csv
-            # having more coordinates than there are channels in the *.mda. So
-            # we remove a line from the file (remove a coordinate) until the
-            # coordinate count matches. Janky, but it works.
-            except AssertionError:
-                geom_file = os.path.join(local_path, 'geom.csv')
-                with open(geom_file, 'r') as F:
-                    lines = F.readlines()
-                    lines = lines[:len(lines)-1]
-                    if len(lines) == 0:
-                        print("geom_file is empty!")
-                        geom_empty = True
-                        continue
-                with open(geom_file, 'w') as F:
-                    F.writelines(lines)
+    # Compare the inputs against those the previous export was built from;
+    # with skipproc, a tetrode whose inputs are unchanged is done already
+    record = export_manifest(local_path, recording_file, config)
+    if not config['skipproc']:
+        record.stages = {}
+    pending_file = os.path.join(phyplace, FEATURES_PENDING)
+    pending = read_pending(phyplace)
+    exported = os.path.exists(os.path.join(phyplace, 'params.py'))
 
-        # If the geom file is empty, because it never converges to
-        # the proper number of channels, continue to the next tetrode
-        if geom_empty:
-            continue
+    # Behavior table and timestamps of the session, loaded once per process
+    features = None
+    if config['behavior_table']:
+        try:
+            features = behavior.session(session_path or os.path.dirname(local_path),
+                                        config['behavior_table'], **config['behavior'])
+        except Exception as E:
+            print(f"Cannot load the behavior of {local_path}: {E!r}")
+            error['behaviorerror'].append(local_path)
 
-        # If we're using filt.mda, the file is already filtered
-        mda.annotate(is_filtered=True)
+    if exported and record.all_fresh() and pending is None:
+        return update_behavior(phyplace, features, recorder, error, claim)
+    if (exported and tier == 'subsample' and config['skipproc']
+            and pending == record.digests['phy']):
+        return update_behavior(phyplace, features, recorder, error, claim)
 
-    else:
-        with open(prv_file, 'r') as F:
-            json_dict = json.load(F)
-        original_path = json_dict['original_path']
+    print("Processing " + local_path)
+
+    # Derive the properties of the prv
+    with open(params_file, 'r') as F:
+        params_dict = json.load(F)
+
+    with recorder.stage('open') as stage:
+        # Create the mda object
+        print("Extracting MDA")
         mda = mda_extract.read_mda_recording(local_path,
-                                                 raw_fname=original_path)
-
-    # ----------------------------------------------
-    # Derive a file pointing to filtered spikes file
-    # ----------------------------------------------
-    print("Getting spikes file")
-    samprate = params_dict['samplerate']
-    try :
-        spikes = (
-            mda_extract.read_mda_sorting(firings_file,
-                                         sampling_frequency=samprate))
-    except FileNotFoundError as F:
-        error['missing'].append(firings_file)
-        continue
-
-    # Remove any folders and files that will hamper this process
-    print("Processing waveform")
-    waveform_file = local_path + os.path.sep + 'waveform' + os.path.sep + "PCA"
-    if os.path.exists(waveform_file):
-        [os.remove(os.path.join(waveform_file, f)) for f in
-         os.listdir(waveform_file)]
-        os.rmdir(waveform_file)
-    waveform_file = local_path + os.path.sep + 'waveform' + os.path.sep + "waveforms"
-    if os.path.exists(waveform_file):
-        [os.remove(os.path.join(waveform_file, f)) for f in
-         os.listdir(waveform_file)]
-        os.rmdir(waveform_file)
-    waveform_file = local_path + os.path.sep + 'waveform'
-    if os.path.exists(waveform_file):
-        [os.remove(os.path.join(waveform_file, f)) for f in
-         os.listdir(waveform_file)]
-        os.rmdir(waveform_file)
+                                             raw_fname=recording_file)
+        if config['filtered']:
+            # If we're using filt.mda, the file is already filtered
+            mda.annotate(is_filtered=True)
+        elif config['raw_filter']:
+            mda = lazy_filter(mda, firings_file, config)
+
+        # ----------------------------------------------
+        # Derive a file pointing to filtered spikes file
+        # ----------------------------------------------
+        print("Getting spikes file")
+        samprate = params_dict['samplerate']
+        try :
+            spikes = (
+                mda_extract.read_mda_sorting(firings_file,
+                                             sampling_frequency=samprate))
+        except FileNotFoundError as F:
+            error['missing'].append(firings_file)
+            stage['missing'] = firings_file
+            return error
+        stage.update(num_samples=mda.get_num_samples(),
+                      num_channels=mda.get_num_channels(),
+                      num_units=len(spikes.unit_ids))
+
+    # -------------------------------------------------
+    # Size the chunks and jobs from the memory budget
+    # -------------------------------------------------
+    recording_header = mdaio.cached_header(recording_file, local_path)
+    firings_header   = mdaio.cached_header(firings_file, local_path)
+    nsamples_waveform = int((config['waveform']['ms_before'] +
+                             config['waveform']['ms_after'])
+                            * samprate / 1000)
+    plan_config, dtype_size = config, recording_header.num_bytes_per_entry
+    raw_dat = None
+    if not config['filtered'] and config['raw_filter']:
+        # Every job holds its own cache of float32 filtered blocks
+        plan_config = dict(config, job_overhead=(
+            memory_bytes(config['job_overhead']) +
+            memory_bytes(config['raw_filter']['cache_size'])))
+        dtype_size, raw_dat = 4, recording_file
+    plan = plan_extraction(num_channels=recording_header.dims[0],
+                           num_samples=recording_header.dims[1],
+                           num_spikes=firings_header.dims[1],
+                           nsamples_waveform=nsamples_waveform,
+                           n_jobs=n_jobs,
+                           memory=total_memory,
+                           dtype_size=dtype_size,
+                           config=plan_config)
+    print(f"Extraction plan: {plan['n_jobs']} jobs x {plan['chunk_size']} "
+          f"samples/chunk, ~{plan['peak_memory'] / 2**20:.0f}M peak")
 
     # ----------------------
     # Extract spike waveform
     # ----------------------
-    try:
-        waveform = wave_extract.extract_waveforms(mda,
-                                                  spikes,
-                                                  waveform_file,
-                                                  max_spikes_per_unit=None,
-                                                  ms_before=3., 
-                                                  ms_after=4.,
-                                                  return_scaled=False, 
-                                                  n_jobs=10,
-                                                  total_memory='50M',
-                                                  progress_bar=True)
-    except ValueError:
-        error['incompletemda'] = (mda, spikes, waveform_file)
+    recording_id = manifest.digest(record.inputs['recording'],
+                                   record.inputs['geom.csv'],
+                                   *([] if config['filtered'] else
+                                     [config['raw_filter']]))
+
+    if tier == 'subsample':
+        print("Processing waveform subsample")
+        waveform_file = local_path + os.path.sep + 'waveform_subsample'
+        try:
+            with recorder.stage('waveforms_subsample', **plan) as stage:
+                waveform, extracted = waveform_cache.load_or_extract(
+                                      mda, spikes, waveform_file, recording_id,
+                                      dict(config['waveform'],
+                                           max_spikes_per_unit=config['tier_spikes_per_unit']),
+                                      num_strata=config['tier_strata'],
+                                      n_jobs=plan['n_jobs'],
+                                      chunk_size=plan['chunk_size'],
+                                      progress_bar=True)
+                stage['extracted_units'] = len(extracted)
+        except ValueError:
+            error['incompletemda'].append(waveform_file)
+            return error
+
+        print("Processing phy (subsample)")
+        try:
+            with recorder.stage('phy_subsample'):
+                phyfiles = export_phy(waveform, phyplace, claim,
+                                      pending=record.digests['phy'],
+                                      raw_dat=raw_dat, features=features,
+                                      lease_timeout=config['lease_timeout'],
+                                      **dict(config['phy'],
+                                             compute_pc_features=False),
+                                      n_jobs=plan['n_jobs'],
+                                      chunk_size=plan['chunk_size'])
+        except lease.LeaseLost:
+            error['claimed'].append(phyplace)
+        except Exception:
+            # The traceback is in the report
+            error['phyerror'].append(phyplace)
+        return error
+
+    print("Processing waveform")
+    waveform_file = local_path + os.path.sep + 'waveform'
+    if record.fresh('waveforms') and os.path.isdir(waveform_file):
+        waveform = wave_extract.WaveformExtractor.load_from_folder(waveform_file)
+    else:
+        record.invalidate('waveforms')
+        # Reuse the waveforms of every unit whose spike train is unchanged
+        start = time.time()
+        try:
+            with recorder.stage('waveforms', **plan) as stage:
+                waveform, extracted = waveform_cache.load_or_extract(
+                                                      mda,
+                                                      spikes,
+                                                      waveform_file,
+                                                      recording_id,
+                                                      config['waveform'],
+                                                      n_jobs=plan['n_jobs'],
+                                                      chunk_size=plan['chunk_size'],
+                                                      progress_bar=True)
+                stage['extracted_units'] = len(extracted)
+        except ValueError:
+            error['incompletemda'].append(waveform_file)
+            return error
+        elapsed = time.time() - start
+        if len(extracted):
+            rss_self, rss_child = peak_rss()
+            print(f"Extraction throughput: "
+                  f"{recording_header.dims[1] / max(elapsed, 1e-9):.3g} "
+                  f"samples/s ({elapsed:.1f}s), peak RSS "
+                  f"{max(rss_self, rss_child) / 2**20:.0f}M")
+        print(f"Extracted {len(extracted)} of {len(spikes.unit_ids)} units")
+        record.mark('waveforms')
+
+    # -----------------------------
+    # Principal components (cached)
+    # -----------------------------
+    if not (record.fresh('pcs') and waveform.is_extension('principal_components')):
+        print("Processing PCs")
+        record.invalidate('pcs')
+        with recorder.stage('pcs'):
+            toolkit.compute_principal_components(waveform, load_if_exists=False,
+                                                 **config['pcs'])
+        record.mark('pcs')
 
     # ----------------------------------
     # Perform the actual export process
     # ----------------------------------
+    if record.fresh('phy') and exported and pending is None:
+        return update_behavior(phyplace, features, recorder, error, claim)
+
+    # A subsample export of these same inputs only lacks the PC features
+    if exported and pending == record.digests['phy']:
+        print("Processing phy (filling PC features)")
+        try:
+            with recorder.stage('fill_features'):
+                fill_features(waveform, phyplace, config, claim,
+                              n_jobs=plan['n_jobs'],
+                              chunk_size=plan['chunk_size'])
+        except lease.LeaseLost:
+            error['claimed'].append(phyplace)
+            return error
+        os.remove(pending_file)
+        record.mark('phy')
+        return update_behavior(phyplace, features, recorder, error, claim)
+
     print("Processing phy")
-    phyplace = local_path + os.path.sep + "phy"
-    if os.path.exists(phyplace):
-        [os.remove(os.path.join(phyplace, f)) for f in os.listdir(phyplace)]
-        os.rmdir(phyplace)
+    record.invalidate('phy')
     try:
-        phyfiles = phy.export_to_phy(waveform, phyplace)
-    except:
-        error['phyerror'].append((waveform, phyplace))
+        with recorder.stage('phy'):
+            phyfiles = export_phy(waveform, phyplace, claim, raw_dat=raw_dat,
+                                  features=features,
+                                  lease_timeout=config['lease_timeout'],
+                                  **config['phy'],
+                                  n_jobs=plan['n_jobs'],
+                                  chunk_size=plan['chunk_size'])
+        record.mark('phy')
+    except lease.LeaseLost:
+        error['claimed'].append(phyplace)
+    except Exception:
+        # The traceback is in the report
+        error['phyerror'].append(phyplace)
+
+    return error
+
+# ---------------------
+# Session level driver
+# ---------------------
+def export_session(parent_path=None, config:dict=config, error:dict=error,
+                   n_workers=None, tetrodes=None, tier=None):
+    '''
+    Exports every tetrode folder under parent_path to phy, scheduling the
+    tetrodes across a process pool. Failures of each tetrode are folded
+    into error, which is also returned.
+
+    tetrodes optionally restricts the export to these folder names. With
+    config['tiered'] each tetrode is first exported as a subsample and its
+    'fill' tier is queued as soon as that finishes; tier runs a single tier
+    (e.g. 'fill' on demand) for every tetrode instead.
+
+    With config['claim'] each tetrode is claimed with a lease file from its
+    first tier until its last tier is processed (and written back, when
+    staged); tetrodes another node holds are skipped and listed under
+    error['claimed'].
+
+    The stages of every tetrode are appended to export_report_<session>.jsonl
+    in config['report_dir'] (default parent_path), followed by a session
+    record holding error, and a summary table is printed at the end.
+    '''
+
+    parent_path = parent_path or config['parent_path']
+    folders = [os.path.join(parent_path, folder)
+               for folder in sorted(os.listdir(parent_path))
+               if tetrodes is None or folder in tetrodes]
+    folders = [folder for folder in folders if os.path.isdir(folder)]
+    if len(folders) == 0:
+        return error
+
+    # The tiers each tetrode goes through, in order
+    if tier is not None:
+        tiers = (tier,)
+    elif config['tiered']:
+        tiers = ('subsample', 'fill')
+    else:
+        tiers = ('full',)
+
+    budget = worker_budget(len(folders),
+                           n_workers=n_workers or config['n_workers'])
+    print(f"Exporting {len(folders)} tetrodes with {budget['n_workers']} "
+          f"workers x {budget['n_jobs']} jobs ({budget['total_memory']} each)")
+    session = instrument.new_session()
+    report_file = instrument.report_file(config['report_dir'] or parent_path,
+                                         session)
+    job_kwargs = dict(n_jobs=budget['n_jobs'],
+                      total_memory=budget['total_memory'],
+                      report_file=report_file, session=session)
+    progress = tqdm.tqdm(total=len(folders) * len(tiers),
+                         desc="Process mountainsort folders")
+
+    # Optional scratch staging; tetrodes that will be skipped are not copied
+    stager = None
+    if config['scratch_dir']:
+        stager = staging.Stager(config['scratch_dir'],
+                                max_bytes=(memory_bytes(config['scratch_max'])
+                                           if config['scratch_max'] else None),
+                                filtered=config['filtered'])
+
+    def stage_ahead(queue, count):
+        # Copy the next tetrodes to scratch while the current ones run
+        if stager is None:
+            return
+        for local_path, stage in queue[:count]:
+            if not up_to_date(local_path, config, tiers[stage]):
+                stager.prefetch(local_path)
+
+    # Leases held by this node, by tetrode; a tetrode keeps its lease across
+    # its tiers
+    leases = {}
+
+    def start(local_path, stage):
+        # Where to process local_path : its scratch copy, once copied; None
+        # if another node has claimed it
+        if config['claim'] and local_path not in leases:
+            claimed = lease.Lease(local_path, timeout=config['lease_timeout'],
+                                  heartbeat=config['lease_heartbeat'])
+            if not claimed.acquire():
+                print(f"Skipping {local_path}, claimed by another node")
+                error['claimed'].append(local_path)
+                return None
+            leases[local_path] = claimed
+        if stager is None or up_to_date(local_path, config, tiers[stage]):
+            return local_path
+        return stager.acquire(local_path)
+
+    def claim(local_path):
+        return leases[local_path].claim if local_path in leases else None
+
+    def finish(local_path, tetrode_error=None, last=True):
+        # Write the outputs back and report errors under the session paths,
+        # then, after the tetrode's last tier, let go of the lease (once
+        # written back)
+        claimed = leases.get(local_path)
+        done = leases.pop(local_path, None) if last else None
+        if stager is None:
+            if done is not None:
+                done.release()
+            return merge_error_dict(error, tetrode_error or {})
+        write_back = stager.release(local_path, claim=claimed and claimed.claim)
+        if done is not None:
+            if write_back is None:
+                done.release()
+            else:
+                write_back.add_done_callback(lambda _: done.release())
+        for key, values in (tetrode_error or {}).items():
+            error.setdefault(key, []).extend(stager.remote_path(value)
+                                             if isinstance(value, str) else value
+                                             for value in values)
+
+    # Every tetrode gets its first tier before any tetrode gets the next one
+    queue = [(local_path, 0) for local_path in folders]
+
+    # Run in this process when there is nothing to parallelize; with
+    # config['debug'] a failing tetrode raises here, for tracebacks and pdb
+    if budget['n_workers'] == 1:
+        while queue:
+            local_path, stage = queue.pop(0)
+            work_path = start(local_path, stage)
+            stage_ahead(queue, config['stage_ahead'])
+            if work_path is None:
+                progress.update()
+                continue
+            try:
+                tetrode_error = process_tetrode(work_path, config,
+                                                tier=tiers[stage],
+                                                tetrode=local_path,
+                                                claim=claim(local_path),
+                                                **job_kwargs)
+            except Exception as E:
+                # Same as a failed worker : in the report with its traceback
+                finish(local_path)
+                if config['debug']:
+                    raise
+                error['workererror'].append((local_path, repr(E)))
+                progress.update()
+                continue
+            finish(local_path, tetrode_error, last=stage + 1 == len(tiers))
+            progress.update()
+            if stage + 1 < len(tiers):
+                queue.append((local_path, stage + 1))
+    else:
+        with ProcessPoolExecutor(max_workers=budget['n_workers']) as pool:
+            futures = {}
+            while queue or futures:
+                # Keep every worker busy, with the next tetrodes staged behind
+                while queue and len(futures) < budget['n_workers']:
+                    local_path, stage = queue.pop(0)
+                    work_path = start(local_path, stage)
+                    if work_path is None:
+                        progress.update()
+                        continue
+                    futures[pool.submit(process_tetrode, work_path, config,
+                                        tier=tiers[stage], tetrode=local_path,
+                                        claim=claim(local_path),
+                                        **job_kwargs)] = (local_path, stage)
+                stage_ahead(queue, budget['n_workers'])
+                if not futures:
+                    continue
+
+                done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                for future in done:
+                    local_path, stage = futures.pop(future)
+                    progress.update()
+                    try:
+                        tetrode_error = future.result()
+                    except Exception as E:
+                        # Errors raised in a stage are in the report with their
+                        # traceback; this also catches a worker that died
+                        finish(local_path)
+                        error['workererror'].append((local_path, repr(E)))
+                        continue
+                    finish(local_path, tetrode_error, last=stage + 1 == len(tiers))
+                    # Queue this tetrode's next tier behind the pending first tiers
+                    if stage + 1 < len(tiers):
+                        queue.append((local_path, stage + 1))
+    progress.close()
+
+    if stager is not None:
+        print("Waiting for the staged outputs to be written back")
+        error['stagingerror'].extend(stager.close())
+    for claimed in leases.values():
+        claimed.release()
+
+    return report_session(report_file, session, error)
+
+def report_session(report_file:str, session:str, error:dict):
+    '''
+    Close the session report with the session's errors and print its summary
+    '''
+    instrument.StageRecorder(report_file, session=session).write(
+        dict(session=session, stage='session', errors=error))
+    print(instrument.summary(instrument.read_report(report_file)))
+    print(f"Report written to {report_file}")
+    return error
+
+
+if __name__ == "__main__":
+
+    import argparse
+    parse = argparse.ArgumentParser(prog="mountainsort to phy",
+                                    description='exports every tetrode of a '
+                                                'mountainsort session to phy',
+                                    usage="mountainsort_to_phy {parent_path}")
+    parse.add_argument("parent_path", nargs="?", default=config['parent_path'],
+                       type=str,
+                       help="the .mountain folder holding the ntXX.mountain "
+                            "tetrode folders")
+    parse.add_argument("--workers", default=config['n_workers'], type=int,
+                       help="tetrodes to process at once (default: derived "
+                            "from cores and memory)")
+    parse.add_argument("--raw", action="store_true",
+                       help="use raw.mda.prv instead of filt.mda, bandpass "
+                            "filtered on the fly")
+    parse.add_argument("--raw-unfiltered", action="store_true",
+                       help="with --raw, use the raw data as is")
+    parse.add_argument("--no-skip", action="store_true",
+                       help="re-export folders that already have phy output")
+    parse.add_argument("--tiered", action="store_true",
+                       help="export a per-unit subsample first so curation can "
+                            "start, then fill in the full PC features")
+    parse.add_argument("--tier", choices=["full", "subsample", "fill"],
+                       default=None,
+                       help="run only this tier, e.g. 'fill' to complete "
+                            "subsample exports on demand")
+    parse.add_argument("--behavior", default=config['behavior_table'], type=str,
+                       help="behavior table (csv, parquet, feather, pickle or "
+                            "hdf, with a 'time' column in seconds) to write "
+                            "the behavior at every spike into the phy folders")
+    parse.add_argument("--behavior-day", default=None, type=int,
+                       help="only use the rows of the behavior table of this day")
+    parse.add_argument("--debug", action="store_true",
+                       help="with one worker, stop at the first tetrode that "
+                            "raises instead of recording it and moving on")
+    parse.add_argument("--tetrodes", nargs="+", default=None,
+                       help="only export these ntXX.mountain folders")
+    parse.add_argument("--scratch", default=config['scratch_dir'], type=str,
+                       help="local folder to stage tetrodes through, for "
+                            "sessions on a slow mount")
+    parse.add_argument("--scratch-max", default=config['scratch_max'], type=str,
+                       help="size cap of the staged copies, e.g. 50G")
+    parse.add_argument("--no-claim", action="store_true",
+                       help="do not claim tetrodes with lease files (only one "
+                            "node exports this parent_path)")
+    parse.add_argument("--lease-timeout", default=config['lease_timeout'],
+                       type=float,
+                       help="seconds without heartbeat after which another "
+                            "node's claim on a tetrode is broken")
+    Opt = parse.parse_args()
+
+    config['parent_path'] = Opt.parent_path
+    config['n_workers']   = Opt.workers
+    config['filtered']    = not Opt.raw
+    if Opt.raw_unfiltered:
+        config['raw_filter'] = None
+    config['skipproc']    = not Opt.no_skip
+    config['tiered']      = Opt.tiered
+    config['scratch_dir'] = Opt.scratch
+    config['scratch_max'] = Opt.scratch_max
+    config['claim']       = not Opt.no_claim
+    config['behavior_table'] = Opt.behavior
+    config['behavior']['day'] = Opt.behavior_day
+    config['lease_timeout'] = Opt.lease_timeout
+    config['debug']       = Opt.debug
+
+    export_session(config['parent_path'], config, error,
+                   tetrodes=Opt.tetrodes, tier=Opt.tier)
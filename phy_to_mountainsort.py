@@ -3,29 +3,407 @@
 # EMAIL:  ryoung-at-brandeis-edu
 # Purpose: Converts phy clusters back to the mountainsort medium
 
+import csv
+import glob
+import json
 import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
-def firings_mda(spike_clusters:str):
-    pass
+import numpy as np
 
-def metrics_json(cluster_groups:str):
-    pass
+import mdaio
 
-def phy_to_mountainsort(folder:str):
-    pass
+# Columns of firings written per chunk; 3 x 2**20 float64 is ~24M
+CHUNK_SIZE = 2**20
+
+# phy cluster groups -> mountainsort tags
+GROUP_TAGS = {'good': ['accepted'], 'mua': ['accepted', 'mua'],
+              'noise': ['rejected'], 'unsorted': []}
+
+def read_tsv(filename:str, column:str, dtype=str):
+    '''
+    Read one column of a phy cluster_*.tsv into {cluster_id: value}
+    '''
+    if not os.path.exists(filename):
+        return {}
+    with open(filename, 'r') as F:
+        return {int(row['cluster_id']): dtype(row[column])
+                for row in csv.DictReader(F, delimiter='\t')
+                if row.get(column, '') != ''}
+
+def read_firings(filename:str):
+    '''
+    Memory-map a firings mda (R x N, R >= 3) without reading its body
+    '''
+    header = mdaio.read_header(filename)
+    return np.memmap(filename, dtype=header.dtype, mode='r',
+                     offset=header.header_size, shape=header.dims, order='F')
+
+def unit_ids(firings, chunk_size=CHUNK_SIZE):
+    '''
+    Sorted mountainsort labels of firings, read chunk by chunk. The export
+    numbers templates (and phy's first cluster ids) in this order, as
+    MdaSortingExtractor lists its units.
+    '''
+    labels = np.zeros(0, dtype='int64')
+    for start in range(0, firings.shape[1], chunk_size):
+        labels = np.union1d(labels, np.asarray(firings[2, start:start + chunk_size],
+                                               dtype='int64'))
+    return labels
+
+def _pair_ties(firings_times, firings_labels, phy_times, phy_labels):
+    '''
+    Pair the spikes of a window made of whole runs of equal times, matching
+    (time, label) inside each run
+
+    Returns
+    -------
+    (columns, spikes) : window indices whose phy spike is not the one at the
+    same index, and those phy spikes
+    '''
+    firings_order = np.lexsort((firings_labels, firings_times))
+    phy_order = np.lexsort((phy_labels, phy_times))
+    order = np.empty_like(phy_order)
+    order[firings_order] = phy_order
+    columns = np.flatnonzero(order != np.arange(len(order)))
+    return columns, order[columns]
+
+def spike_order(phy_folder:str, firings, chunk_size=CHUNK_SIZE):
+    '''
+    Pair phy spikes with firings columns.
+
+    phy sorts the spikes by time but leaves ties in arbitrary order, so
+    spikes are matched on (time, original mountainsort label). When the
+    firings are sorted by time too (the usual case), phy spike k and firings
+    column k share their time and only runs of equal times can be out of
+    order : those are found and reordered chunk by chunk, so only the
+    reordered spikes are held in memory.
+
+    Returns
+    -------
+    None if phy spike k is firings column k for every k, otherwise
+    (columns, spikes) : the firings columns (ascending) whose phy spike is
+    not the one at the same index, and those phy spikes
+    '''
+    spike_times = np.load(os.path.join(phy_folder, 'spike_times.npy'),
+                          mmap_mode='r').ravel()
+    spike_templates = np.load(os.path.join(phy_folder, 'spike_templates.npy'),
+                              mmap_mode='r').ravel()
+    num_spikes = firings.shape[1]
+    if len(spike_times) != num_spikes:
+        raise ValueError(f"{phy_folder} has {len(spike_times)} spikes but "
+                         f"firings has {num_spikes}")
+
+    # Original mountainsort label of every template. Not from phy's
+    # cluster_si_unit_ids.tsv : phy rewrites it on every save with the
+    # current clusters only, which loses merged and split ones.
+    template_units = unit_ids(firings, chunk_size)
+
+    columns, spikes = [], []
+    # Start of the run of equal times still open at the end of the last chunk
+    start = 0
+    for stop in range(chunk_size, num_spikes + chunk_size, chunk_size):
+        stop = min(stop, num_spikes)
+        times = np.asarray(firings[1, start:stop], dtype='int64')
+        if (np.any(np.diff(times) < 0) or not np.array_equal(
+                times, np.asarray(spike_times[start:stop], dtype='int64'))):
+            return _spike_order_unsorted(firings, spike_times, spike_templates,
+                                         template_units)
+        # Leave the last run for the next chunk, it may go on there
+        if stop < num_spikes:
+            run_starts = np.flatnonzero(np.diff(times)) + 1
+            if len(run_starts) == 0:
+                continue
+            stop = start + run_starts[-1]
+            times = times[:run_starts[-1]]
+        window_columns, window_spikes = _pair_ties(
+            times, np.asarray(firings[2, start:stop], dtype='int64'),
+            times, template_units[spike_templates[start:stop]])
+        columns.append(start + window_columns)
+        spikes.append(start + window_spikes)
+        start = stop
+
+    if sum(len(window) for window in columns) == 0:
+        return None
+    return np.concatenate(columns), np.concatenate(spikes)
+
+def _spike_order_unsorted(firings, spike_times, spike_templates, template_units):
+    '''
+    spike_order of firings that are not sorted by time : pairs every spike
+    at once, with the firings rows and phy arrays in memory
+    '''
+    columns, spikes = _pair_ties(np.asarray(firings[1], dtype='int64'),
+                                 np.asarray(firings[2], dtype='int64'),
+                                 np.asarray(spike_times, dtype='int64'),
+                                 template_units[spike_templates])
+    if len(columns) == 0:
+        return None
+    return columns, spikes
+
+def cluster_labels(phy_folder:str, keep_noise=False, spike_clusters=None,
+                   groups=None):
+    '''
+    Map curated phy cluster ids onto consecutive mountainsort labels.
+    spike_clusters and groups default to those phy saved in phy_folder.
+
+    Returns
+    -------
+    (lookup array phy cluster id -> label, 0 for dropped clusters,
+     {phy cluster id: label})
+    '''
+    if spike_clusters is None:
+        spike_clusters = np.load(os.path.join(phy_folder, 'spike_clusters.npy'),
+                                 mmap_mode='r').ravel()
+    if groups is None:
+        groups = read_tsv(os.path.join(phy_folder, 'cluster_group.tsv'), 'group')
+
+    # Which cluster ids still own spikes
+    present = np.zeros(0, dtype=bool)
+    for start in range(0, len(spike_clusters), CHUNK_SIZE):
+        counts = np.bincount(spike_clusters[start:start + CHUNK_SIZE])
+        if len(counts) > len(present):
+            present = np.pad(present, (0, len(counts) - len(present)))
+        present[:len(counts)] |= counts > 0
+    cluster_ids = np.flatnonzero(present)
+    if not keep_noise:
+        cluster_ids = np.array([cluster_id for cluster_id in cluster_ids
+                                if groups.get(cluster_id) != 'noise'],
+                               dtype='int64')
+
+    lookup = np.zeros(len(present), dtype='int64')
+    lookup[cluster_ids] = np.arange(1, len(cluster_ids) + 1)
+    return lookup, {int(c): int(lookup[c]) for c in cluster_ids}
+
+def firings_mda(phy_folder:str, ms_folder=None, keep_noise=False,
+                chunk_size=CHUNK_SIZE, spike_clusters=None, groups=None):
+    '''
+    Write the curated firings.mda next to firings_raw.mda
+
+    The primary channel and time rows come from firings_raw.mda, the label
+    row from phy's spike_clusters.npy (remapped to 1..K, noise clusters
+    dropped unless keep_noise). Inputs are memory-mapped and the output is
+    streamed in chunks of chunk_size spikes. spike_clusters and groups
+    replace phy's saved files when given (the live state of a phy session).
+
+    Returns
+    -------
+    {phy cluster id: mountainsort label}
+    '''
+    ms_folder = ms_folder or os.path.dirname(os.path.abspath(phy_folder))
+    firings = read_firings(os.path.join(ms_folder, 'firings_raw.mda'))
+    if spike_clusters is None:
+        spike_clusters = np.load(os.path.join(phy_folder, 'spike_clusters.npy'),
+                                 mmap_mode='r').ravel()
+    order = spike_order(phy_folder, firings, chunk_size)
+    lookup, labels = cluster_labels(phy_folder, keep_noise, spike_clusters,
+                                    groups)
+
+    def chunk_labels(start, stop):
+        clusters = np.array(spike_clusters[start:stop])
+        if order is not None:
+            columns, spikes = order
+            first, last = np.searchsorted(columns, [start, stop])
+            clusters[columns[first:last] - start] = spike_clusters[spikes[first:last]]
+        return lookup[clusters]
+
+    # Count first, so the header can go out before the body
+    num_spikes = sum(np.count_nonzero(chunk_labels(start, start + chunk_size))
+                     for start in range(0, firings.shape[1], chunk_size))
+    dims = (firings.shape[0], num_spikes)
+
+    filename = os.path.join(ms_folder, 'firings.mda')
+    with open(filename + '.tmp', 'wb') as F:
+        F.write(mdaio.header_bytes('float64', dims))
+        for start in range(0, firings.shape[1], chunk_size):
+            stop = min(start + chunk_size, firings.shape[1])
+            new_labels = chunk_labels(start, stop)
+            keep = new_labels > 0
+            # (spikes x rows) in C order is the column-major (rows x spikes)
+            block = np.array(firings[:, start:stop].T, dtype='float64')
+            block[:, 2] = new_labels
+            block[keep].tofile(F)
+    os.replace(filename + '.tmp', filename)
+    return labels
+
+def metrics_json(phy_folder:str, labels:dict, ms_folder=None, groups=None,
+                 fields=None):
+    '''
+    Write metrics_curated.json for the curated clusters
+
+    Clusters phy left untouched keep the metrics of their mountainsort
+    cluster in metrics_tagged.json; merged or split clusters get empty
+    metrics. Tags combine the original tags with the phy group. groups
+    defaults to phy's cluster_group.tsv; fields ({name: {cluster id:
+    value}}, other phy cluster labels) are added as phy_<name> metrics.
+    '''
+    ms_folder = ms_folder or os.path.dirname(os.path.abspath(phy_folder))
+    if groups is None:
+        groups = read_tsv(os.path.join(phy_folder, 'cluster_group.tsv'), 'group')
+    fields = fields or {}
+    template_units = unit_ids(read_firings(os.path.join(ms_folder,
+                                                        'firings_raw.mda')))
+
+    original = {}
+    tagged_file = os.path.join(ms_folder, 'metrics_tagged.json')
+    if os.path.exists(tagged_file):
+        with open(tagged_file, 'r') as F:
+            original = {elem['label']: elem for elem in json.load(F)['clusters']}
+
+    clusters = []
+    for cluster_id, label in sorted(labels.items(), key=lambda x: x[1]):
+        # phy never reuses ids, so an id below the template count is a
+        # cluster that was neither merged nor split (split children inherit
+        # their parent's labels, so those cannot tell)
+        source = (original.get(int(template_units[cluster_id]), {})
+                  if cluster_id < len(template_units) else {})
+        tags = [tag for tag in source.get('tags', [])
+                if tag not in ('accepted', 'rejected', 'mua')]
+        tags += GROUP_TAGS.get(groups.get(cluster_id, 'unsorted'), [])
+        clusters.append(dict(label=label,
+                             metrics=dict(source.get('metrics', {}),
+                                          phy_cluster_id=cluster_id,
+                                          **{f'phy_{name}': values[cluster_id]
+                                             for name, values in fields.items()
+                                             if cluster_id in values}),
+                             tags=tags))
+
+    filename = os.path.join(ms_folder, 'metrics_curated.json')
+    with open(filename + '.tmp', 'w') as F:
+        json.dump(dict(clusters=clusters), F, indent=2)
+    os.replace(filename + '.tmp', filename)
+
+def phy_to_mountainsort(folder:str, keep_noise=False):
+    '''
+    Convert one curated phy folder back to firings.mda/metrics_curated.json
+    in the mountainsort folder above it
+    '''
+    labels = firings_mda(folder, keep_noise=keep_noise)
+    metrics_json(folder, labels)
+    return labels
+
+# -------------------
+# Curation change log
+# -------------------
+# MSCurationSave (plugins/MSclusterPlugins.py) appends one json line per phy
+# save to this file of the mountainsort folder (save time, number of spikes
+# that moved cluster, changed groups and labels), instead of rewriting
+# firings.mda and metrics_curated.json each time. The log is a dirty marker
+# with a short journal of the saves, it is never read back : phy writes its
+# own files on every save, and compaction rebuilds the mountainsort files
+# from those (or the plugin's in-memory copy of the same state), then drops
+# the logs it covers. A log still present means the mountainsort files are
+# behind phy's own files.
+CHANGE_LOG = 'curation_changes.log'
+
+def append_changes(ms_folder:str, num_spikes:int, groups=None, fields=None):
+    '''
+    Append one save's line to the change log : number of spikes that moved
+    cluster, {cluster id: group} and {label name: {cluster id: value}} that
+    changed
+    '''
+    record = dict(time=time.time(), num_spikes=int(num_spikes),
+                  groups={str(c): g for c, g in (groups or {}).items()},
+                  fields={name: {str(c): v for c, v in values.items()}
+                          for name, values in (fields or {}).items()})
+    with open(os.path.join(ms_folder, CHANGE_LOG), 'a') as F:
+        F.write(json.dumps(record) + '\n')
+
+def change_logs(ms_folder:str):
+    '''
+    Logs holding records not compacted yet, oldest first : those sealed by
+    an unfinished compaction, then the current one
+    '''
+    logs = sorted(glob.glob(os.path.join(ms_folder, CHANGE_LOG + '.*.compacting')))
+    current = os.path.join(ms_folder, CHANGE_LOG)
+    return logs + ([current] if os.path.exists(current) else [])
+
+def seal_changes(ms_folder:str):
+    '''
+    Set the current log aside for a compaction (later saves start a new
+    one). Returns every log the compaction covers.
+    '''
+    current = os.path.join(ms_folder, CHANGE_LOG)
+    if os.path.exists(current):
+        os.rename(current, f'{current}.{time.time_ns()}.compacting')
+    return [log for log in change_logs(ms_folder) if log != current]
+
+def compact_changes(phy_folder:str, ms_folder=None, keep_noise=False,
+                    spike_clusters=None, groups=None, fields=None,
+                    logs=None):
+    '''
+    Rewrite firings.mda and metrics_curated.json (each through a rename)
+    from the curation state, then drop the change logs it covers (logs,
+    default : seal the current log now). The state defaults to the files
+    phy saved in phy_folder, which hold every save of the logs.
+    '''
+    ms_folder = ms_folder or os.path.dirname(os.path.abspath(phy_folder))
+    if logs is None:
+        logs = seal_changes(ms_folder)
+    labels = firings_mda(phy_folder, ms_folder, keep_noise=keep_noise,
+                         spike_clusters=spike_clusters, groups=groups)
+    metrics_json(phy_folder, labels, ms_folder, groups=groups, fields=fields)
+    for log in logs:
+        os.remove(log)
+    return labels
+
+def phy_to_mountainsort_session(parent_path:str, n_workers=None,
+                                keep_noise=False):
+    '''
+    Convert every ntXX.mountain/phy folder under parent_path in parallel
+
+    Returns
+    -------
+    {phy folder: error string} for the folders that failed
+    '''
+    folders = [os.path.join(parent_path, folder, 'phy')
+               for folder in sorted(os.listdir(parent_path))]
+    folders = [folder for folder in folders
+               if os.path.exists(os.path.join(folder, 'params.py'))]
+    errors = {}
+    with ProcessPoolExecutor(max_workers=n_workers) as pool:
+        futures = {pool.submit(phy_to_mountainsort, folder, keep_noise): folder
+                   for folder in folders}
+        for future in as_completed(futures):
+            try:
+                future.result()
+            except Exception as E:
+                errors[futures[future]] = repr(E)
+    return errors
 
 
 if __name__ == "__main__":
 
     import argparse
     parse = argparse.ArgumentParser(prog="phy to mountainsort",
-                                    desc='converts phy clustered data back to'
-                                         'types expected by mountainsort',
+                                    description='converts phy clustered data '
+                                                'back to types expected by '
+                                                'mountainsort',
                                     usage="phy_to_mountainsort {folder}")
-    parse.add_argument("folder", default="", type=str,
+    parse.add_argument("folder", default="", type=str, nargs="?",
                        help="the phy folder path -- assumes mountainsort "
-                            "files live a folder above")
+                            "files live a folder above. A .mountain folder "
+                            "converts every tetrode under it.")
+    parse.add_argument("--workers", default=None, type=int,
+                       help="tetrodes to convert at once in batch mode")
+    parse.add_argument("--keep-noise", action="store_true",
+                       help="keep clusters labeled noise in firings.mda")
+    parse.add_argument("--compact", action="store_true",
+                       help="only bring the mountainsort files up to date "
+                            "with phy's saves when the curation change log "
+                            "says they are behind (no-op otherwise)")
     Opt = parse.parse_args()
 
     if Opt.folder == "" or Opt.folder == "pwd":
         Opt.folder = os.getcwd()
+
+    if Opt.compact:
+        if change_logs(os.path.dirname(os.path.abspath(Opt.folder))):
+            compact_changes(Opt.folder, keep_noise=Opt.keep_noise)
+    elif os.path.exists(os.path.join(Opt.folder, 'params.py')):
+        phy_to_mountainsort(Opt.folder, keep_noise=Opt.keep_noise)
+    else:
+        errors = phy_to_mountainsort_session(Opt.folder, Opt.workers,
+                                             keep_noise=Opt.keep_noise)
+        for folder, message in errors.items():
+            print(f"{folder}: {message}")
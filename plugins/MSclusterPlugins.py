@@ -5,33 +5,74 @@
 #
 # Then open ~/.phy/phy_config.py and add this line:
 # c.TemplateGUI.plugins = ['MSCurationTagsPlugin']
+#
+# MSCurationSave also needs phy_to_mountainsort.py : symlink this file from
+# the repository instead of copying it, or put the repository on PYTHONPATH.
 
 import numpy as np
-from phy import IPlugin
+from phy import IPlugin, connect
 import json
+import logging
 import os
+import sys
+import threading
+import time
 import pandas as pd
 
+logger = logging.getLogger('phy')
+
+def knn_fraction(A, B, n_neighbors=6):
+    '''
+    Fraction of the n_neighbors nearest neighbours of the rows of A, searched
+    among the rows of A and B, that are rows of A (brute force, vectorized)
+    '''
+    A = A.reshape(len(A), -1).astype(np.float32)
+    B = B.reshape(len(B), -1).astype(np.float32)
+    Z = np.concatenate([A, B])
+    n_neighbors = min(n_neighbors, len(Z) - 1)
+    if len(A) == 0 or n_neighbors < 1:
+        return np.nan
+    sq = np.einsum('ij,ij->i', Z, Z)
+    D = sq[:len(A), None] + sq[None, :] - 2 * (A @ Z.T)
+    D[np.arange(len(A)), np.arange(len(A))] = np.inf
+    nearest = np.argpartition(D, n_neighbors - 1, axis=1)[:, :n_neighbors]
+    return float(np.mean(nearest < len(A)))
+
 class MSCurationTagsPlugin(IPlugin):
     '''
     Adds mountainsort curation tags statically to phy
     table at the beginning of execution.
 
-    TODO
-    ----
-    Dynamically recompute metrics when clusters merge or split
+    Clusters created by a merge or split in phy are not in the mountainsort
+    metrics; their metrics are recomputed (see recomputed_metrics) from the
+    waveforms of the new cluster, and memoized on disk in phy's .phy folder.
     '''
 
-    def __init__(self, remove_redundant_labels=True, ryan_preferred=True):
+    # Metrics that can be recomputed for clusters created in phy
+    recomputed_metrics = ('num_events', 'firing_rate', 't1_sec', 't2_sec',
+                          'dur_sec', 'peak_amp', 'peak_snr', 'isolation',
+                          'noise_overlap')
+
+    def __init__(self, remove_redundant_labels=True, ryan_preferred=True,
+                 max_spikes=1000, n_neighbors=6, n_noise_clips=1000):
         self.remove_redundant_labels = remove_redundant_labels
         self.ryan_preferred = ryan_preferred
+        self.max_spikes = max_spikes
+        self.n_neighbors = n_neighbors
+        self.n_noise_clips = n_noise_clips
+        self.controller = None
+        self.recomputed = {}
+        self.validated = set()
+        self._noise = None
 
     def attach_to_controller(self, controller):
         """Note that this function is called at initialization time, *before*
         the supervisor is created. The `controller.cluster_metrics` items are
         then passed to the supervisor when constructing it."""
 
+        self.controller = controller
         self.get_metric_table(controller=controller)
+        self.load_recomputed()
         metrics = self.list_metric_names(remove_redundant_labels=self.remove_redundant_labels, ryan_preferred=self.ryan_preferred)
         metrics = self.order_metric_names(metrics)
         # Use this dictionary to define custom cluster metrics.  We memcache
@@ -44,10 +85,27 @@ class MSCurationTagsPlugin(IPlugin):
             controller.cluster_metrics[('ms\n' + metric).replace('_','\n')] = \
                 self.get_cluster_lambda(metric)
 
+        @connect
+        def on_cluster(sender, up):
+            # Only the clusters a merge/split created need new metrics
+            added = [cluster_id for cluster_id in getattr(up, 'added', [])
+                     if not self.is_known(cluster_id)]
+            for cluster_id in added:
+                self.recompute_cluster(cluster_id)
+            if added:
+                self.save_recomputed()
+
+    # Binary sidecar of the parsed metric table, next to the json
+    metric_cache_suffix = '.cache.npz'
+
     def get_metric_table(self, json_filename=None, controller=None,
                          adjust_index_by_order=True):
         '''
         Parse a json to obtain cluster metric table
+
+        The parsed table is cached next to the json (metric_cache_suffix),
+        keyed on the json's size and mtime, so reopening phy on the same
+        tetrode skips the parse.
         '''
 
         if json_filename is None:
@@ -59,71 +117,301 @@ class MSCurationTagsPlugin(IPlugin):
         if not os.path.exists(json_filename):
             raise FileExistsError(f"{json_filename} does not exist!")
 
-        with open(json_filename,'r') as F:
-            J = json.load(F)
+        stat = os.stat(json_filename)
+        key = np.array([stat.st_size, stat.st_mtime_ns, int(adjust_index_by_order)],
+                       dtype=np.int64)
+        cache_filename = os.path.splitext(json_filename)[0] + self.metric_cache_suffix
 
-        clusters = J['clusters']
+        df = self.load_metric_cache(cache_filename, key)
+        if df is None:
+            df = self.parse_metric_json(json_filename, adjust_index_by_order)
+            self.save_metric_cache(cache_filename, key, df)
 
-        df = pd.DataFrame()
-        for i, elem in enumerate(clusters):
+        self.df = df
+        self.build_metric_arrays()
 
-            label = elem['label']
-            metrics = pd.DataFrame.from_dict(elem['metrics'], orient='index').T
-            metrics.index = pd.Index([label], name='id')
-            if len(elem['tags']) == 0:
-                tags = ''
+    def build_metric_arrays(self):
+        '''
+        Lay every metric column out as a dense array indexed by cluster id,
+        so the cluster view's lookups are plain array indexing. self.known
+        marks the ids present in the table; other slots hold NaN.
+        '''
+        cluster_ids = self.df.index.to_numpy().astype(np.int64)
+        size = cluster_ids.max() + 1 if len(cluster_ids) else 0
+        self.known = np.zeros(size, dtype=bool)
+        self.known[cluster_ids] = True
+        self.metric_arrays = {}
+        # Integer columns are stored as float (for the NaN fill) and handed
+        # back as int
+        self.integer_metrics = set()
+        for metric in self.df.columns:
+            values = self.df[metric].to_numpy()
+            if values.dtype.kind in 'biu':
+                self.integer_metrics.add(metric)
+            if values.dtype.kind in 'biuf':
+                array = np.full(size, np.nan)
             else:
-                tags = str(elem['tags'] if len(elem['tags'])!=1 else elem['tags'][0])
-            metrics = metrics.assign(tags=tags)
+                array = np.full(size, np.nan, dtype=object)
+            array[cluster_ids] = values
+            self.metric_arrays[metric] = array
 
-            if i > 0:
-                df = df.append(metrics)
-            else:
-                df = metrics
+    def is_known(self, cluster_id):
+        return 0 <= cluster_id < len(self.known) and self.known[cluster_id]
+
+    @staticmethod
+    def parse_metric_json(json_filename:str, adjust_index_by_order=True):
+        '''
+        Build the metric table column by column in a single pass over the
+        json clusters
+        '''
+
+        with open(json_filename,'r') as F:
+            J = json.load(F)
+
+        clusters = J['clusters']
+
+        # Union of the metric names, in the order they first appear
+        names = {}
+        for elem in clusters:
+            names.update(dict.fromkeys(elem['metrics']))
+        columns = {name: [elem['metrics'].get(name, np.nan) for elem in clusters]
+                   for name in names}
+        columns['tags'] = ['' if len(elem['tags']) == 0 else
+                           str(elem['tags'] if len(elem['tags']) != 1
+                               else elem['tags'][0])
+                           for elem in clusters]
+        df = pd.DataFrame(columns,
+                          index=pd.Index([elem['label'] for elem in clusters],
+                                         name='id'))
 
         if adjust_index_by_order:
 
             df.sort_index(inplace=True)
-            old_index = df.index
-            new_index = tuple(pd.Index(range(df.shape[0]),
-                              name="label"))
-            lookup = pd.Series(index=old_index, data=new_index)
-            lookup.loc[0] = -1
-            df.loc[:, 'old_ms_id'] = old_index
-            df.loc[:, 'old(overl,burst)'] = df.loc[:,'overlap_cluster'].astype("str") + ", " + df.loc[:,'bursting_parent'].astype("str")
-            df.loc[:, 'overlap_cluster'] = lookup.loc[df.overlap_cluster.astype('int')].values
-            df.loc[:, 'bursting_parent'] = lookup.loc[df.bursting_parent.astype('int')].values
-            df.index = new_index
+            old_index = df.index.values.astype(np.int64)
+            new_index = np.arange(df.shape[0])
 
-        self.df = df
+            # Vectorized old label -> new label lookup; label 0 (none) and
+            # unknown labels map to -1
+            def lookup(labels):
+                labels = np.asarray(labels).astype(np.int64)
+                pos = np.clip(np.searchsorted(old_index, labels), 0,
+                              max(len(old_index) - 1, 0))
+                found = (old_index[pos] == labels) & (labels != 0)
+                return np.where(found, new_index[pos], -1)
+
+            df['old_ms_id'] = old_index
+            df['old(overl,burst)'] = df['overlap_cluster'].astype("str") + ", " + df['bursting_parent'].astype("str")
+            df['overlap_cluster'] = lookup(df['overlap_cluster'])
+            df['bursting_parent'] = lookup(df['bursting_parent'])
+            df.index = pd.Index(new_index)
+
+        return df
+
+    @staticmethod
+    def load_metric_cache(cache_filename:str, key):
+        '''
+        The cached table, or None if missing or made from another json
+        '''
+        if not os.path.exists(cache_filename):
+            return None
+        try:
+            with np.load(cache_filename, allow_pickle=False) as cache:
+                if not np.array_equal(cache['__key__'], key):
+                    return None
+                columns = [str(name) for name in cache['__columns__']]
+                df = pd.DataFrame({name: cache['column_%d' % i]
+                                   for i, name in enumerate(columns)},
+                                  index=pd.Index(cache['__index__'],
+                                                 name=str(cache['__index_name__'])
+                                                 or None))
+        except (OSError, ValueError, KeyError):
+            return None
+        return df
+
+    @staticmethod
+    def save_metric_cache(cache_filename:str, key, df):
+        arrays = {'column_%d' % i: df[name].to_numpy() for i, name in
+                  enumerate(df.columns)}
+        # Text columns are stored as fixed width unicode, no pickling
+        arrays = {name: values.astype(str) if values.dtype == object else values
+                  for name, values in arrays.items()}
+        try:
+            with open(cache_filename, 'wb') as F:
+                np.savez(F, __key__=key,
+                         __columns__=np.array(df.columns, dtype=str),
+                         __index__=df.index.to_numpy(),
+                         __index_name__=np.array(df.index.name or ''),
+                         **arrays)
+        except OSError:
+            # Read-only session folders just don't get a cache
+            pass
 
     def get_cluster_metric(self, cluster_id:int, metric:str, obj=None):
         '''
         Obtain a metric at a cluster id
         '''
 
-        if cluster_id in self.df.index:
-            return self.df.loc[cluster_id][metric]
+        if self.is_known(cluster_id):
+            value = self.metric_arrays[metric][cluster_id]
+            return int(value) if metric in self.integer_metrics else value
         else:
-            return np.nan
+            return self.get_recomputed_metric(cluster_id, metric)
+
+    def get_cluster_metrics(self, metric:str, cluster_ids):
+        '''
+        Batch version of get_cluster_metric : the metric for many cluster ids
+        in one vectorized lookup (only ids created in phy are looked up one
+        by one, through the recomputed metrics)
+        '''
+        cluster_ids = np.asarray(cluster_ids, dtype=np.int64)
+        values = self.metric_arrays[metric]
+        inside = (cluster_ids >= 0) & (cluster_ids < len(self.known))
+        known = np.zeros(len(cluster_ids), dtype=bool)
+        known[inside] = self.known[cluster_ids[inside]]
 
+        out = np.full(len(cluster_ids), np.nan, dtype=values.dtype)
+        out[known] = values[cluster_ids[known]]
+        for i in np.flatnonzero(~known):
+            out[i] = self.get_recomputed_metric(cluster_ids[i], metric)
+        return out
 
     def get_cluster_lambda(self, metric:str):
         '''
         reeturna  lambda function that reports the value of a metric for a cluster id
         '''
 
-        df = self.df[metric]
+        values, known = self.metric_arrays[metric], self.known
+        if metric in self.integer_metrics:
+            values = values.tolist()
+            values = [int(v) if v == v else v for v in values]
 
-        def func(cluster_id, df=df):
-            if cluster_id in df.index:
-                return df.loc[cluster_id]
+        def func(cluster_id, values=values, known=known):
+            if 0 <= cluster_id < len(known) and known[cluster_id]:
+                return values[cluster_id]
             else:
-                # TODO, if not found, then reccompute cluster metrics; user may
-                # have merged or split a cluster
-                return np.nan
+                # User merged or split a cluster
+                return self.get_recomputed_metric(cluster_id, metric)
         return func
 
+    # ------------------------------------------------
+    # Metrics of clusters created by merges and splits
+    # ------------------------------------------------
+    def _spike_ids(self, cluster_id):
+        spc = self.controller.supervisor.clustering.spikes_per_cluster
+        return np.asarray(spc.get(cluster_id, []), dtype=np.int64)
+
+    @staticmethod
+    def _signature(spike_ids):
+        '''
+        Cheap check that a memoized cluster id still holds the same spikes
+        (phy may hand out the id of an undone cluster again)
+        '''
+        return [int(len(spike_ids)), int(spike_ids.sum())]
+
+    def get_recomputed_metric(self, cluster_id, metric:str):
+        if metric not in self.recomputed_metrics or self.controller is None:
+            return np.nan
+        cluster_id = int(cluster_id)
+        entry = self.recomputed.get(cluster_id)
+        if entry is not None and cluster_id not in self.validated:
+            if entry['signature'] != self._signature(self._spike_ids(cluster_id)):
+                entry = None
+        if entry is None:
+            entry = self.recompute_cluster(cluster_id)
+            self.save_recomputed()
+        self.validated.add(cluster_id)
+        return entry['metrics'].get(metric, np.nan)
+
+    def noise_clips(self):
+        '''
+        Random snippets of the recording (n_clips, n_samples, n_channels),
+        drawn once per session; None without a recording
+        '''
+        model = self.controller.model
+        if self._noise is None and getattr(model, 'traces', None) is not None:
+            n_samples = model.n_samples_waveforms
+            rng = np.random.default_rng(0)
+            starts = rng.integers(0, model.traces.shape[0] - n_samples,
+                                  self.n_noise_clips)
+            self._noise = np.stack([np.asarray(model.traces[start:start + n_samples])
+                                    for start in np.sort(starts)]).astype(np.float32)
+        return self._noise
+
+    def recompute_cluster(self, cluster_id:int):
+        '''
+        MountainSort-style metrics of one cluster from a subsample of its
+        waveforms on its best channels:
+            peak_snr      : template peak over the MAD noise of that channel
+            isolation     : fraction of nearest neighbours (cluster vs
+                            background spikes) that belong to the cluster
+            noise_overlap : fraction of nearest neighbours that are noise clips
+        '''
+        controller, model = self.controller, self.controller.model
+        spike_ids = self._spike_ids(cluster_id)
+        n_spikes = len(spike_ids)
+        metrics = dict.fromkeys(self.recomputed_metrics, np.nan)
+        if n_spikes:
+            times = model.spike_times[spike_ids]
+            metrics.update(num_events=n_spikes,
+                           firing_rate=n_spikes / max(model.duration, 1e-9),
+                           t1_sec=float(times.min()), t2_sec=float(times.max()),
+                           dur_sec=float(times.max() - times.min()))
+
+            sample = np.unique(spike_ids[np.linspace(0, n_spikes - 1,
+                                                     min(n_spikes, self.max_spikes)
+                                                     ).astype(np.int64)])
+            channel_ids = np.asarray(controller.get_best_channels(cluster_id))
+            waveforms = model.get_waveforms(sample, channel_ids)
+            if waveforms is not None:
+                waveforms = np.asarray(waveforms, dtype=np.float32)
+                template = waveforms.mean(axis=0)
+                t, c = np.unravel_index(np.argmax(np.abs(template)), template.shape)
+                peak_amp = float(np.abs(template[t, c]))
+
+                noise = self.noise_clips()
+                if noise is not None:
+                    noise = noise[:, :, channel_ids]
+                    channel = noise[:, :, c]
+                    sigma = 1.4826 * np.median(np.abs(channel - np.median(channel)))
+                else:
+                    sigma = waveforms[:, t, c].std()
+
+                background = controller.get_background_spike_ids(n=2 * len(sample))
+                background = np.setdiff1d(background, spike_ids)[:len(sample)]
+                others = model.get_waveforms(background, channel_ids)
+
+                metrics.update(peak_amp=peak_amp,
+                               peak_snr=peak_amp / sigma if sigma > 0 else np.nan)
+                if others is not None and len(background):
+                    metrics['isolation'] = knn_fraction(waveforms, others,
+                                                        self.n_neighbors)
+                if noise is not None:
+                    metrics['noise_overlap'] = 1 - knn_fraction(waveforms,
+                                                                noise[:len(sample)],
+                                                                self.n_neighbors)
+
+        entry = dict(signature=self._signature(spike_ids),
+                     metrics={key: (None if value is None else float(value))
+                              for key, value in metrics.items()})
+        self.recomputed[int(cluster_id)] = entry
+        self.validated.add(int(cluster_id))
+        return entry
+
+    def load_recomputed(self):
+        '''
+        Load the metrics memoized in earlier sessions (.phy/ms_metrics.json)
+        '''
+        context = getattr(self.controller, 'context', None)
+        stored = context.load('ms_metrics') if context is not None else None
+        self.recomputed = {int(cluster_id): entry
+                           for cluster_id, entry in (stored or {}).items()}
+
+    def save_recomputed(self):
+        context = getattr(self.controller, 'context', None)
+        if context is not None:
+            context.save('ms_metrics', {str(cluster_id): entry for cluster_id, entry
+                                        in self.recomputed.items()}, kind='json')
+
     def list_metric_names(self, remove_redundant_labels=False, ryan_preferred=False):
         metric_list = list(self.df.columns)
         if remove_redundant_labels:
@@ -158,12 +446,155 @@ class TetrodeMetrics(IPlugin):
     from phy import IPlugin
     pass
 
+def load_converter():
+    '''
+    phy_to_mountainsort, from the repository this file lives in (when
+    symlinked into ~/.phy/plugins) or from the python path; None if missing
+    '''
+    repository = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+    if (os.path.exists(os.path.join(repository, 'phy_to_mountainsort.py'))
+            and repository not in sys.path):
+        sys.path.append(repository)
+    try:
+        import phy_to_mountainsort
+    except ImportError:
+        return None
+    return phy_to_mountainsort
+
 class MSCurationSave(IPlugin):
     '''
     Whenever a save event is emitted, save the state of the cluster
     tags to mountainsort files
+
+    A save only appends a line to the change log of the mountainsort folder
+    (see phy_to_mountainsort.CHANGE_LOG), marking its files as behind. Every
+    compact_every saves or compact_interval seconds, and when phy closes,
+    firings.mda and metrics_curated.json are rewritten from the curation
+    state in a background thread. A failed compaction is logged, and shown
+    in the status bar on the next save.
     '''
-    from phy import IPlugin
-    pass
+
+    compact_every = 10       # Saves between two compactions
+    compact_interval = 300.  # Seconds between two compactions
+    keep_noise = False       # Keep the noise clusters in firings.mda
+
+    def attach_to_controller(self, controller):
+        self.converter = load_converter()
+        if self.converter is None:
+            logger.warning("MSCurationSave: phy_to_mountainsort not found, "
+                           "curation is not saved to mountainsort")
+            return
+        self.phy_folder = os.path.abspath(os.path.expanduser(controller.dir_path))
+        self.ms_folder = os.path.dirname(self.phy_folder)
+        self.lock = threading.Lock()
+        self.thread = None
+
+        # The curation state as of the last save
+        model = controller.model
+        metadata = getattr(model, 'metadata', {}) or {}
+        self.saved = np.array(model.spike_clusters, dtype=np.int64).ravel()
+        self.groups = {int(c): g for c, g in metadata.get('group', {}).items()}
+        self.fields = {name: {int(c): v for c, v in values.items()}
+                       for name, values in metadata.items() if name != 'group'}
+        self.saves = 0
+        self.compacted = time.time()
+        # Error of the last compaction, if it failed, and the GUI to show it in
+        self.failure = None
+        self.gui = None
+
+        # Saves of an earlier session that were never compacted (phy crashed)
+        if self.converter.change_logs(self.ms_folder):
+            self.compact()
+
+        @connect
+        def on_save_clustering(sender, spike_clusters, groups, *labels):
+            self.save(spike_clusters, groups, dict(labels))
+
+        @connect(event='gui_ready')
+        def on_gui_ready(sender, gui):
+            self.gui = gui
+
+        @connect(event='close')
+        def on_close(sender):
+            self.close()
+
+    def save(self, spike_clusters, groups:dict, fields:dict):
+        '''
+        Log what changed since the last save, and compact if it is time to
+        '''
+        spike_clusters = np.asarray(spike_clusters).ravel()
+        with self.lock:
+            if len(spike_clusters) != len(self.saved):
+                self.saved = np.full(len(spike_clusters), -1, dtype=np.int64)
+            changed = np.flatnonzero(spike_clusters != self.saved)
+            group_changes = {int(c): g for c, g in groups.items()
+                             if self.groups.get(int(c)) != g}
+            field_changes = {}
+            for name, values in fields.items():
+                if name == 'group':
+                    continue
+                known = self.fields.setdefault(name, {})
+                delta = {int(c): v for c, v in values.items()
+                         if known.get(int(c)) != v}
+                if delta:
+                    field_changes[name] = delta
+            if self.failure is not None and self.gui is not None:
+                self.gui.status_message = (f"MSCurationSave: mountainsort files "
+                                           f"not updated, {self.failure}")
+            if not (len(changed) or group_changes or field_changes):
+                return
+            self.converter.append_changes(self.ms_folder, len(changed),
+                                          group_changes, field_changes)
+            self.saved[changed] = spike_clusters[changed]
+            self.groups.update(group_changes)
+            for name, delta in field_changes.items():
+                self.fields[name].update(delta)
+            self.saves += 1
+            due = (self.saves >= self.compact_every or
+                   time.time() - self.compacted >= self.compact_interval)
+        if due:
+            self.compact()
+
+    def compact(self, wait=False):
+        '''
+        Rewrite the mountainsort files from the state of the last save, in a
+        background thread (unless one is running already)
+        '''
+        with self.lock:
+            if self.thread is not None and self.thread.is_alive():
+                return
+            logs = self.converter.seal_changes(self.ms_folder)
+            if not logs:
+                return
+            state = dict(spike_clusters=self.saved.copy(),
+                         groups=dict(self.groups),
+                         fields={name: dict(values)
+                                 for name, values in self.fields.items()})
+            self.saves = 0
+            self.compacted = time.time()
+            self.thread = threading.Thread(target=self._compact,
+                                           args=(logs, state),
+                                           name='ms-compact')
+            self.thread.start()
+        if wait:
+            self.thread.join()
+
+    def _compact(self, logs, state):
+        try:
+            self.converter.compact_changes(self.phy_folder, self.ms_folder,
+                                           keep_noise=self.keep_noise,
+                                           logs=logs, **state)
+            self.failure = None
+        except Exception as E:
+            # The logs stay, the next compaction covers them
+            self.failure = repr(E)
+            logger.exception("MSCurationSave: compaction of %s failed",
+                             self.ms_folder)
+
+    def close(self):
+        # Fold in every save of this session before phy exits
+        if self.thread is not None:
+            self.thread.join()
+        self.compact(wait=True)
 
 
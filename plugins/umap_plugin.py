@@ -1,14 +1,285 @@
 # import from plugins/umap_view.py
 """Show how to write a custom dimension reduction view."""
 
+import hashlib
+import multiprocessing
+import os
+import runpy
+import sys
+import threading
+from collections import OrderedDict, namedtuple
+
+import numpy as np
 from phy import IPlugin, Bunch, connect
 from phy.cluster.views import ScatterView
+from phy.gui.qt import QObject, pyqtSignal
 
 
 class WaveformUMAPView(ScatterView):
     """Every view corresponds to a unique view class, so we need to subclass ScatterView."""
     pass
 
+class Cancelled(Exception):
+    """The UMAP computation was cancelled by a newer selection."""
+
+class ModelLost(Exception):
+    """The worker holding a fitted model was restarted since the fit."""
+
+# A model fitted and kept by a worker process : worker, the epoch (process
+# start) of that worker it was fitted in, and its id there
+ModelRef = namedtuple('ModelRef', ['worker', 'epoch', 'model_id'])
+
+def serve(connection, doGPU=True, nice=0):
+    '''
+    Worker process loop : ('fit', (data,), kws, forget) or ('transform',
+    (model_id, data), {}, forget) requests in, ('ok', result), ('lost',
+    None) or ('error', message) out. Fitted models stay here, by id, until
+    their id comes back in the forget list of a request.
+    '''
+    if nice and hasattr(os, 'nice'):
+        os.nice(nice)
+    # Import UMAP now, while the GUI gathers the features of the first call
+    WaveformUMAPPluginComplete.umap_class(doGPU)
+    models = {}
+    next_id = 0
+    while True:
+        try:
+            job = connection.recv()
+        except EOFError:
+            return
+        if job is None:
+            return
+        kind, args, kws, forget = job
+        for model_id in forget:
+            models.pop(model_id, None)
+        try:
+            if kind == 'fit':
+                model, pos = WaveformUMAPPluginComplete.umapfit(args[0], doGPU=doGPU, **kws)
+                models[next_id] = model
+                connection.send(('ok', (next_id, pos)))
+                next_id += 1
+            elif args[0] not in models:
+                connection.send(('lost', None))
+            else:
+                connection.send(('ok', models[args[0]].transform(args[1])))
+        except Exception as E:
+            connection.send(('error', repr(E)))
+
+class UMAPWorker:
+    '''
+    Runs UMAP fits and transforms one at a time in a separate process, so
+    the GUI never waits on them. Fitted models stay in the process and are
+    referred to by ModelRef. cancel() kills a running computation whose tag
+    is stale and starts a fresh process right away, which loses the models.
+
+    phy loads plugins from files outside sys.path, so the worker is spawned
+    running this file as a script (see the bottom of the file). nice lowers
+    the priority of the process (background work).
+    '''
+
+    def __init__(self, doGPU=True, nice=0):
+        self.doGPU = doGPU
+        self.nice = nice
+        self.process = None
+        self.connection = None
+        # Process starts so far, and the tag of the running call
+        self.epoch = 0
+        self.running = None
+        # Ids of models to free, sent with the next call
+        self.forgotten = []
+        self.busy = threading.Lock()
+        self.lock = threading.Lock()
+
+    def _start(self):
+        context = multiprocessing.get_context('spawn')
+        self.connection, child = context.Pipe()
+        self.process = context.Process(target=runpy.run_path, args=(__file__,),
+                                       kwargs=dict(run_name='__umap_worker__',
+                                                   init_globals=dict(worker_connection=child,
+                                                                     worker_gpu=self.doGPU,
+                                                                     worker_nice=self.nice)),
+                                       name='umap-worker', daemon=True)
+        self.process.start()
+        child.close()
+        self.epoch += 1
+        self.forgotten = []
+
+    def _call(self, kind, args, kws, cancelled, tag, epoch=None):
+        with self.busy:
+            with self.lock:
+                if cancelled is not None and cancelled():
+                    raise Cancelled()
+                if self.process is None or not self.process.is_alive():
+                    self._start()
+                if epoch is not None and epoch != self.epoch:
+                    raise ModelLost()
+                connection = self.connection
+                epoch = self.epoch
+                connection.send((kind, args, kws, self.forgotten))
+                self.forgotten = []
+                self.running = tag
+            try:
+                status, result = connection.recv()
+            except (EOFError, OSError):
+                raise Cancelled()
+            finally:
+                self.running = None
+        if status == 'error':
+            raise RuntimeError(result)
+        if status == 'lost':
+            raise ModelLost()
+        return epoch, result
+
+    def fit(self, data, cancelled=None, tag=None, **kws):
+        '''
+        Fit UMAP on data in the worker : (ModelRef, embedding of data).
+        Raises Cancelled if cancel() interrupted it, or if cancelled() is
+        true once it is this call's turn.
+        '''
+        epoch, (model_id, pos) = self._call('fit', (data,), kws, cancelled, tag)
+        return ModelRef(self, epoch, model_id), pos
+
+    def transform(self, model, data, cancelled=None, tag=None):
+        '''
+        Embedding of data by a model this worker fitted; raises ModelLost if
+        the worker was restarted since
+        '''
+        return self._call('transform', (model.model_id, data), {}, cancelled,
+                          tag, epoch=model.epoch)[1]
+
+    def forget(self, model):
+        '''
+        Free a fitted model (with the next call)
+        '''
+        with self.lock:
+            if model.epoch == self.epoch:
+                self.forgotten.append(model.model_id)
+
+    def cancel(self, stale):
+        '''
+        Kill the running tagged call if stale(its tag), and start the next process
+        at once so its imports overlap the next call's preparation
+        '''
+        with self.lock:
+            if (self.process is not None and self.running is not None
+                    and stale(self.running)):
+                self.process.terminate()
+                self.connection.close()
+                self._start()
+
+    def close(self):
+        with self.lock:
+            if self.process is not None:
+                self.process.terminate()
+                self.process = None
+
+class _Relay(QObject):
+    """Hands results computed in background threads to the GUI thread."""
+    ready = pyqtSignal(object)
+
+class UMAPEmbeddingStore:
+    '''
+    Embeddings of cluster selections, saved under folder, plus the UMAP
+    models fitted this session.
+
+    An embedding is keyed on the selected cluster set, the spike ids shown,
+    n_neighbors and the data version, so reselecting clusters reloads it
+    instead of rerunning UMAP. The last max_models fitted models are kept
+    (as ModelRef, the models stay in their worker) : a selection that adds
+    clusters to an already fitted set is projected with that model's
+    transform instead of a new fit.
+    '''
+
+    def __init__(self, folder:str, data_version:str, max_models=32):
+        self.folder = folder
+        self.data_version = data_version
+        self.max_models = max_models
+        self.embeddings = {}
+        self.models = OrderedDict()
+        self.lock = threading.Lock()
+        os.makedirs(folder, exist_ok=True)
+
+    def key(self, cluster_ids, spike_ids, n_neighbors):
+        return self.named_key(sorted(int(c) for c in cluster_ids), int(n_neighbors),
+                              spikes=spike_ids)
+
+    def named_key(self, *items, spikes=()):
+        '''
+        Key of any array derived from items (and spike ids) of this data version
+        '''
+        digest = hashlib.blake2b(digest_size=16)
+        digest.update(repr((items, self.data_version)).encode())
+        digest.update(np.ascontiguousarray(spikes, dtype=np.int64).tobytes())
+        return digest.hexdigest()
+
+    def get(self, key:str):
+        '''
+        The stored embedding, or None
+        '''
+        with self.lock:
+            if key in self.embeddings:
+                return self.embeddings[key]
+        filename = os.path.join(self.folder, key + '.npy')
+        if not os.path.exists(filename):
+            return None
+        try:
+            pos = np.load(filename, allow_pickle=False)
+        except (OSError, ValueError):
+            return None
+        with self.lock:
+            self.embeddings[key] = pos
+        return pos
+
+    def put(self, key:str, pos):
+        with self.lock:
+            self.embeddings[key] = pos
+        filename = os.path.join(self.folder, key + '.npy')
+        try:
+            with open(filename + '.tmp', 'wb') as F:
+                np.save(F, pos)
+            os.replace(filename + '.tmp', filename)
+        except OSError:
+            # Read-only cache folders only get the in-memory store
+            pass
+
+    def add_model(self, cluster_ids, n_neighbors, model, spike_ids, pos):
+        '''
+        Keep a fitted model (a ModelRef); returns the models evicted to make
+        room, for their worker to free
+        '''
+        order = np.argsort(spike_ids)
+        evicted = []
+        with self.lock:
+            self.models[(frozenset(int(c) for c in cluster_ids), int(n_neighbors))] = \
+                (model, np.asarray(spike_ids)[order], pos[order])
+            while len(self.models) > self.max_models:
+                evicted.append(self.models.popitem(last=False)[1][0])
+        return evicted
+
+    def drop_model(self, model):
+        '''
+        Forget a model whose worker lost it
+        '''
+        with self.lock:
+            for key in [key for key, fit in self.models.items() if fit[0] == model]:
+                del self.models[key]
+
+    def base_model(self, cluster_ids, n_neighbors):
+        '''
+        The fitted model whose cluster set is the largest subset of
+        cluster_ids : (model, sorted spike ids, their embedding) or None
+        '''
+        cluster_ids = frozenset(int(c) for c in cluster_ids)
+        with self.lock:
+            bases = [(len(key[0]), len(fit[1]), key)
+                     for key, fit in self.models.items()
+                     if key[1] == n_neighbors and key[0] <= cluster_ids]
+            if not bases:
+                return None
+            key = max(bases)[2]
+            self.models.move_to_end(key)
+            return self.models[key]
+
 class WaveformUMAPPluginComplete(IPlugin):
     '''
     This version of umap cluster plugin takes longer to run (exectues on all
@@ -16,16 +287,46 @@ class WaveformUMAPPluginComplete(IPlugin):
     cluster. More helpful than the quicker view.
     '''
 
-    def __init__(self, n_neighbors=15, spike_count=None, batch_size=50):
+    # Bump when the features fed to UMAP change, to invalidate stored embeddings
+    feature_version = 2
+
+    def __init__(self, n_neighbors=15, spike_count=None, batch_size=50,
+                 quick_spike_count=2000, feature_dims=10, feature_batch=10000,
+                 basis_spikes=20000):
         self.n_neighbors = n_neighbors
         self.spike_count = spike_count
         self.batch_size = 50
+        self.quick_spike_count = quick_spike_count
+        # Waveforms are read feature_batch spikes at a time and projected on
+        # feature_dims principal components (None : no projection), fitted
+        # once per dataset on basis_spikes random spikes
+        self.feature_dims = feature_dims
+        self.feature_batch = feature_batch
+        self.basis_spikes = basis_spikes
+        self.basis = None
+        self._basis_lock = threading.Lock()
+        self.store = None
+        # Selections and background caching each get their own worker, so
+        # a new selection never kills the caching, which runs niced
+        self.worker = UMAPWorker()
+        self.cache_worker = UMAPWorker(nice=10)
+        self.views = []
+        # Current selection, and the generation stamped on its background work
+        self.selection = None
+        self.generation = 0
+        self._stop = threading.Event()
+        # Set while no selection is being computed (background caching yields)
+        self._idle = threading.Event()
+        self._idle.set()
 
     @staticmethod
     def umapfunc(x, doGPU=True, **kws):
         """Perform the dimension reduction of the array x."""
-        import sys
+        return WaveformUMAPPluginComplete.umapfit(x, doGPU=doGPU, **kws)[1]
 
+    @staticmethod
+    def umap_class(doGPU=True):
+        """The UMAP class : cuml's with doGPU if it is installed, else umap-learn's."""
         # Attempt to grab the GPU version
         if doGPU:
             try:
@@ -36,42 +337,215 @@ class WaveformUMAPPluginComplete(IPlugin):
                 from umap import UMAP
         else:
             from umap import UMAP
-        return UMAP(**kws).fit_transform(x)
+        return UMAP
+
+    @staticmethod
+    def umapfit(x, doGPU=True, **kws):
+        """Fit UMAP on the array x; return the model and the embedding of x."""
+        model = WaveformUMAPPluginComplete.umap_class(doGPU)(**kws)
+        return model, model.fit_transform(x)
+
+    def data_version(self, controller):
+        '''
+        Identity of the spikes and waveforms the embeddings are computed from
+        '''
+        model = controller.model
+        paths = [os.path.join(model.dir_path, 'spike_times.npy')]
+        paths += [str(path) for path in (getattr(model, 'dat_path', None) or [])]
+        stats = [(os.path.basename(path), os.stat(path).st_size,
+                  os.stat(path).st_mtime_ns)
+                 for path in paths if os.path.exists(path)]
+        return repr((stats, model.n_samples_waveforms, model.n_channels,
+                     self.feature_version, self.feature_dims))
+
+    @staticmethod
+    def raw_features(controller, spike_ids):
+        """Waveforms of spike_ids on all channels, as float32 (n_spikes, n_features)."""
+        # Across all channels so that we use the same dimensions for every cluster.
+        # Any fixed feature order will do, so no transpose (and no copy).
+        data = controller.model.get_waveforms(spike_ids, None)
+        return data.reshape((len(data), -1)).astype(np.float32, copy=False)
+
+    def feature_basis(self, controller):
+        '''
+        (mean, components) of the projection applied to the waveforms, fitted
+        with IncrementalPCA on basis_spikes random spikes of the dataset and
+        kept in the store. Shared by every selection, so features of
+        different selections live in the same space (needed to transform
+        with a model fitted on other clusters).
+        '''
+        with self._basis_lock:
+            if self.basis is not None:
+                return self.basis
+            key = self.store.named_key('basis', self.feature_dims, self.basis_spikes)
+            basis = self.store.get(key)
+            if basis is None:
+                from sklearn.decomposition import IncrementalPCA
+                n_spikes = controller.model.n_spikes
+                rng = np.random.default_rng(0)
+                spike_ids = np.sort(rng.choice(n_spikes, min(self.basis_spikes, n_spikes),
+                                               replace=False))
+                pca = IncrementalPCA(n_components=min(self.feature_dims, len(spike_ids)))
+                batch = max(self.feature_batch, self.feature_dims)
+                for start in range(0, len(spike_ids), batch):
+                    data = self.raw_features(controller, spike_ids[start:start + batch])
+                    if len(data) >= pca.n_components:
+                        pca.partial_fit(data)
+                # Row 0 is the mean, the others the components
+                basis = np.vstack([pca.mean_, pca.components_]).astype(np.float32)
+                self.store.put(key, basis)
+            self.basis = (basis[0], basis[1:])
+            return self.basis
+
+    def waveform_features(self, controller, spike_ids):
+        '''
+        Features UMAP runs on : the waveforms of spike_ids read in batches of
+        feature_batch spikes, each projected on the feature basis, as float32
+        (n_spikes, feature_dims)
+        '''
+        if self.feature_dims is None:
+            return self.raw_features(controller, spike_ids)
+        mean, components = self.feature_basis(controller)
+        features = np.empty((len(spike_ids), len(components)), dtype=np.float32)
+        for start in range(0, len(spike_ids), self.feature_batch):
+            stop = start + self.feature_batch
+            data = self.raw_features(controller, spike_ids[start:stop])
+            features[start:stop] = (data - mean) @ components.T
+        return features
+
+    def embed(self, controller, cluster_ids, spike_ids, keep_model=True,
+              cancelled=None, worker=None, tag=None):
+        '''
+        UMAP embedding of spike_ids (drawn from cluster_ids) : from the store
+        if present, else projected with a model fitted on a subset of the
+        clusters (in the worker holding it), else fitted from scratch in
+        worker (default the selection worker) under tag. cancelled is checked
+        before the UMAP work starts.
+        '''
+        worker = worker or self.worker
+        key = self.store.key(cluster_ids, spike_ids, self.n_neighbors)
+        pos = self.store.get(key)
+        if pos is not None:
+            return pos
+
+        base = self.store.base_model(cluster_ids, self.n_neighbors) if keep_model else None
+        if base is not None:
+            # Spikes the base model was fitted on keep their coordinates,
+            # the others are projected
+            model, base_spikes, base_pos = base
+            spike_ids = np.asarray(spike_ids)
+            index = np.clip(np.searchsorted(base_spikes, spike_ids), 0,
+                            len(base_spikes) - 1)
+            found = base_spikes[index] == spike_ids
+            pos = np.empty((len(spike_ids), base_pos.shape[1]), dtype=base_pos.dtype)
+            pos[found] = base_pos[index[found]]
+            if not found.all():
+                data = self.waveform_features(controller, spike_ids[~found])
+                try:
+                    pos[~found] = model.worker.transform(model, data,
+                                                         cancelled=cancelled,
+                                                         tag=tag)
+                except ModelLost:
+                    self.store.drop_model(model)
+                    base = None
+        if base is None:
+            data = self.waveform_features(controller, spike_ids)
+            model, pos = worker.fit(data, cancelled=cancelled, tag=tag,
+                                    n_neighbors=min(self.n_neighbors,
+                                                    len(data) - 1))
+            if keep_model:
+                for evicted in self.store.add_model(cluster_ids, self.n_neighbors,
+                                                    model, spike_ids, pos):
+                    evicted.worker.forget(evicted)
+            else:
+                worker.forget(model)
+        self.store.put(key, pos)
+        return pos
+
+    @staticmethod
+    def quick_layout(data):
+        """First two principal components of data, a stand-in until UMAP is done."""
+        data = data - data.mean(axis=0)
+        _, _, vt = np.linalg.svd(data, full_matrices=False)
+        return (data @ vt[:2].T).astype(np.float32)
+
+    def refine(self, controller, generation, cluster_ids, quick_ids, spike_ids):
+        '''
+        Background work of a selection : UMAP of the quick subsample, then of
+        all the spikes, each handed to the views as soon as it is ready.
+        Stops as soon as a newer selection is made.
+        '''
+        def stale():
+            return generation != self.generation or self._stop.is_set()
+        try:
+            if len(quick_ids) < len(spike_ids):
+                self.embed(controller, cluster_ids, quick_ids, keep_model=False,
+                           cancelled=stale, tag=generation)
+                self.relay.ready.emit(generation)
+            self.embed(controller, cluster_ids, spike_ids, cancelled=stale,
+                       tag=generation)
+            self.relay.ready.emit(generation)
+        except Cancelled:
+            pass
+        except Exception as E:
+            print(f"UMAP: clusters {list(cluster_ids)} failed, {E!r}", file=sys.stderr)
+        finally:
+            if not stale():
+                self._idle.set()
+
+    def refresh(self, generation):
+        """Redraw the views with the embedding that just arrived (GUI thread)."""
+        if generation != self.generation:
+            return
+        for view in self.views:
+            view.plot()
+            view.canvas.update()
 
     def attach_to_controller(self, controller):
+        self.store = UMAPEmbeddingStore(os.path.join(controller.context.cache_dir, 'umap'),
+                                        self.data_version(controller))
+        self.relay = _Relay()
+        self.relay.ready.connect(self.refresh)
         #                                                                 
         #                        ,---.|                   o|    |         
         #                        |---||    ,---.,---.,---..|--- |---.,-.-.
         #                        |   ||    |   ||   ||    ||    |   || | |
         #                        `   '`---'`---|`---'`    ``---'`   '` ' '
         #                                  `---'                          
-        def coordscomplete(cluster_ids):
+        def coordscomplete(cluster_ids, load_all=False):
             """Must return a Bunch object with pos, spike_ids, spike_clusters."""
-            # We select 200 spikes from the selected clusters, using a batch size of 50 spikes.
-            # WARNING: lasso and split will work but will *only split the shown subselection* of
-            # spikes. You should use the `load_all` keyword argument to `coords()` to load all
-            # spikes before computing the spikes inside the lasso, however (1) this could be
-            # prohibitely long with UMAP, and (2) the coordinates will change when reperforming
-            # the dimension reduction on all spikes, so the splitting would be meaningless anyway.
-            # A warning is displayed when trying to split on a view that does not accept the
-            # `load_all` keyword argument, because it means that all relevant spikes (even not
-            # shown ones) are not going to be split.    
+            # Returns at once : the embedding of all the selected spikes if it is
+            # stored, else the UMAP of a quick subsample, else a PCA of that
+            # subsample. The UMAPs are computed in the background (refine) and
+            # the view is redrawn as each arrives.
+            # Lasso and split (load_all) act on the spikes shown : all of them
+            # once the full embedding has arrived, the subsample until then.
             spike_ids = controller.selector(self.spike_count, cluster_ids, self.batch_size)
+            pos = self.store.get(self.store.key(cluster_ids, spike_ids, self.n_neighbors))
+            if pos is None:
+                selection = (tuple(cluster_ids), self.n_neighbors, self.spike_count)
+                quick_ids = controller.selector(self.quick_spike_count, cluster_ids,
+                                                self.batch_size)
+                if selection != self.selection:
+                    # A new selection : stop the UMAP of a superseded one
+                    # (not the background caching) and start its own
+                    self.selection = selection
+                    self.generation += 1
+                    self._idle.clear()
+                    self.worker.cancel(lambda generation: generation != self.generation)
+                    threading.Thread(target=self.refine, name='umap-selection',
+                                     args=(controller, self.generation, cluster_ids,
+                                           quick_ids, spike_ids),
+                                     daemon=True).start()
+                spike_ids = quick_ids
+                pos = self.store.get(self.store.key(cluster_ids, spike_ids,
+                                                    self.n_neighbors))
+                if pos is None:
+                    # Raw waveforms : the feature basis may not be fitted yet
+                    pos = self.quick_layout(self.raw_features(controller, spike_ids))
 
             # We get the cluster ids corresponding to the chosen spikes.
             spike_clusters = controller.supervisor.clustering.spike_clusters[spike_ids]
-
-            # We get the waveforms of the spikes, across all channels so that we use the
-            # same dimensions for every cluster.
-            data = controller.model.get_waveforms(spike_ids, None)
-
-            # We reshape the array as a 2D array so that we can pass it to the t-SNE algorithm.
-            (n_spikes, n_samples, n_channels) = data.shape
-            data = data.transpose((0, 2, 1))  # get an (n_spikes, n_channels, n_samples) array
-            data = data.reshape((n_spikes, n_samples * n_channels))
-
-            # We perform the dimension reduction.
-            pos = WaveformUMAPPluginComplete.umapfunc(data, n_neighbors=self.n_neighbors)
             return Bunch(pos=pos, spike_ids=spike_ids, spike_clusters=spike_clusters)
         #                              o          
         #                        .    ,.,---.. . .
@@ -80,7 +554,11 @@ class WaveformUMAPPluginComplete(IPlugin):
         #                                         
         def create_view():
             """Create and return a histogram view."""
-            return WaveformUMAPView(coords=controller.context.cache(coordscomplete))
+            # No context.cache : the embedding store already persists the
+            # coordinates, and is keyed on n_neighbors and the spikes shown
+            view = WaveformUMAPView(coords=coordscomplete)
+            self.views.append(view)
+            return view
 
         # Maps a view name to a function that returns a view
         # when called with no argument.
@@ -91,9 +569,19 @@ class WaveformUMAPPluginComplete(IPlugin):
         #                        ,---||    |    ||   ||   |`---.
         #                        `---^`---'`---'``---'`   '`---'
         #                                                       
+        @connect(event='gui_ready')
+        def on_gui_loaded(sender, gui):
+            self.cache_all_clusters(controller)
+
+        @connect(event='close')
+        def on_close(sender):
+            self._stop.set()
+            self._idle.set()
+            self.worker.close()
+            self.cache_worker.close()
+
         @connect(event='add_view')
         def on_gui_ready(sender, gui):
-            import sys
             # Add a separator at the end of the File menu.
             # Note: currently, there is no way to add actions at another position in the menu.
             view = gui.views[-1]
@@ -130,6 +618,38 @@ class WaveformUMAPPluginComplete(IPlugin):
                 gui.status_message = f"UMAP: changed the batch size to {batch_size}"
 
 
-    def cache_all_clusters():
-        ''' Function that caches all clusters '''
-        pass
+    def cache_all_clusters(self, controller):
+        '''
+        Precompute, in a background thread, the embedding of every cluster
+        on its own, so that selections are served from the store and
+        multi-cluster selections only project the added clusters. The fits
+        run in the niced cache worker, and a new cluster is only started
+        while no selection is being computed.
+        '''
+        def run():
+            queue = list(controller.supervisor.clustering.cluster_ids)
+            while queue and not self._stop.is_set():
+                # Selections go first; a cluster cut short by one is redone
+                if not self._idle.wait(timeout=1):
+                    continue
+                cluster_id = queue[0]
+                try:
+                    spike_ids = controller.selector(self.spike_count, [cluster_id],
+                                                    self.batch_size)
+                    self.embed(controller, [cluster_id], spike_ids,
+                               cancelled=lambda: not self._idle.is_set(),
+                               worker=self.cache_worker)
+                except Cancelled:
+                    continue
+                except Exception as E:
+                    print(f"UMAP cache: cluster {cluster_id} failed, {E!r}",
+                          file=sys.stderr)
+                queue.pop(0)
+        thread = threading.Thread(target=run, name='umap-cache', daemon=True)
+        thread.start()
+        return thread
+
+
+if __name__ == '__umap_worker__':
+    # Started by UMAPWorker, with worker_connection, worker_gpu and worker_nice set
+    serve(worker_connection, worker_gpu, worker_nice)
@@ -0,0 +1,410 @@
+# Scratch staging of tetrode folders
+#
+# Sessions often live on a slow network mount, where waveform extraction's
+# random reads across filt.mda are expensive. A Stager copies the files a
+# tetrode export needs to a local scratch folder in a background thread
+# (while the previous tetrode is being processed), hands out the scratch copy
+# to work in, and copies what the export produced back to the session in
+# another background thread. Staged copies are evicted, oldest first, to keep
+# the scratch folder under a size cap.
+
+import json
+import os
+import shutil
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import lease
+import manifest
+import mdaio
+
+# Files a tetrode export reads, or keeps state in between runs
+STAGED_FILES = ('filt.mda', 'firings_raw.mda', 'params.json', 'geom.csv',
+                'raw.mda.prv', 'metrics_tagged.json', manifest.MANIFEST,
+                mdaio.HEADER_CACHE)
+
+# Folders the export writes; staged too when present, for incremental runs
+STAGED_FOLDERS = ('waveform', 'waveform_subsample', 'phy')
+
+# Name of the raw recording a staged raw.mda.prv points to
+STAGED_RAW = 'raw.mda'
+
+# Small text files that may hold absolute paths (phy's params.py, the
+# spikeinterface json of the waveform folders); paths into the session copy
+# (and to the raw recording) are translated to the scratch copy on the way
+# in, and back on the way out
+TRANSLATED = ('.py', '.json')
+TRANSLATE_MAX = 2**20
+
+def _walk(folder:str):
+    '''
+    {path relative to folder: (size, mtime_ns)} of every file under folder
+    '''
+    files = {}
+    for root, _, names in os.walk(folder):
+        for name in names:
+            path = os.path.join(root, name)
+            stat = os.stat(path)
+            files[os.path.relpath(path, folder)] = (stat.st_size, stat.st_mtime_ns)
+    return files
+
+def _folders(folder:str):
+    '''
+    {name: inode} of the folders directly under folder; a folder that was
+    rebuilt and swapped in has a new inode
+    '''
+    return {item.name: item.inode() for item in os.scandir(folder)
+            if item.is_dir()}
+
+def _translate(path:str, old:str, new:str, name=None):
+    '''
+    Replace the folder old by new in the file at path, if it is a small
+    text file of a TRANSLATED kind (judged from name, default path). Keeps
+    the mtime.
+    '''
+    if (not (name or path).endswith(TRANSLATED)
+            or os.path.getsize(path) > TRANSLATE_MAX):
+        return
+    try:
+        with open(path, 'r') as F:
+            text = F.read()
+    except (UnicodeDecodeError, OSError):
+        return
+    if old not in text:
+        return
+    stat = os.stat(path)
+    with open(path, 'w') as F:
+        F.write(text.replace(old, new))
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+
+def _translate_tree(folder:str, old:str, new:str):
+    for root, _, names in os.walk(folder):
+        for name in names:
+            _translate(os.path.join(root, name), old, new)
+
+class Entry:
+    '''
+    One staged tetrode : its scratch copy, the copy-in and write-back
+    futures, and the files and folders as they were after the last copy
+    (the baseline the write-back diffs against)
+    '''
+
+    def __init__(self, remote:str, scratch:str, size:int):
+        self.remote = remote
+        self.scratch = scratch
+        self.size = size
+        self.raw = None
+        self.copy = None
+        self.write_back = None
+        self.baseline = {}
+        self.folders = {}
+        self.claim = None
+        self.in_use = False
+        self.last_used = time.time()
+
+    def idle(self):
+        '''
+        Safe to evict : not in use, and its outputs are back in the session
+        '''
+        return (not self.in_use and self.copy is not None and self.copy.done()
+                and (self.write_back is None or (self.write_back.done() and
+                                                 self.write_back.exception() is None)))
+
+    def failed(self):
+        '''
+        Its write-back raised : the staged copy holds the only copy of its
+        outputs, and is never evicted
+        '''
+        return (self.write_back is not None and self.write_back.done()
+                and self.write_back.exception() is not None)
+
+class Stager:
+    '''
+    Stage tetrode folders through a local scratch folder
+
+    Parameters
+    ----------
+    scratch_dir : str
+        local folder the copies are made in
+    max_bytes : int or None
+        size cap of the staged copies; a tetrode that does not fit even after
+        evicting every idle copy is processed in place
+    filtered : bool
+        the export reads filt.mda (else the recording raw.mda.prv points to,
+        which is staged too, with the staged prv pointing at the copy)
+    '''
+
+    def __init__(self, scratch_dir:str, max_bytes=None, filtered=True):
+        self.scratch_dir = os.path.abspath(scratch_dir)
+        self.max_bytes = max_bytes
+        self.filtered = filtered
+        self.entries = {}
+        self.errors = []
+        self.lock = threading.RLock()
+        # Copies in and out each get a thread, so write-back never holds up
+        # the prefetch of the next tetrode
+        self.copier = ThreadPoolExecutor(max_workers=1, thread_name_prefix='stage-in')
+        self.writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix='stage-out')
+        os.makedirs(self.scratch_dir, exist_ok=True)
+
+    # ----------------
+    # What gets staged
+    # ----------------
+    def inputs(self, remote:str):
+        '''
+        {relative path: source path} of the files to stage for remote
+        '''
+        files = {name: os.path.join(remote, name) for name in STAGED_FILES
+                 if os.path.exists(os.path.join(remote, name))}
+        if self.filtered:
+            files.pop('raw.mda.prv', None)
+        else:
+            files.pop('filt.mda', None)
+            if 'raw.mda.prv' in files:
+                with open(files['raw.mda.prv'], 'r') as F:
+                    files[STAGED_RAW] = json.load(F)['original_path']
+        for folder in STAGED_FOLDERS:
+            if os.path.isdir(os.path.join(remote, folder)):
+                for name in _walk(os.path.join(remote, folder)):
+                    path = os.path.join(folder, name)
+                    files[path] = os.path.join(remote, path)
+        return files
+
+    def used(self):
+        with self.lock:
+            return sum(entry.size for entry in self.entries.values())
+
+    # --------
+    # Eviction
+    # --------
+    def _evict(self, entry:Entry):
+        del self.entries[entry.remote]
+        shutil.rmtree(entry.scratch, ignore_errors=True)
+
+    def _make_room(self, size:int):
+        '''
+        Evict idle copies, least recently used first (waiting on their
+        write-back if need be) until size more bytes fit under max_bytes.
+        Copies whose write-back failed are kept and take up room.
+        '''
+        if self.max_bytes is None:
+            return True
+        if size > self.max_bytes:
+            return False
+        while True:
+            with self.lock:
+                if self.used() + size <= self.max_bytes:
+                    return True
+                candidates = sorted((entry for entry in self.entries.values()
+                                     if entry.copy is not None and not entry.in_use
+                                     and not entry.failed()),
+                                    key=lambda entry: entry.last_used)
+                idle = [entry for entry in candidates if entry.idle()]
+                if idle:
+                    self._evict(idle[0])
+                    continue
+                if not candidates:
+                    return False
+                waiting = candidates[0]
+            # Only copies still being written back or fetched : wait for one
+            for future in (waiting.copy, waiting.write_back):
+                if future is not None:
+                    future.exception()
+
+    # -------
+    # Copying
+    # -------
+    def _copy_in(self, entry:Entry, files:dict):
+        entry.raw = files.get(STAGED_RAW)
+        for name, source in files.items():
+            target = os.path.join(entry.scratch, name)
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            # copy2 keeps mtimes, so the manifest and header caches still
+            # recognize the staged files
+            shutil.copy2(source, target + '.part')
+            if entry.raw is not None:
+                _translate(target + '.part', entry.raw,
+                           os.path.join(entry.scratch, STAGED_RAW), name)
+            _translate(target + '.part', entry.remote, entry.scratch, name)
+            os.replace(target + '.part', target)
+        if STAGED_RAW in files:
+            prv = os.path.join(entry.scratch, 'raw.mda.prv')
+            with open(prv, 'r') as F:
+                pointer = json.load(F)
+            pointer['original_path'] = os.path.join(entry.scratch, STAGED_RAW)
+            with open(prv, 'w') as F:
+                json.dump(pointer, F)
+        entry.baseline = _walk(entry.scratch)
+        entry.folders = _folders(entry.scratch)
+        return entry.scratch
+
+    def _copy_out(self, entry:Entry):
+        '''
+        Copy the files the export created or changed back to the session.
+        An output folder the export rebuilt (swapped in anew) replaces the
+        session's as a whole (copied next to it, then swapped in). In a
+        folder updated in place, like a phy folder that got its PC features
+        filled in, only the changed files are written, each through a
+        rename, so files changed meanwhile in the session (phy curation) are
+        kept; files the export removed are removed last. Nothing is written
+        if the lease on the session folder was lost.
+        '''
+        if entry.claim is not None:
+            entry.claim.check()
+        current = _walk(entry.scratch)
+        folders = _folders(entry.scratch)
+        changed = {name for name, stat in current.items()
+                   if entry.baseline.get(name) != stat}
+        removed = {name for name in entry.baseline if name not in current}
+        changed -= {'raw.mda.prv', STAGED_RAW}
+        removed -= {'raw.mda.prv', STAGED_RAW}
+
+        # Folders rebuilt, created or removed by the export
+        rebuilt = {folder for folder in set(folders) | set(entry.folders)
+                   if folders.get(folder) != entry.folders.get(folder)}
+        for folder in rebuilt:
+            source = os.path.join(entry.scratch, folder)
+            target = os.path.join(entry.remote, folder)
+            if os.path.exists(target + '.writeback'):
+                shutil.rmtree(target + '.writeback')
+            if os.path.isdir(source):
+                shutil.copytree(source, target + '.writeback')
+                if entry.raw is not None:
+                    _translate_tree(target + '.writeback',
+                                    os.path.join(entry.scratch, STAGED_RAW), entry.raw)
+                _translate_tree(target + '.writeback', entry.scratch, entry.remote)
+                lease.replace_folder(target + '.writeback', target)
+            elif os.path.isdir(target):
+                shutil.rmtree(target)
+
+        # Files changed in place, in the folders first so that top level
+        # state (the manifest) lands last
+        for name in sorted(changed, key=lambda name: os.sep not in name):
+            if name.split(os.sep)[0] in rebuilt:
+                continue
+            target = os.path.join(entry.remote, name)
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            shutil.copy2(os.path.join(entry.scratch, name), target + '.writeback')
+            if entry.raw is not None:
+                _translate(target + '.writeback', os.path.join(entry.scratch, STAGED_RAW),
+                           entry.raw, name)
+            _translate(target + '.writeback', entry.scratch, entry.remote, name)
+            os.replace(target + '.writeback', target)
+        for name in removed:
+            target = os.path.join(entry.remote, name)
+            if name.split(os.sep)[0] not in rebuilt and os.path.exists(target):
+                os.remove(target)
+        entry.baseline = current
+        entry.folders = folders
+
+    # ---
+    # API
+    # ---
+    def prefetch(self, remote:str):
+        '''
+        Start copying remote to scratch in the background, unless it is
+        already staged or does not fit
+        '''
+        remote = os.path.abspath(remote)
+        with self.lock:
+            if remote in self.entries:
+                return self.entries[remote]
+        # Listing and sizes come from the (slow) session mount, and making
+        # room may wait on write-backs : neither holds the lock, which the
+        # write-back callbacks and the other threads need meanwhile
+        files = self.inputs(remote)
+        size = sum(os.path.getsize(path) for path in files.values())
+        while True:
+            if not self._make_room(size):
+                return None
+            with self.lock:
+                if remote in self.entries:
+                    return self.entries[remote]
+                # Room taken by another prefetch since : make room again
+                if (self.max_bytes is not None
+                        and self.used() + size > self.max_bytes):
+                    continue
+                # Session and tetrode name : several sessions can share a scratch
+                scratch = os.path.join(self.scratch_dir,
+                                       os.path.basename(os.path.dirname(remote)) + '_' +
+                                       os.path.basename(remote))
+                if os.path.exists(scratch):
+                    shutil.rmtree(scratch)
+                entry = Entry(remote, scratch, size)
+                self.entries[remote] = entry
+                entry.copy = self.copier.submit(self._copy_in, entry, files)
+                return entry
+
+    def acquire(self, remote:str):
+        '''
+        Path to process remote at : its scratch copy once the copy is done,
+        or remote itself if it could not be staged
+        '''
+        entry = self.prefetch(remote)
+        if entry is None:
+            return os.path.abspath(remote)
+        # A previous write-back of this folder must land before it changes again
+        if entry.write_back is not None:
+            entry.write_back.exception()
+        try:
+            entry.copy.result()
+        except Exception as E:
+            self.errors.append((entry.remote, repr(E)))
+            with self.lock:
+                self._evict(entry)
+            return os.path.abspath(remote)
+        with self.lock:
+            entry.in_use = True
+            entry.last_used = time.time()
+        return entry.scratch
+
+    def release(self, remote:str, claim=None):
+        '''
+        Done processing remote : write its outputs back in the background,
+        provided claim (a lease.Claim on remote) is still held.
+        Returns the future of the write-back (None if remote was not staged).
+        '''
+        remote = os.path.abspath(remote)
+        with self.lock:
+            entry = self.entries.get(remote)
+            if entry is None or not entry.in_use:
+                return None
+            entry.in_use = False
+            entry.last_used = time.time()
+            entry.claim = claim
+            entry.write_back = self.writer.submit(self._copy_out, entry)
+            entry.write_back.add_done_callback(
+                lambda future: self._written_back(entry, future))
+            return entry.write_back
+
+    def _written_back(self, entry:Entry, future):
+        # Record a failed write-back as soon as it happens
+        if future.exception() is not None:
+            with self.lock:
+                self.errors.append((entry.remote, repr(future.exception())))
+
+    def remote_path(self, path:str):
+        '''
+        Translate a path inside a staged copy to the session path
+        '''
+        with self.lock:
+            for entry in self.entries.values():
+                if path == entry.scratch or path.startswith(entry.scratch + os.sep):
+                    return entry.remote + path[len(entry.scratch):]
+        return path
+
+    def close(self, keep=False):
+        '''
+        Wait for every write-back, then remove the staged copies (unless
+        keep). Copies whose write-back failed are kept, as they hold the
+        only copy of their outputs. Returns the (remote, error) of the copies
+        that failed.
+        '''
+        self.copier.shutdown(wait=True)
+        self.writer.shutdown(wait=True)
+        with self.lock:
+            for entry in list(self.entries.values()):
+                if not entry.failed() and not keep:
+                    self._evict(entry)
+        return self.errors
@@ -0,0 +1,251 @@
+# Cached waveform store
+#
+# Keeps the spikeinterface waveform folder of a tetrode between runs. The
+# store is keyed on the identity of the recording and on the extraction
+# parameters; within a store every unit carries a fingerprint of its spike
+# train, so after a re-sort only the units whose spikes changed are extracted
+# again.
+
+import hashlib
+import json
+import os
+import shutil
+
+import numpy as np
+import spikeinterface.core.waveform_extractor as wave_extract
+
+# Lives inside the waveform folder
+STORE_INDEX = 'store_index.json'
+
+# Extraction parameters that change the content of a waveform file
+KEY_PARAMS = ('ms_before', 'ms_after', 'return_scaled', 'max_spikes_per_unit',
+              'dtype', 'num_strata')
+
+def store_key(recording_id:str, params:dict):
+    '''
+    Digest identifying a recording + extraction parameter combination
+    '''
+    key = dict(recording=recording_id,
+               **{name: params.get(name) for name in KEY_PARAMS})
+    return hashlib.blake2b(json.dumps(key, sort_keys=True).encode(),
+                           digest_size=16).hexdigest()
+
+def stratified_indices(spike_train, num_samples:int, max_spikes, num_strata:int,
+                       seed=0):
+    '''
+    Pick about max_spikes indices of a sorted spike train, spread over
+    num_strata equal stretches of the recording. Every stretch gets a share
+    proportional to its spike count, and at least one spike when it has any,
+    so the subsample can exceed max_spikes by at most num_strata.
+    '''
+    n = len(spike_train)
+    if max_spikes is None or n <= max_spikes:
+        return np.arange(n)
+    rng = np.random.default_rng(seed)
+    edges = np.linspace(0, num_samples, num_strata + 1)[1:-1]
+    bounds = np.concatenate(([0], np.searchsorted(spike_train, edges), [n]))
+    counts = np.diff(bounds)
+    share = counts * max_spikes / n
+    quota = np.floor(share).astype('int64')
+    # Hand the rounding remainder to the stretches that lost the most to it
+    remainder = max_spikes - quota.sum()
+    quota[np.argsort(quota - share)[:remainder]] += 1
+    quota[(counts > 0) & (quota == 0)] = 1
+    quota = np.minimum(quota, counts)
+    selected = [start + rng.choice(count, size=take, replace=False)
+                for start, count, take in zip(bounds[:-1], counts, quota)
+                if take > 0]
+    return np.sort(np.concatenate(selected))
+
+class StratifiedWaveformExtractor(wave_extract.WaveformExtractor):
+    '''
+    WaveformExtractor whose max_spikes_per_unit subsample is stratified in
+    time (see stratified_indices) instead of drawn uniformly at random
+    '''
+
+    num_strata = 20
+
+    def sample_spikes(self):
+        max_spikes = self._params['max_spikes_per_unit']
+        selected_spikes = {}
+        for unit_id in self.sorting.unit_ids:
+            selected_spikes[unit_id] = []
+            for segment_index in range(self.sorting.get_num_segments()):
+                train = self.sorting.get_unit_spike_train(unit_id=unit_id,
+                                                          segment_index=segment_index)
+                num_samples = self.recording.get_num_samples(segment_index=segment_index)
+                inds = stratified_indices(train, num_samples, max_spikes,
+                                          self.num_strata)
+                # Same border rule as spikeinterface's uniform sampling
+                if max_spikes is not None:
+                    times = train[inds]
+                    inds = inds[(times >= self.nbefore) &
+                                (times < num_samples - self.nafter)]
+                selected_spikes[unit_id].append(inds)
+
+            # store in a 2 columns (spike_index, segment_index) in a npy file
+            n = sum(inds.size for inds in selected_spikes[unit_id])
+            sampled_index = np.zeros(n, dtype=[('spike_index', 'int64'),
+                                               ('segment_index', 'int64')])
+            pos = 0
+            for segment_index, inds in enumerate(selected_spikes[unit_id]):
+                sampled_index[pos:pos + inds.size]['spike_index'] = inds
+                sampled_index[pos:pos + inds.size]['segment_index'] = segment_index
+                pos += inds.size
+            np.save(os.path.join(self.folder, 'waveforms',
+                                 f'sampled_index_{unit_id}.npy'), sampled_index)
+        return selected_spikes
+
+def extract(recording, sorting, folder:str, params:dict, num_strata=None,
+            precompute_template=('average',), **job_kwargs):
+    '''
+    extract_waveforms into a fresh folder; with num_strata the spike
+    subsample is stratified in time (StratifiedWaveformExtractor)
+    '''
+    if num_strata is None:
+        return wave_extract.extract_waveforms(recording, sorting, folder,
+                                              overwrite=True,
+                                              precompute_template=precompute_template,
+                                              **params, **job_kwargs)
+    if os.path.isdir(folder):
+        shutil.rmtree(folder)
+    waveform = StratifiedWaveformExtractor.create(recording, sorting, folder)
+    waveform.num_strata = num_strata
+    waveform.set_params(**params)
+    waveform.run_extract_waveforms(**job_kwargs)
+    if precompute_template is not None:
+        waveform.precompute_templates(modes=precompute_template)
+    return waveform
+
+def unit_fingerprints(sorting):
+    '''
+    Hash of every unit's spike train, keyed by str(unit_id)
+    '''
+    fingerprints = {}
+    for unit_id in sorting.unit_ids:
+        digest = hashlib.blake2b(digest_size=16)
+        for segment_index in range(sorting.get_num_segments()):
+            train = sorting.get_unit_spike_train(unit_id=unit_id,
+                                                 segment_index=segment_index)
+            digest.update(np.ascontiguousarray(train, dtype='int64').tobytes())
+        fingerprints[str(unit_id)] = digest.hexdigest()
+    return fingerprints
+
+def read_index(folder:str):
+    index_file = os.path.join(folder, STORE_INDEX)
+    if not os.path.exists(index_file):
+        return {}
+    try:
+        with open(index_file, 'r') as F:
+            return json.load(F)
+    except (ValueError, OSError):
+        return {}
+
+def write_index(folder:str, key:str, fingerprints:dict):
+    index_file = os.path.join(folder, STORE_INDEX)
+    with open(index_file + '.tmp', 'w') as F:
+        json.dump(dict(key=key, units=fingerprints), F)
+    os.replace(index_file + '.tmp', index_file)
+
+def _unit_files(folder:str, unit_id):
+    waveforms = os.path.join(folder, 'waveforms')
+    return (os.path.join(waveforms, f'waveforms_{unit_id}.npy'),
+            os.path.join(waveforms, f'sampled_index_{unit_id}.npy'))
+
+def _drop_derived(folder:str):
+    '''
+    Remove the templates and extensions (PCs, amplitudes, ...) computed from
+    the previous set of waveforms
+    '''
+    for name in os.listdir(folder):
+        path = os.path.join(folder, name)
+        if name.startswith('templates_') and name.endswith('.npy'):
+            os.remove(path)
+        elif os.path.isdir(path) and name != 'waveforms':
+            shutil.rmtree(path)
+
+def load_or_extract(recording, sorting, folder:str, recording_id:str,
+                    params:dict, num_strata=None, **job_kwargs):
+    '''
+    Return a WaveformExtractor for recording/sorting in folder, reusing the
+    cached waveforms of every unit whose spike train is unchanged
+
+    Parameters
+    ----------
+    recording_id : str
+        identity of the recording (e.g. the hash of filt.mda + geom.csv)
+    params : dict
+        keyword arguments of extract_waveforms (ms_before, ms_after, ...)
+    num_strata : int or None
+        stratify the max_spikes_per_unit subsample over this many stretches
+        of the recording (None : spikeinterface's uniform sampling)
+    job_kwargs :
+        n_jobs, total_memory, progress_bar ... for the extraction
+
+    Returns
+    -------
+    (WaveformExtractor, list of unit ids that were extracted)
+    '''
+    key = store_key(recording_id, dict(params, num_strata=num_strata))
+    fingerprints = unit_fingerprints(sorting)
+    index = read_index(folder)
+
+    # Unusable store : different recording or parameters, extract everything
+    if (index.get('key') != key
+            or not os.path.isdir(os.path.join(folder, 'waveforms'))):
+        waveform = extract(recording, sorting, folder, params, num_strata,
+                           **job_kwargs)
+        write_index(folder, key, fingerprints)
+        return waveform, list(sorting.unit_ids)
+
+    # A unit may have been renumbered by the re-sort; find its old files by
+    # fingerprint before deciding it needs extraction
+    cached = {fingerprint: unit for unit, fingerprint in index['units'].items()
+              if all(os.path.exists(f) for f in _unit_files(folder, unit))}
+    reuse = {str(unit): cached.get(fingerprints[str(unit)])
+             for unit in sorting.unit_ids}
+    stale = [unit for unit in sorting.unit_ids if reuse[str(unit)] is None]
+    if not stale and all(reuse[unit] == unit for unit in reuse) \
+            and set(index['units']) == set(fingerprints):
+        return wave_extract.WaveformExtractor.load_from_folder(folder), []
+
+    # Stage the reused files under their new unit ids, then extract the
+    # stale units into a scratch folder and move them in as well
+    staging = os.path.join(folder, 'waveforms.staging')
+    if os.path.exists(staging):
+        shutil.rmtree(staging)
+    os.makedirs(staging)
+    staged = {}
+    for unit, old_unit in reuse.items():
+        if old_unit is None:
+            continue
+        for old, new in zip(_unit_files(folder, old_unit),
+                            _unit_files(folder, unit)):
+            new = os.path.join(staging, os.path.basename(new))
+            # Two units with identical trains share the old files
+            if old in staged:
+                shutil.copyfile(staged[old], new)
+            else:
+                shutil.move(old, new)
+                staged[old] = new
+
+    if stale:
+        partial = os.path.join(folder, 'waveforms.partial')
+        extract(recording, sorting.select_units(stale), partial, params,
+                num_strata, precompute_template=None, **job_kwargs)
+        for unit in stale:
+            for path in _unit_files(partial, unit):
+                shutil.move(path, os.path.join(staging, os.path.basename(path)))
+        shutil.rmtree(partial)
+
+    # Swap the staged files in and point the store at the new sorting
+    shutil.rmtree(os.path.join(folder, 'waveforms'))
+    os.rename(staging, os.path.join(folder, 'waveforms'))
+    _drop_derived(folder)
+    if sorting.is_dumpable:
+        sorting.dump(os.path.join(folder, 'sorting.json'))
+
+    waveform = wave_extract.WaveformExtractor.load_from_folder(folder)
+    waveform.precompute_templates(modes=('average',))
+    write_index(folder, key, fingerprints)
+    return waveform, stale